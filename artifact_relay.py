@@ -0,0 +1,136 @@
+"""Local cache of provisioning artifacts relayed to nodes over SFTP.
+
+In relay mode nodes don't download anything from Docker Hub, get.docker.com or
+GitHub themselves; the bot host keeps these files in ARTIFACT_CACHE_DIR and
+uploads them:
+
+- ``marzban-node.tar``: the node image as written by ``docker save``
+- ``docker-compose.yml``: the upstream Marzban-node compose file used for warm-up
+- ``packages/*.deb``: Docker engine/compose packages for the nodes' distribution
+  (optional; preferred over the installer)
+- ``get-docker.sh``: the get.docker.com installer (optional)
+
+The cache can be filled by hand (e.g. from a local stand-in registry) or with
+``python artifact_relay.py refresh [source-image]``.
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import posixpath
+import sys
+import tarfile
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_RELAY_ENABLED = os.environ.get("MARZBAN_ARTIFACT_RELAY", "").lower() in ('1', 'true', 'yes')
+ARTIFACT_CACHE_DIR = os.environ.get("MARZBAN_ARTIFACT_CACHE", "artifacts")
+
+# Staging directory on the node, writable by the SSH user
+REMOTE_ARTIFACT_DIR = "/tmp/marzban-node-artifacts"
+
+IMAGE_TARBALL = "marzban-node.tar"
+UPSTREAM_COMPOSE = "docker-compose.yml"
+DOCKER_INSTALLER = "get-docker.sh"
+PACKAGES_DIR = "packages"
+
+UPSTREAM_COMPOSE_URLS = (
+    "https://raw.githubusercontent.com/Gozargah/Marzban-node/master/docker-compose.yml",
+    "https://raw.githubusercontent.com/Gozargah/Marzban-node/main/docker-compose.yml",
+)
+DOCKER_INSTALLER_URL = "https://get.docker.com"
+
+
+def _existing(path: str):
+    return path if os.path.isfile(path) and os.path.getsize(path) > 0 else None
+
+
+def cached_artifacts(cache_dir: str = ARTIFACT_CACHE_DIR) -> dict:
+    """Returns the paths of the artifacts present in the cache (None when missing)."""
+    packages_dir = os.path.join(cache_dir, PACKAGES_DIR)
+    packages = []
+    if os.path.isdir(packages_dir):
+        packages = sorted(
+            os.path.join(packages_dir, name) for name in os.listdir(packages_dir) if name.endswith('.deb')
+        )
+    return {
+        'image': _existing(os.path.join(cache_dir, IMAGE_TARBALL)),
+        'compose': _existing(os.path.join(cache_dir, UPSTREAM_COMPOSE)),
+        'installer': _existing(os.path.join(cache_dir, DOCKER_INSTALLER)),
+        'packages': packages,
+    }
+
+
+@functools.lru_cache(maxsize=4)
+def _tarball_image_id(path: str, mtime: float):
+    with tarfile.open(path) as tar:
+        member = tar.extractfile('manifest.json')
+        manifest = json.load(member) if member else []
+    if not manifest:
+        return None
+    # "blobs/sha256/<hex>" (OCI layout) or "<hex>.json" (legacy layout), the image's config digest
+    return 'sha256:' + posixpath.basename(manifest[0]['Config']).removesuffix('.json')
+
+
+def image_tarball_id(path: str):
+    """Returns the image ID (``sha256:...``, as ``docker image inspect`` reports it) saved in a
+    ``docker save`` tarball, or None when it can't be read."""
+    try:
+        return _tarball_image_id(path, os.path.getmtime(path))
+    except (OSError, KeyError, IndexError, ValueError, tarfile.TarError) as e:
+        logger.warning(f"Could not read the image ID of {path}: {e}")
+        return None
+
+
+async def _run(*command: str) -> None:
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    output, _ = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed with exit status {process.returncode}: {output.decode(errors='replace')[-500:]}")
+
+
+async def _download(urls, path: str) -> None:
+    import httpx
+
+    async with httpx.AsyncClient(follow_redirects=True, timeout=60) as client:
+        for url in urls:
+            response = await client.get(url)
+            if response.status_code == 200:
+                with open(path + '.part', 'wb') as f:
+                    f.write(response.content)
+                os.replace(path + '.part', path)
+                return
+    raise RuntimeError(f"Could not download {path} from {', '.join(urls)}")
+
+
+async def refresh_artifact_cache(image: str, source_image: str = None, cache_dir: str = ARTIFACT_CACHE_DIR) -> dict:
+    """Fills the cache on the bot host: pulls and saves the image, downloads compose and installer.
+
+    ``source_image`` lets the image come from another registry (e.g. a local stand-in);
+    it is re-tagged as ``image`` so nodes see the name their compose file expects.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    source_image = source_image or image
+    await _run('docker', 'pull', source_image)
+    if source_image != image:
+        await _run('docker', 'tag', source_image, image)
+    tarball = os.path.join(cache_dir, IMAGE_TARBALL)
+    await _run('docker', 'save', '-o', tarball + '.part', image)
+    os.replace(tarball + '.part', tarball)
+    logger.info(f"Saved {image} to {tarball}")
+
+    await _download(UPSTREAM_COMPOSE_URLS, os.path.join(cache_dir, UPSTREAM_COMPOSE))
+    await _download((DOCKER_INSTALLER_URL,), os.path.join(cache_dir, DOCKER_INSTALLER))
+    return cached_artifacts(cache_dir)
+
+
+if __name__ == "__main__":
+    from node_provisioning import NODE_IMAGE
+
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2 or sys.argv[1] != 'refresh':
+        print("usage: python artifact_relay.py refresh [source-image]")
+        sys.exit(1)
+    artifacts = asyncio.run(refresh_artifact_cache(NODE_IMAGE, sys.argv[2] if len(sys.argv) > 2 else None))
+    print(artifacts)
@@ -0,0 +1,330 @@
+"""Local stand-ins for a Marzban panel and for node SSH servers, for offline benchmarks.
+
+- FakeMarzbanPanel: threaded HTTP server implementing the panel endpoints the bot
+  uses (token, node settings, node create/list/usage) with configurable latency
+  and error rate.
+- FakeNodeSSHServer: paramiko SSH server accepting any credentials, serving SFTP
+  from a temporary root directory and answering uploaded step scripts by
+  replaying their step markers, spending --step-seconds per step
+  (--docker-seconds for the Docker install step).
+- FakeBotAPI: Telegram Bot API stand-in handing out one /start update and
+  recording when the bot polls and replies (used by benchmarks/startup.py).
+
+Run both in their own process (so their threads don't skew the client's numbers):
+
+    python benchmarks/fake_servers.py --http-port 8000 --ssh-port 2222
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STEP_BEGIN = re.compile(r'^echo "__MARZBAN_NODE_STEP__ begin (\d+)"$', re.MULTILINE)
+
+FAKE_CERTIFICATE = "-----BEGIN CERTIFICATE-----\nRkFLRSBNQVJaQkFOIENFUlRJRklDQVRF\n-----END CERTIFICATE-----"
+
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address) -> None:
+        # A client that stopped mid-request (e.g. the bot shutting down) isn't a server error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+# --- Fake Telegram Bot API --- #
+class FakeBotAPI(FakeHTTPServer):
+    """Serves ``/bot<token>/<method>``; ``events`` maps getMe, getUpdates (the one carrying the
+    update) and sendMessage to the monotonic time they were first called."""
+
+    def __init__(self, port: int, chat_id: int = 42):
+        self.chat_id = chat_id
+        self.events = {}
+        self.update_sent = False
+        self.messages = 0
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', port), FakeBotAPIHandler)
+
+    def start_update(self) -> dict:
+        user = {'id': self.chat_id, 'is_bot': False, 'first_name': 'bench'}
+        return {'update_id': 1, 'message': {
+            'message_id': 1, 'date': int(time.time()), 'chat': {'id': self.chat_id, 'type': 'private'}, 'from': user,
+            'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        }}
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        api = self.server
+        method = self.path.rsplit('/', 1)[-1]
+        with api.lock:
+            api.events.setdefault(method, time.monotonic())
+            deliver = method == 'getUpdates' and not api.update_sent
+            api.update_sent = api.update_sent or deliver
+            if method == 'sendMessage':
+                api.messages += 1
+                message_id = api.messages + 1
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'getUpdates':
+            if not deliver:
+                time.sleep(0.5) # An idle long poll
+            result = [api.start_update()] if deliver else []
+        elif method == 'sendMessage':
+            result = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': api.chat_id, 'type': 'private'}, 'text': '-'}
+        else:
+            result = True
+        data = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+
+# --- Fake Marzban panel --- #
+def fake_jwt(lifetime: int = 3600) -> str:
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+    return f"{encode({'alg': 'HS256', 'typ': 'JWT'})}.{encode({'sub': 'admin', 'exp': int(time.time()) + lifetime})}.c2ln"
+
+
+class FakeMarzbanPanel(FakeHTTPServer):
+    request_queue_size = 1024
+
+    def __init__(self, port: int, latency: float = 0.05, error_rate: float = 0.0, error_status: int = 500):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.nodes = []
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', port), FakeMarzbanHandler)
+
+
+class FakeMarzbanHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self) -> None:
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        panel = self.server
+        # Latency jittered by +-50% so percentiles have something to show
+        time.sleep(panel.latency * random.uniform(0.5, 1.5))
+        if random.random() < panel.error_rate:
+            self._reply(panel.error_status, {'detail': 'simulated error'})
+            return
+        path = self.path.split('?')[0]
+        if self.command == 'POST' and path == '/api/admin/token':
+            self._reply(200, {'access_token': fake_jwt(), 'token_type': 'bearer'})
+        elif not self.headers.get('Authorization', '').startswith('Bearer '):
+            self._reply(401, {'detail': 'Not authenticated'})
+        elif self.command == 'GET' and path == '/api/node/settings':
+            self._reply(200, {'min_node_version': 'v0.2.0', 'certificate': FAKE_CERTIFICATE})
+        elif self.command == 'POST' and path == '/api/node':
+            node = json.loads(body or b'{}')
+            with panel.lock:
+                node.update(id=len(panel.nodes) + 1, status='connected', message=None)
+                panel.nodes.append(node)
+            self._reply(200, node)
+        elif self.command == 'GET' and path == '/api/nodes':
+            with panel.lock:
+                self._reply(200, list(panel.nodes))
+        elif self.command == 'GET' and path == '/api/nodes/usage':
+            with panel.lock:
+                usages = [{'node_id': node['id'], 'node_name': node['name'], 'uplink': 1 << 20, 'downlink': 1 << 24} for node in panel.nodes]
+            self._reply(200, {'usages': usages})
+        else:
+            self._reply(404, {'detail': 'Not Found'})
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+# --- Fake node SSH server --- #
+def rooted_sftp_server(root: str):
+    """Returns an SFTPServerInterface class serving ``root`` as the remote filesystem."""
+    import paramiko
+
+    class RootedSFTPServer(paramiko.SFTPServerInterface):
+        def _path(self, path):
+            return os.path.join(root, self.canonicalize(path).lstrip('/'))
+
+        def open(self, path, flags, attr):
+            real = self._path(path)
+            try:
+                fd = os.open(real, flags, 0o600)
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            if flags & os.O_WRONLY:
+                mode = 'ab' if flags & os.O_APPEND else 'wb'
+            elif flags & os.O_RDWR:
+                mode = 'r+b'
+            else:
+                mode = 'rb'
+            handle = paramiko.SFTPHandle(flags)
+            handle.filename = real
+            handle.readfile = handle.writefile = os.fdopen(fd, mode)
+            return handle
+
+        def stat(self, path):
+            try:
+                return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        lstat = stat
+
+        def mkdir(self, path, attr):
+            try:
+                os.mkdir(self._path(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def chattr(self, path, attr):
+            if attr.st_mode is not None:
+                os.chmod(self._path(path), attr.st_mode)
+            return paramiko.SFTP_OK
+
+    return RootedSFTPServer
+
+
+class FakeNodeSSHServer:
+    """Threaded paramiko SSH server simulating provisioning command durations."""
+
+    def __init__(self, port: int, root: str, step_seconds: float = 0.2, docker_seconds: float = 2.0, error_rate: float = 0.0):
+        import paramiko
+
+        self.port = port
+        self.root = root
+        self.step_seconds = step_seconds
+        self.docker_seconds = docker_seconds
+        self.error_rate = error_rate
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sftp_server = rooted_sftp_server(root)
+
+    def serve_forever(self) -> None:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', self.port))
+        listener.listen(1024)
+        while True:
+            sock, _ = listener.accept()
+            threading.Thread(target=self._serve_connection, args=(sock,), daemon=True).start()
+
+    def _serve_connection(self, sock) -> None:
+        import paramiko
+
+        server = self
+
+        class NodeInterface(paramiko.ServerInterface):
+            def get_allowed_auths(self, username):
+                return 'password,publickey'
+
+            def check_auth_password(self, username, password):
+                return paramiko.AUTH_SUCCESSFUL
+
+            def check_auth_publickey(self, username, key):
+                return paramiko.AUTH_SUCCESSFUL
+
+            def check_channel_request(self, kind, chanid):
+                return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+            def check_channel_pty_request(self, *args):
+                return True
+
+            def check_channel_exec_request(self, channel, command):
+                threading.Thread(target=server._run_command, args=(channel, command.decode()), daemon=True).start()
+                return True
+
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, self.sftp_server)
+        transport.start_server(server=NodeInterface())
+
+    def _run_command(self, channel, command: str) -> None:
+        exit_status = 0
+        # The exec reply is sent by the transport thread after check_channel_exec_request
+        # returns; closing the channel before that makes the client see "Channel closed"
+        time.sleep(0.01)
+        try:
+            if command.startswith('bash /'):
+                exit_status = self._replay_script(channel, os.path.join(self.root, command[len('bash /'):]))
+            # Probes report nothing satisfied, other commands succeed silently
+        finally:
+            channel.send_exit_status(exit_status)
+            channel.close()
+
+    def _replay_script(self, channel, path: str) -> int:
+        with open(path) as f:
+            script = f.read()
+        matches = list(STEP_BEGIN.finditer(script))
+        for number, match in enumerate(matches):
+            index = match.group(1)
+            end = matches[number + 1].start() if number + 1 < len(matches) else len(script)
+            duration = self.docker_seconds if 'get.docker.com' in script[match.end():end] else self.step_seconds
+            channel.sendall(f"__MARZBAN_NODE_STEP__ begin {index}\r\n".encode())
+            for line in range(3):
+                time.sleep(duration / 3)
+                channel.sendall(f"step {index} output {line}\r\n".encode())
+            status = 1 if random.random() < self.error_rate else 0
+            channel.sendall(f"__MARZBAN_NODE_STEP__ end {index} {status}\r\n".encode())
+            if status:
+                return status
+        return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--http-port', type=int, required=True)
+    parser.add_argument('--ssh-port', type=int, required=True)
+    parser.add_argument('--panel-latency', type=float, default=0.05, help='seconds per panel API call')
+    parser.add_argument('--panel-error-rate', type=float, default=0.0, help='fraction of panel calls answered with an error')
+    parser.add_argument('--panel-error-status', type=int, default=500, help='status code of simulated panel errors')
+    parser.add_argument('--step-seconds', type=float, default=0.2, help='duration of each SSH step')
+    parser.add_argument('--docker-seconds', type=float, default=2.0, help='duration of the Docker install step')
+    parser.add_argument('--ssh-error-rate', type=float, default=0.0, help='fraction of SSH steps that fail')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='fake-nodes-')
+    os.makedirs(os.path.join(root, 'tmp'))
+    panel = FakeMarzbanPanel(args.http_port, args.panel_latency, args.panel_error_rate, args.panel_error_status)
+    threading.Thread(target=panel.serve_forever, daemon=True).start()
+    ssh = FakeNodeSSHServer(args.ssh_port, root, args.step_seconds, args.docker_seconds, args.ssh_error_rate)
+    threading.Thread(target=ssh.serve_forever, daemon=True).start()
+    print('ready', flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""End-to-end provisioning benchmark against a fake Marzban panel and fake nodes.
+
+Starts benchmarks/fake_servers.py in a subprocess (HTTP panel plus paramiko SSH
+server, both local), then runs ``provision_node`` for N concurrent nodes in a
+fresh client subprocess per run and reports throughput, per-stage latency
+percentiles, peak thread count and max RSS of the client. Everything runs
+offline on 127.0.0.1.
+
+    python benchmarks/provisioning.py [--nodes 1 10 100] [--backend asyncssh|paramiko]
+        [--panel-latency 0.05] [--step-seconds 0.2] [--docker-seconds 2]
+
+Token and certificate come from the per-panel caches after the first node, as
+in the bot, so their percentiles mostly show cache hits.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FAKE_SERVERS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_servers.py')
+
+STAGES = ('token', 'cert', 'ssh_connect', 'ssh_setup', 'ssh_cert', 'api', 'total')
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p * len(values))) - 1))] if values else 0.0
+
+
+# --- Client side --- #
+async def run_client(args) -> dict:
+    import node_provisioning
+    from marzban_api import close_panel_clients
+    from ssh_backends import get_ssh_backend
+    from ssh_pool import get_ssh_pool
+
+    timings = {stage: [] for stage in STAGES}
+    backend = get_ssh_backend(args.backend)
+
+    def timed(stage, func):
+        async def wrapper(*a, **kw):
+            started = time.monotonic()
+            try:
+                return await func(*a, **kw)
+            finally:
+                timings[stage].append(time.monotonic() - started)
+        return wrapper
+
+    # provision_node looks these up in its module namespace, so wrapping them there times each stage
+    node_provisioning.get_marzban_access_token = timed('token', node_provisioning.get_marzban_access_token)
+    node_provisioning.get_marzban_cert = timed('cert', node_provisioning.get_marzban_cert)
+    node_provisioning.add_marzban_node_api = timed('api', node_provisioning.add_marzban_node_api)
+    connect_node = node_provisioning.connect_node
+    node_provisioning.connect_node = timed('ssh_connect', lambda node_details: connect_node(node_details, backend))
+    run_session_steps = node_provisioning.run_session_steps
+    steps_run = {}
+
+    async def timed_steps(session, node_details, steps, output_tail=None):
+        # The first script of a node is the setup, the second the certificate steps
+        stage = 'ssh_cert' if steps_run.setdefault(id(node_details), 0) else 'ssh_setup'
+        steps_run[id(node_details)] += 1
+        return await timed(stage, run_session_steps)(session, node_details, steps, output_tail)
+
+    node_provisioning.run_session_steps = timed_steps
+
+    panel_info = {
+        'domain': '127.0.0.1', 'port': args.http_port, 'https': False,
+        'username': 'admin', 'password': 'admin', 'add_as_new_host': False,
+    }
+    peak_threads = threading.active_count()
+
+    async def sample_threads():
+        nonlocal peak_threads
+        while True:
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.05)
+
+    async def one_node(number):
+        node_details = {'ip': '127.0.0.1', 'port': args.ssh_port, 'user': f'node{number}', 'password': 'x', 'key': ''}
+        started = time.monotonic()
+        result = await node_provisioning.provision_node(panel_info, node_details)
+        timings['total'].append(time.monotonic() - started)
+        return result
+
+    sampler = asyncio.create_task(sample_threads())
+    started = time.monotonic()
+    results = await asyncio.gather(*(one_node(number) for number in range(args.nodes[0])))
+    wall = time.monotonic() - started
+    sampler.cancel()
+    await get_ssh_pool().close()
+    await close_panel_clients()
+
+    failed = {}
+    for result in results:
+        if not result['success']:
+            failed[result['stage']] = failed.get(result['stage'], 0) + 1
+    return {
+        'nodes': len(results),
+        'succeeded': len(results) - sum(failed.values()),
+        'failed_stages': failed,
+        'wall_seconds': wall,
+        'nodes_per_second': len(results) / wall,
+        'stages': {
+            stage: {'count': len(values), **{f'p{int(p * 100)}': percentile(values, p) for p in (0.5, 0.95, 0.99)}}
+            for stage, values in timings.items()
+        },
+        'peak_threads': peak_threads,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def print_report(r: dict) -> None:
+    failed = ', '.join(f"{stage}: {count}" for stage, count in r['failed_stages'].items()) or '-'
+    print(f"\n{r['nodes']} nodes: {r['succeeded']} ok (failed {failed}), {r['wall_seconds']:.2f}s wall, "
+          f"{r['nodes_per_second']:.2f} nodes/s, {r['peak_threads']} peak threads, {r['max_rss_mb']:.1f} MB max RSS")
+    print(f"  {'stage':<12} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage, s in r['stages'].items():
+        print(f"  {stage:<12} {s['count']:>6} {s['p50'] * 1000:>9.1f} {s['p95'] * 1000:>9.1f} {s['p99'] * 1000:>9.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--backend', help='SSH backend (default: same choice as the bot)')
+    parser.add_argument('--panel-latency', type=float, default=0.05)
+    parser.add_argument('--panel-error-rate', type=float, default=0.0)
+    parser.add_argument('--panel-error-status', type=int, default=500)
+    parser.add_argument('--step-seconds', type=float, default=0.2)
+    parser.add_argument('--docker-seconds', type=float, default=2.0)
+    parser.add_argument('--ssh-error-rate', type=float, default=0.0)
+    parser.add_argument('--json', action='store_true', help='print the raw results as JSON lines')
+    parser.add_argument('--client', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--http-port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--ssh-port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        print(json.dumps(asyncio.run(run_client(args))))
+        return
+
+    http_port, ssh_port = free_port(), free_port()
+    server = subprocess.Popen(
+        [sys.executable, FAKE_SERVERS, '--http-port', str(http_port), '--ssh-port', str(ssh_port),
+         '--panel-latency', str(args.panel_latency), '--panel-error-rate', str(args.panel_error_rate),
+         '--panel-error-status', str(args.panel_error_status),
+         '--step-seconds', str(args.step_seconds), '--docker-seconds', str(args.docker_seconds),
+         '--ssh-error-rate', str(args.ssh_error_rate)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        server.stdout.readline() # 'ready'
+        for nodes in args.nodes:
+            command = [sys.executable, __file__, '--client', '--http-port', str(http_port), '--ssh-port', str(ssh_port), '--nodes', str(nodes)]
+            if args.backend:
+                command += ['--backend', args.backend]
+            output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            if args.json:
+                print(json.dumps(result), flush=True)
+            else:
+                print_report(result)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
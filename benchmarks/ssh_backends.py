@@ -0,0 +1,154 @@
+"""Compares the SSH backends provisioning many fake nodes at once.
+
+A fake SSH server (asyncssh, in a subprocess) accepts any password, serves SFTP
+from a temporary directory and answers the uploaded step script by replaying
+its step markers with some output spread over --step-seconds per step. Each
+backend then runs ``run_ssh_steps`` against N concurrent fake nodes in its own
+client subprocess, so its threads and memory are measured in isolation.
+
+    python benchmarks/ssh_backends.py [--nodes 10 100 300] [--steps 4] [--step-seconds 0.5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STEP_BEGIN = re.compile(r'echo "__MARZBAN_NODE_STEP__ begin (\d+)"')
+
+
+# --- Fake node server --- #
+async def serve(port: int, root: str, step_seconds: float) -> None:
+    import asyncssh
+
+    class AnyPasswordServer(asyncssh.SSHServer):
+        def password_auth_supported(self):
+            return True
+
+        def validate_password(self, username, password):
+            return True
+
+    async def handle(process):
+        command = process.command or ''
+        if command.startswith('bash /'):
+            with open(os.path.join(root, command[len('bash /'):])) as f:
+                indexes = STEP_BEGIN.findall(f.read())
+            for index in indexes:
+                process.stdout.write(f"__MARZBAN_NODE_STEP__ begin {index}\r\n")
+                for line in range(5):
+                    await asyncio.sleep(step_seconds / 5)
+                    process.stdout.write(f"step {index} output line {line}\r\n")
+                process.stdout.write(f"__MARZBAN_NODE_STEP__ end {index} 0\r\n")
+        process.exit(0)
+
+    await asyncssh.create_server(
+        AnyPasswordServer, '127.0.0.1', port, server_host_keys=[asyncssh.generate_private_key('ssh-ed25519')],
+        process_factory=handle, sftp_factory=lambda chan: asyncssh.SFTPServer(chan, chroot=root),
+        backlog=1024,
+    )
+    print('ready', flush=True)
+    await asyncio.Event().wait()
+
+
+# --- Client side --- #
+async def run_client(backend_name: str, port: int, nodes: int, steps: int) -> dict:
+    from node_provisioning import run_ssh_steps
+    from ssh_backends import get_ssh_backend
+
+    backend = get_ssh_backend(backend_name)
+    node_steps = [{'name': f'step_{index}', 'command': 'true'} for index in range(steps)]
+    peak_threads = threading.active_count()
+    latencies = []
+
+    async def sample_threads():
+        nonlocal peak_threads
+        while True:
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.05)
+
+    async def one_node(number):
+        node = {'ip': '127.0.0.1', 'port': port, 'user': f'node{number}', 'password': 'x', 'key': ''}
+        started = time.monotonic()
+        success, output = await run_ssh_steps(node, node_steps, backend=backend)
+        latencies.append(time.monotonic() - started)
+        return success
+
+    sampler = asyncio.create_task(sample_threads())
+    started = time.monotonic()
+    results = await asyncio.gather(*(one_node(number) for number in range(nodes)))
+    wall = time.monotonic() - started
+    sampler.cancel()
+    latencies.sort()
+    return {
+        'backend': backend_name,
+        'nodes': nodes,
+        'succeeded': sum(results),
+        'wall_seconds': round(wall, 2),
+        'p50_seconds': round(statistics.median(latencies), 2),
+        'p95_seconds': round(latencies[int(len(latencies) * 0.95) - 1 if len(latencies) > 1 else 0], 2),
+        'peak_threads': peak_threads,
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10, 100, 300])
+    parser.add_argument('--backends', nargs='+', default=['asyncssh', 'paramiko'])
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--step-seconds', type=float, default=0.5)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--root', help=argparse.SUPPRESS)
+    parser.add_argument('--client', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        asyncio.run(serve(args.serve, args.root, args.step_seconds))
+        return
+    if args.client:
+        print(json.dumps(asyncio.run(run_client(args.client, args.port, args.nodes[0], args.steps))))
+        return
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, 'tmp'))
+        server = subprocess.Popen(
+            [sys.executable, __file__, '--serve', str(port), '--root', root, '--step-seconds', str(args.step_seconds)],
+            stdout=subprocess.PIPE, text=True,
+        )
+        try:
+            server.stdout.readline() # 'ready'
+            print(f"{'backend':<10} {'nodes':>5} {'ok':>5} {'wall s':>8} {'p50 s':>7} {'p95 s':>7} {'threads':>8} {'rss MB':>7}")
+            for nodes in args.nodes:
+                for backend in args.backends:
+                    output = subprocess.run(
+                        [sys.executable, __file__, '--client', backend, '--port', str(port), '--nodes', str(nodes), '--steps', str(args.steps)],
+                        capture_output=True, text=True, check=True,
+                    ).stdout
+                    r = json.loads(output.strip().splitlines()[-1])
+                    print(f"{r['backend']:<10} {r['nodes']:>5} {r['succeeded']:>5} {r['wall_seconds']:>8} {r['p50_seconds']:>7} "
+                          f"{r['p95_seconds']:>7} {r['peak_threads']:>8} {r['max_rss_mb']:>7}", flush=True)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
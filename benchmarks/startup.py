@@ -0,0 +1,180 @@
+"""Startup benchmark of the bot against a fake Telegram Bot API and fake Marzban panels.
+
+Runs telegram_bot.py in a fresh subprocess per run, pointed (BOT_API_BASE_URL)
+at a local FakeBotAPI that hands out one /start update, with a temporary
+registry holding --panels FakeMarzbanPanel panels of --nodes nodes each. Reports
+the time from spawning the process to the first getUpdates poll and to the
+reply to /start, plus the peak RSS of the bot. The import cost of telegram_bot
+and the heavy optional libraries it pulls in are measured in a separate process.
+Everything runs offline on 127.0.0.1.
+
+    python benchmarks/startup.py [--runs 3] [--panels 20] [--nodes 5]
+        [--panel-latency 0.2] [--warmup-delay 2]
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import FakeBotAPI, FakeMarzbanPanel # noqa: E402
+
+BOT_SCRIPT = os.path.join(REPO_DIR, 'telegram_bot.py')
+# Fernet key (NODE_CREDENTIALS_KEY) of the seeded registry
+CREDENTIALS_KEY = 'YmVuY2htYXJrLWNyZWRlbnRpYWxzLWtleS0wMDAwMDA='
+
+# Libraries only some features need, which shouldn't be paid for at startup
+HEAVY_MODULES = ('paramiko', 'asyncssh', 'yaml', 'requests')
+
+IMPORT_PROBE = f"""
+import json, sys, time
+started = time.perf_counter()
+import telegram_bot
+seconds = time.perf_counter() - started
+rss = next(line.split()[1] for line in open('/proc/self/status') if line.startswith('VmRSS:'))
+print(json.dumps({{'seconds': seconds, 'rss_mb': int(rss) / 1024,
+                  'loaded': [name for name in {HEAVY_MODULES!r} if name in sys.modules]}}))
+"""
+
+
+def peak_rss_mb(pid: int) -> float:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:')) / 1024
+    except (OSError, StopIteration):
+        return 0.0
+
+
+def measure_import() -> dict:
+    output = subprocess.run([sys.executable, '-c', IMPORT_PROBE], cwd=REPO_DIR, capture_output=True, text=True,
+                            check=True, env={**os.environ, 'TELEGRAM_BOT_TOKEN': '123456:BENCH'}).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def seed_registry(directory: str, panel_ports: list, nodes: int) -> None:
+    import panel_registry
+    from panel_registry import PanelRegistry, node_record, node_ssh_details
+
+    # Encrypted like the bot stores SSH credentials, with the key the bot is started with
+    panel_registry.NODE_CREDENTIALS_KEY = CREDENTIALS_KEY
+
+    registry = PanelRegistry(os.path.join(directory, 'marzban_bot.db'), os.path.join(directory, 'panels.json'))
+    for number, port in enumerate(panel_ports):
+        name = f'panel{number}'
+        registry.save_panel(name, {
+            'domain': '127.0.0.1', 'port': port, 'https': False,
+            'username': 'admin', 'password': 'admin', 'add_as_new_host': False,
+        }, owner_id=42)
+        for node in range(nodes):
+            # Stored like record_node does after /add_node, so the bot can use them
+            address = f'10.{number // 256}.{number % 256}.{node + 1}'
+            registry.save_node(name, address, node_record({'ip': address, 'port': '22', 'user': 'root', 'password': 'x'}))
+    for name in registry.panel_names():
+        for address, node in registry.nodes(name).items():
+            assert node_ssh_details(address, node), f"node {address} can't be read by the bot"
+    registry.close()
+
+
+def run_once(args, panel_ports: list) -> dict:
+    bot_api = FakeBotAPI(0)
+    threading.Thread(target=bot_api.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as directory:
+        seed_registry(directory, panel_ports, args.nodes)
+        env = {
+            **os.environ,
+            'TELEGRAM_BOT_TOKEN': '123456:BENCH',
+            'BOT_API_BASE_URL': f'http://127.0.0.1:{bot_api.server_address[1]}',
+            'METRICS_PORT': '0',
+            'NODE_CREDENTIALS_KEY': CREDENTIALS_KEY,
+        }
+        if args.warmup_delay is not None:
+            env['STARTUP_WARMUP_DELAY'] = str(args.warmup_delay)
+        started = time.monotonic()
+        bot = subprocess.Popen([sys.executable, BOT_SCRIPT], cwd=directory, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = started + args.timeout
+            while 'sendMessage' not in bot_api.events and time.monotonic() < deadline and bot.poll() is None:
+                time.sleep(0.01)
+            rss_at_reply = peak_rss_mb(bot.pid)
+            # Let the deferred warm-up (panel logins, monitors) run before reading the peak RSS
+            time.sleep(args.settle)
+            rss = peak_rss_mb(bot.pid)
+        finally:
+            bot.send_signal(signal.SIGINT)
+            try:
+                bot.wait(10)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+                bot.wait()
+            bot_api.shutdown()
+            bot_api.server_close()
+    events = bot_api.events
+    return {
+        'first_poll_seconds': events['getUpdates'] - started if 'getUpdates' in events else None,
+        'first_reply_seconds': events['sendMessage'] - started if 'sendMessage' in events else None,
+        'rss_at_reply_mb': rss_at_reply,
+        'peak_rss_mb': rss,
+    }
+
+
+def median(values: list):
+    values = sorted(value for value in values if value is not None)
+    return values[len(values) // 2] if values else None
+
+
+def seconds(value) -> str:
+    return f"{value * 1000:.0f} ms" if value is not None else "never"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--panels', type=int, default=20)
+    parser.add_argument('--nodes', type=int, default=5, help='recorded nodes per panel')
+    parser.add_argument('--panel-latency', type=float, default=0.2)
+    parser.add_argument('--warmup-delay', type=float, help='STARTUP_WARMUP_DELAY of the bot (default: its own)')
+    parser.add_argument('--settle', type=float, default=5.0, help='seconds to keep the bot running after its reply')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--json', action='store_true', help='print the raw results as JSON')
+    args = parser.parse_args()
+
+    panels = [FakeMarzbanPanel(0, latency=args.panel_latency) for _ in range(args.panels)]
+    for panel in panels:
+        threading.Thread(target=panel.serve_forever, daemon=True).start()
+    try:
+        imported = measure_import()
+        runs = [run_once(args, [panel.server_address[1] for panel in panels]) for _ in range(args.runs)]
+    finally:
+        for panel in panels:
+            panel.shutdown()
+            panel.server_close()
+
+    result = {
+        'import': imported,
+        'runs': runs,
+        'median': {key: median([run[key] for run in runs]) for key in runs[0]},
+    }
+    if args.json:
+        print(json.dumps(result))
+        return
+    m = result['median']
+    print(f"import telegram_bot: {seconds(imported['seconds'])}, {imported['rss_mb']:.1f} MB RSS, "
+          f"optional libraries loaded: {', '.join(imported['loaded']) or 'none'}")
+    print(f"{args.runs} run(s), {args.panels} panel(s) x {args.nodes} node(s), panel latency {args.panel_latency * 1000:.0f} ms (median):")
+    print(f"  first getUpdates  {seconds(m['first_poll_seconds'])}")
+    print(f"  reply to /start   {seconds(m['first_reply_seconds'])}")
+    print(f"  RSS at reply      {m['rss_at_reply_mb']:.1f} MB")
+    print(f"  peak RSS          {m['peak_rss_mb']:.1f} MB (after {args.settle:.0f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Bulk node onboarding from an inventory file, shared by the bot's /bulk_add and the CLI.
+
+An inventory is either a CSV file (``ip,port,user,password,key`` with an optional
+header row) or a YAML list of mappings with the same keys. The bot hands every
+node to its provisioning queue; the CLI provisions them through
+``run_bulk_onboarding`` with a bounded number running at once.
+"""
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import time
+
+from node_provisioning import provision_node
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of nodes provisioned at the same time
+BULK_CONCURRENCY = int(os.environ.get("BULK_CONCURRENCY", "5"))
+
+INVENTORY_FIELDS = ('ip', 'port', 'user', 'password', 'key')
+
+STATUS_ICONS = {
+    'queued': '⏳',
+    'token': '🔑',
+    'cert': '📜',
+    'ssh': '🔧',
+    'api': '🌐',
+    'done': '✅',
+    'failed': '❌',
+}
+
+
+class InventoryError(ValueError):
+    """Raised when an uploaded inventory file cannot be used."""
+
+
+def _normalize_entry(entry: dict, line: int) -> dict:
+    ip = str(entry.get('ip') or '').strip()
+    if not ip:
+        raise InventoryError(f"line {line}: missing ip")
+    node = {
+        'ip': ip,
+        'port': str(entry.get('port') or '22').strip(),
+        'user': str(entry.get('user') or 'root').strip(),
+        'password': str(entry.get('password') or ''),
+        'key': str(entry.get('key') or ''),
+    }
+    if not node['password'] and not node['key']:
+        raise InventoryError(f"line {line}: {ip} needs a password or a key")
+    if not node['port'].isdigit():
+        raise InventoryError(f"line {line}: invalid port {node['port']!r}")
+    return node
+
+
+def _parse_csv(text: str) -> list:
+    rows = [
+        (number, row) for number, row in enumerate(csv.reader(io.StringIO(text)), start=1)
+        if row and row[0].strip() and not row[0].lstrip().startswith('#')
+    ]
+    header = INVENTORY_FIELDS
+    if rows and rows[0][1][0].strip().lower() == 'ip':
+        header = tuple(column.strip().lower() for column in rows[0][1])
+        rows = rows[1:]
+    return [(number, dict(zip(header, (value.strip() for value in row)))) for number, row in rows]
+
+
+def _parse_yaml(text: str) -> list:
+    try:
+        import yaml
+    except ImportError:
+        raise InventoryError("YAML inventories need PyYAML (pip install pyyaml)")
+    try:
+        data = yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        raise InventoryError(f"invalid YAML: {e}")
+    if isinstance(data, dict):
+        data = data.get('nodes')
+    if not isinstance(data, list) or not all(isinstance(entry, dict) for entry in data):
+        raise InventoryError("YAML inventory must be a list of nodes")
+    return list(enumerate(data, start=1))
+
+
+def parse_inventory(filename: str, data: bytes) -> list:
+    """Parses an uploaded inventory into a list of node_details dicts."""
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise InventoryError("inventory must be UTF-8 text")
+
+    if filename.lower().endswith(('.yaml', '.yml')):
+        entries = _parse_yaml(text)
+    else:
+        entries = _parse_csv(text)
+
+    nodes = []
+    seen = set()
+    for line, entry in entries:
+        node = _normalize_entry(entry, line)
+        if node['ip'] in seen:
+            raise InventoryError(f"line {line}: duplicate ip {node['ip']}")
+        seen.add(node['ip'])
+        nodes.append(node)
+    if not nodes:
+        raise InventoryError("inventory is empty")
+    return nodes
+
+
+def format_summary(panel_name: str, statuses: dict) -> str:
+    """Renders the per-node status lines of a running bulk onboarding."""
+    finished = sum(1 for status in statuses.values() if status in ('done', 'failed'))
+    lines = [f"افزودن گروهی نود به پنل {panel_name}: {finished}/{len(statuses)}"]
+    for ip, status in statuses.items():
+        lines.append(f"{STATUS_ICONS.get(status, '•')} {ip}: {status}")
+    text = "\n".join(lines)
+    # Stay within Telegram's message size limit on very large inventories
+    return text if len(text) <= 4000 else text[:3990] + "\n..."
+
+
+def build_report(results: list) -> bytes:
+    """Builds the final CSV report of a bulk onboarding."""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['ip', 'success', 'stage', 'duration_seconds', 'output_tail'])
+    for result in results:
+        writer.writerow([
+            result['ip'],
+            'yes' if result['success'] else 'no',
+            result['stage'],
+            f"{result.get('duration', 0):.1f}",
+            result['output'][-300:],
+        ])
+    return output.getvalue().encode('utf-8')
+
+
+def build_json_report(panel_name: str, results: list, duration: float) -> bytes:
+    """Builds the machine-readable JSON report of a bulk onboarding."""
+    succeeded = sum(1 for result in results if result['success'])
+    report = {
+        'panel': panel_name,
+        'finished_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'duration_seconds': round(duration, 1),
+        'total': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'nodes': [
+            {
+                'ip': result['ip'],
+                'success': result['success'],
+                'stage': result['stage'],
+                'duration_seconds': round(result.get('duration', 0), 1),
+                'cert_fingerprint': result['cert_fingerprint'],
+                'output_tail': result['output'][-300:],
+            }
+            for result in results
+        ],
+    }
+    return json.dumps(report, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+async def run_bulk_onboarding(panel_info: dict, nodes: list, statuses: dict = None, concurrency: int = BULK_CONCURRENCY,
+                              on_result=None) -> list:
+    """Provisions all nodes concurrently, at most ``concurrency`` at a time.
+
+    ``statuses`` is filled in place with ``{ip: stage}`` as nodes progress, so a live
+    summary can render it; ``on_result`` is called with each node's result as it
+    finishes. Returns the provision_node results in inventory order.
+    """
+    if statuses is None:
+        statuses = {}
+    statuses.update((node['ip'], 'queued') for node in nodes)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(node):
+        async with semaphore:
+            async def progress(stage):
+                statuses[node['ip']] = stage
+
+            started = time.monotonic()
+            try:
+                result = await provision_node(panel_info, node, progress)
+            except Exception as e:
+                logger.error(f"Bulk onboarding of {node['ip']} failed: {e}")
+                result = {'ip': node['ip'], 'success': False, 'stage': statuses[node['ip']], 'output': f"Error: {e}", 'cert_fingerprint': None}
+            result['duration'] = time.monotonic() - started
+            statuses[node['ip']] = 'done' if result['success'] else 'failed'
+            if on_result:
+                on_result(result)
+            return result
+
+    return await asyncio.gather(*(run_one(node) for node in nodes))
@@ -0,0 +1,193 @@
+"""Background health monitor for the nodes of every panel.
+
+Each round probes every known node (recorded in the registry or reported by its
+panel) with TCP connects to the node service and API ports, and combines that
+with the node status the panel reports. Panels are probed concurrently, with at
+most HEALTH_MAX_PER_PANEL probes in flight per panel and every probe started
+at a random offset inside the round. Connect times are kept in a fixed-size ring
+buffer per node; state changes are passed to an ``on_transition`` callback.
+"""
+import array
+import asyncio
+import logging
+import math
+import os
+import random
+import time
+
+from marzban_api import NODE_API_PORT, NODE_SERVICE_PORT, get_marzban_nodes
+from panel_registry import get_registry
+
+logger = logging.getLogger(__name__)
+
+HEALTH_PROBE_INTERVAL = float(os.environ.get("HEALTH_PROBE_INTERVAL", "60"))
+HEALTH_PROBE_TIMEOUT = float(os.environ.get("HEALTH_PROBE_TIMEOUT", "3"))
+HEALTH_MAX_PER_PANEL = int(os.environ.get("HEALTH_MAX_PER_PANEL", "20"))
+# Samples kept per node (a day at the default interval)
+HEALTH_HISTORY_SIZE = int(os.environ.get("HEALTH_HISTORY_SIZE", "1440"))
+# Fraction of the interval over which probes of a round are spread
+HEALTH_PROBE_SPREAD = 0.5
+
+STATE_UP, STATE_DOWN = 'up', 'down'
+
+
+class RttSeries:
+    """Ring buffer of (timestamp, RTT in ms) samples; failed probes are stored as NaN."""
+
+    def __init__(self, capacity: int = HEALTH_HISTORY_SIZE):
+        self.capacity = capacity
+        self.times = array.array('d', bytes(8 * capacity))
+        self.rtts = array.array('f', bytes(4 * capacity))
+        self.count = 0
+        self._next = 0
+
+    def append(self, rtt_ms, timestamp: float = None) -> None:
+        self.times[self._next] = time.time() if timestamp is None else timestamp
+        self.rtts[self._next] = math.nan if rtt_ms is None else rtt_ms
+        self._next = (self._next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _indexes(self):
+        start = (self._next - self.count) % self.capacity
+        return ((start + offset) % self.capacity for offset in range(self.count))
+
+    def samples(self, since: float = 0) -> list:
+        """Returns ``[(timestamp, rtt_ms or None)]`` oldest first."""
+        return [
+            (self.times[i], None if math.isnan(self.rtts[i]) else self.rtts[i])
+            for i in self._indexes() if self.times[i] >= since
+        ]
+
+    def stats(self, since: float = 0) -> dict:
+        """Returns p50/p95 RTT (None without successful samples) and the loss ratio."""
+        samples = self.samples(since)
+        rtts = sorted(rtt for _, rtt in samples if rtt is not None)
+
+        def percentile(p):
+            return rtts[min(len(rtts) - 1, int(math.ceil(p * len(rtts))) - 1)] if rtts else None
+
+        return {
+            'samples': len(samples),
+            'p50': percentile(0.50),
+            'p95': percentile(0.95),
+            'loss': (len(samples) - len(rtts)) / len(samples) if samples else 0.0,
+        }
+
+
+async def tcp_connect_rtt(host: str, port: int, timeout: float = HEALTH_PROBE_TIMEOUT):
+    """Returns the TCP connect time to host:port in ms, or None when unreachable."""
+    started = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    rtt = (time.perf_counter() - started) * 1000
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return rtt
+
+
+class HealthMonitor:
+    """Periodically probes all nodes of all panels and tracks their state and latency.
+
+    ``on_transition`` is an optional coroutine function called as
+    ``on_transition(panel_name, address, old_state, new_state, reason)``; a node
+    seen for the first time only triggers it when it is down.
+    """
+
+    def __init__(self, on_transition=None, interval: float = HEALTH_PROBE_INTERVAL, max_per_panel: int = HEALTH_MAX_PER_PANEL):
+        self.on_transition = on_transition
+        self.interval = interval
+        self.max_per_panel = max_per_panel
+        # (panel_name, address) -> {'state', 'reason', 'since', 'checked_at', 'series'}
+        self.nodes = {}
+        self._task = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            started = time.monotonic()
+            try:
+                await self.check_all()
+            except Exception:
+                logger.exception("Health check round failed")
+            # Jitter the rounds so probes don't line up with other periodic traffic
+            delay = self.interval * random.uniform(0.9, 1.1) - (time.monotonic() - started)
+            await asyncio.sleep(max(delay, 1))
+
+    async def check_all(self) -> None:
+        """Runs one probe round over every panel concurrently."""
+        registry = get_registry()
+        panels = registry.panels()
+        await asyncio.gather(*(self._check_panel(name, panel_info, registry.nodes(name)) for name, panel_info in panels.items()))
+        for key in [key for key in self.nodes if key[0] not in panels]:
+            del self.nodes[key] # Panel was deleted
+
+    async def _check_panel(self, panel_name: str, panel_info: dict, recorded_nodes: dict) -> None:
+        panel_nodes = await get_marzban_nodes(panel_info)
+        panel_status = {}
+        if panel_nodes is not None:
+            panel_status = {node.get('address'): node for node in panel_nodes if node.get('address')}
+        addresses = set(recorded_nodes) | set(panel_status)
+        slots = asyncio.Semaphore(self.max_per_panel)
+        spread = self.interval * HEALTH_PROBE_SPREAD
+
+        async def probe(address):
+            await asyncio.sleep(random.uniform(0, spread))
+            async with slots:
+                await self._probe_node(panel_name, address, panel_status.get(address), panel_nodes is not None)
+
+        await asyncio.gather(*(probe(address) for address in addresses))
+
+    async def _probe_node(self, panel_name: str, address: str, panel_node, panel_reachable: bool) -> None:
+        service_rtt, api_rtt = await asyncio.gather(
+            tcp_connect_rtt(address, NODE_SERVICE_PORT), tcp_connect_rtt(address, NODE_API_PORT)
+        )
+        if service_rtt is None:
+            state, reason = STATE_DOWN, f"پورت {NODE_SERVICE_PORT} در دسترس نیست"
+        elif api_rtt is None:
+            state, reason = STATE_DOWN, f"پورت {NODE_API_PORT} در دسترس نیست"
+        elif panel_reachable and panel_node is None:
+            state, reason = STATE_DOWN, "نود در پنل ثبت نشده است"
+        elif panel_node is not None and panel_node.get('status') not in ('connected', None):
+            state, reason = STATE_DOWN, f"وضعیت پنل: {panel_node.get('status')} {panel_node.get('message') or ''}".strip()
+        else:
+            state, reason = STATE_UP, ''
+
+        key = (panel_name, address)
+        entry = self.nodes.get(key)
+        if entry is None:
+            entry = self.nodes[key] = {'state': None, 'reason': '', 'since': time.time(), 'checked_at': 0, 'series': RttSeries()}
+        entry['series'].append(service_rtt)
+        entry['checked_at'] = time.time()
+        old_state = entry['state']
+        entry['reason'] = reason
+        if state == old_state:
+            return
+        entry['state'], entry['since'] = state, time.time()
+        if old_state is not None or state == STATE_DOWN:
+            logger.info(f"Node {address} on panel {panel_name}: {old_state} -> {state} {reason}")
+            if self.on_transition:
+                try:
+                    await self.on_transition(panel_name, address, old_state, state, reason)
+                except Exception as e:
+                    logger.error(f"Health alert for {address} failed: {e}")
+
+    def report(self, panel_name: str = None) -> list:
+        """Returns ``[(panel_name, address, entry, stats)]`` sorted by panel and address."""
+        return [
+            (key[0], key[1], entry, entry['series'].stats())
+            for key, entry in sorted(self.nodes.items())
+            if panel_name is None or key[0] == panel_name
+        ]
@@ -0,0 +1,107 @@
+"""Rate-limited live status messages.
+
+Long-running operations register a Telegram message together with a render
+function. One background task re-renders the tracked messages and edits them,
+never faster than STATUS_EDIT_CHAT_INTERVAL per chat and STATUS_EDIT_GLOBAL_INTERVAL
+across all chats, so any number of parallel provisionings stays within Telegram's
+edit limits. Tracked messages in the same chat are refreshed round-robin.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+from outbound_queue import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# Minimum delay (seconds) between two edits in the same chat
+STATUS_EDIT_CHAT_INTERVAL = float(os.environ.get("STATUS_EDIT_CHAT_INTERVAL", "3"))
+# Minimum delay (seconds) between two edits across all chats
+STATUS_EDIT_GLOBAL_INTERVAL = float(os.environ.get("STATUS_EDIT_GLOBAL_INTERVAL", "0.1"))
+# How often the board checks its tracked messages
+STATUS_BOARD_TICK = 0.5
+
+
+class LiveStatusBoard:
+    """Keeps tracked status messages up to date within per-chat and global edit limits."""
+
+    def __init__(self, chat_interval: float = STATUS_EDIT_CHAT_INTERVAL, global_interval: float = STATUS_EDIT_GLOBAL_INTERVAL):
+        self.chat_interval = chat_interval
+        self.global_interval = global_interval
+        # (chat_id, message_id) -> {'message', 'render', 'text', 'edited_at'}
+        self._entries = {}
+        self._chat_ready_at = {}
+        self._global_ready_at = 0.0
+        self._task = None
+
+    @staticmethod
+    def _key(message) -> tuple:
+        return message.chat_id, message.message_id
+
+    def track(self, message, render) -> None:
+        """Starts refreshing ``message`` with the text returned by ``render()``."""
+        self._entries[self._key(message)] = {'message': message, 'render': render, 'text': message.text, 'edited_at': 0.0}
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def finish(self, message, text: str) -> None:
+        """Stops tracking ``message`` and edits it to its final ``text`` once the chat allows it."""
+        entry = self._entries.pop(self._key(message), None)
+        if entry and entry['text'] == text:
+            return
+        delay = max(self._chat_ready_at.get(message.chat_id, 0.0), self._global_ready_at) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self._edit(message, text)
+
+    def _reserve(self, chat_id: int) -> None:
+        now = time.monotonic()
+        self._chat_ready_at[chat_id] = now + self.chat_interval
+        self._global_ready_at = now + self.global_interval
+
+    async def _edit(self, message, text: str) -> bool:
+        self._reserve(message.chat_id)
+        try:
+            await message.edit_text(text)
+            return True
+        except RetryAfter as e:
+            # Flood control outlasted the outbound queue's retries: back off this chat as well
+            self._chat_ready_at[message.chat_id] = time.monotonic() + retry_after_seconds(e)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logger.warning(f"Could not update status message: {e}")
+        except Exception as e: # Status edits are best-effort
+            logger.warning(f"Could not update status message: {e}")
+        return False
+
+    async def _run(self) -> None:
+        while self._entries:
+            now = time.monotonic()
+            # Least recently edited first, so messages sharing a chat take turns
+            for key, entry in sorted(self._entries.items(), key=lambda item: item[1]['edited_at']):
+                chat_id = key[0]
+                if key not in self._entries:
+                    continue # Finished while an earlier edit was in flight
+                if self._global_ready_at > now or self._chat_ready_at.get(chat_id, 0.0) > now:
+                    continue
+                text = entry['render']()
+                if text == entry['text']:
+                    continue
+                if await self._edit(entry['message'], text):
+                    entry['text'] = text
+                entry['edited_at'] = now = time.monotonic()
+            await asyncio.sleep(STATUS_BOARD_TICK)
+
+
+_board = None
+
+
+def get_status_board() -> LiveStatusBoard:
+    """Returns the process-wide status board."""
+    global _board
+    if _board is None:
+        _board = LiveStatusBoard()
+    return _board
@@ -0,0 +1,388 @@
+"""Async client layer for the Marzban panel API.
+
+Every panel gets its own pooled ``httpx.AsyncClient`` so consecutive calls to the
+same panel reuse keep-alive connections instead of opening a new TCP+TLS
+connection (and a worker thread) per request.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+
+import httpx
+
+from metrics import PANEL_REQUEST_SECONDS, PANEL_RESPONSES, PANEL_RETRIES, endpoint_label
+from panel_resilience import (
+    IDEMPOTENT_METHODS,
+    PANEL_RETRY_ATTEMPTS,
+    backoff_delay,
+    get_breaker,
+    is_failure_status,
+    is_transient_error,
+    should_retry,
+)
+
+logger = logging.getLogger(__name__)
+
+# Connection pool limits and timeouts (seconds) for panel requests
+HTTP_MAX_CONNECTIONS = int(os.environ.get("MARZBAN_HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("MARZBAN_HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("MARZBAN_HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("MARZBAN_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_POOL_TIMEOUT = float(os.environ.get("MARZBAN_HTTP_POOL_TIMEOUT", "10"))
+HTTP_TIMEOUT = float(os.environ.get("MARZBAN_HTTP_TIMEOUT", "15"))
+
+# Cached access tokens are refreshed this many seconds before their JWT expiry
+TOKEN_REFRESH_MARGIN = float(os.environ.get("MARZBAN_TOKEN_REFRESH_MARGIN", "60"))
+# Lifetime assumed for tokens whose expiry cannot be decoded
+TOKEN_DEFAULT_TTL = float(os.environ.get("MARZBAN_TOKEN_DEFAULT_TTL", "600"))
+
+# How long (seconds) a panel's node certificate is served from cache
+CERT_CACHE_TTL = float(os.environ.get("MARZBAN_CERT_CACHE_TTL", "3600"))
+
+# Substrings of a node status message that point to a TLS client-cert problem
+TLS_ERROR_MARKERS = ('ssl', 'tls', 'certificate')
+
+# Default Marzban-node service ports
+NODE_SERVICE_PORT = 62050
+NODE_API_PORT = 62051
+
+# One pooled client per panel base URL
+_panel_clients = {}
+
+# Access tokens per panel key: {panel_key: (access_token, expires_at)}
+_token_cache = {}
+# One login lock per panel key so concurrent callers share a single login
+_token_locks = {}
+
+# Node certificates per panel key: {panel_key: (certificate, fingerprint, fetched_at)}
+_cert_cache = {}
+
+
+def panel_key(panel_info: dict) -> str:
+    """Returns the panel name used as key in marzban_panels.json (domain:port)."""
+    return f"{panel_info['domain']}:{panel_info['port']}"
+
+
+def panel_base_url(panel_info: dict) -> str:
+    use_protocol = 'https' if panel_info['https'] else 'http'
+    return f"{use_protocol}://{panel_info['domain']}:{panel_info['port']}"
+
+
+def get_panel_client(panel_info: dict) -> httpx.AsyncClient:
+    """Returns the shared keep-alive client for a panel, creating it on first use."""
+    base_url = panel_base_url(panel_info)
+    client = _panel_clients.get(base_url)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=base_url,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT, pool=HTTP_POOL_TIMEOUT),
+        )
+        _panel_clients[base_url] = client
+    return client
+
+
+async def close_panel_clients() -> None:
+    """Closes every pooled panel client (called on bot shutdown)."""
+    clients = list(_panel_clients.values())
+    _panel_clients.clear()
+    await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
+
+
+async def _send_panel_request(client: httpx.AsyncClient, panel: str, method: str, path: str, **kwargs) -> httpx.Response:
+    endpoint = endpoint_label(path)
+    status = 'error'
+    try:
+        with PANEL_REQUEST_SECONDS.time(panel=panel, method=method, endpoint=endpoint):
+            response = await client.request(method, path, **kwargs)
+        status = response.status_code
+        return response
+    finally:
+        PANEL_RESPONSES.inc(panel=panel, endpoint=endpoint, status=status)
+
+
+async def panel_request(panel_info: dict, method: str, path: str, access_token: str = None,
+                        idempotent: bool = None, **kwargs) -> httpx.Response:
+    """Sends a request to a panel endpoint over its pooled client, through the panel's circuit breaker.
+
+    Idempotent requests (by default those with an idempotent method) are retried
+    with jittered exponential backoff on transport errors and 502/503/504; other
+    requests only when the connection was never established. Raises
+    ``httpx.HTTPError`` on transport errors and non-2xx responses, and
+    ``CircuitOpenError`` (a subclass) while the panel's breaker is open.
+    """
+    headers = {'accept': 'application/json'}
+    if access_token:
+        headers['Authorization'] = f'Bearer {access_token}'
+    headers.update(kwargs.pop('headers', None) or {})
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    client = get_panel_client(panel_info)
+    panel = panel_key(panel_info)
+    breaker = get_breaker(panel)
+
+    for attempt in range(1, PANEL_RETRY_ATTEMPTS + 1):
+        probe = breaker.before_call()
+        recorded = False
+        try:
+            response = await _send_panel_request(client, panel, method, path, headers=headers, **kwargs)
+        except httpx.TransportError as e:
+            breaker.record_failure(f"{type(e).__name__}: {e}", probe)
+            recorded = True
+            if attempt == PANEL_RETRY_ATTEMPTS or not should_retry(idempotent, error=e):
+                raise
+        else:
+            if is_failure_status(response.status_code):
+                breaker.record_failure(f"HTTP {response.status_code}", probe)
+            else:
+                breaker.record_success(probe)
+            recorded = True
+            if attempt == PANEL_RETRY_ATTEMPTS or not should_retry(idempotent, status_code=response.status_code):
+                response.raise_for_status()
+                return response
+        finally:
+            if probe and not recorded:
+                breaker.release_probe()
+        PANEL_RETRIES.inc(panel=panel, endpoint=endpoint_label(path))
+        delay = backoff_delay(attempt)
+        logger.info(f"Retrying {method} {path} on panel {panel} in {delay:.1f}s (attempt {attempt + 1}/{PANEL_RETRY_ATTEMPTS})")
+        await asyncio.sleep(delay)
+
+
+def _jwt_expiry(access_token: str):
+    """Returns the ``exp`` claim of a JWT as a unix timestamp, or None if unreadable."""
+    try:
+        payload = access_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def _cached_access_token(key: str):
+    cached = _token_cache.get(key)
+    if cached and cached[1] - TOKEN_REFRESH_MARGIN > time.time():
+        return cached[0]
+    return None
+
+
+def invalidate_access_token(panel_info: dict, access_token: str = None) -> None:
+    """Drops the cached token of a panel.
+
+    When ``access_token`` is given, the cache is only cleared if it still holds that
+    token, so a token another caller has just refreshed is kept.
+    """
+    key = panel_key(panel_info)
+    cached = _token_cache.get(key)
+    if cached and (access_token is None or cached[0] == access_token):
+        del _token_cache[key]
+
+
+async def _fetch_access_token(panel_info: dict) -> str:
+    """Returns a valid cached token or logs in; raises ``httpx.HTTPError`` on failure."""
+    key = panel_key(panel_info)
+    access_token = _cached_access_token(key)
+    if access_token:
+        return access_token
+
+    lock = _token_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        # Another caller may have logged in while we were waiting for the lock
+        access_token = _cached_access_token(key)
+        if access_token:
+            return access_token
+
+        data = {
+            'username': panel_info['username'],
+            'password': panel_info['password']
+        }
+        # Logging in has no side effects, so it is retried like a GET
+        response = await panel_request(panel_info, 'POST', '/api/admin/token', idempotent=True, data=data)
+        access_token = response.json()['access_token']
+        expires_at = _jwt_expiry(access_token) or time.time() + TOKEN_DEFAULT_TTL
+        _token_cache[key] = (access_token, expires_at)
+        logger.info(f"Successfully obtained access token for {panel_info['domain']}")
+        return access_token
+
+
+async def authorized_panel_request(panel_info: dict, method: str, path: str, **kwargs) -> httpx.Response:
+    """Sends a request with the panel's cached token, logging in again once on a 401."""
+    access_token = await _fetch_access_token(panel_info)
+    try:
+        return await panel_request(panel_info, method, path, access_token=access_token, **kwargs)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != 401:
+            raise
+    logger.info(f"Access token for {panel_info['domain']} was rejected, logging in again")
+    invalidate_access_token(panel_info, access_token)
+    access_token = await _fetch_access_token(panel_info)
+    return await panel_request(panel_info, method, path, access_token=access_token, **kwargs)
+
+
+async def get_marzban_access_token(panel_info: dict):
+    """Gets access token from Marzban panel, reusing the cached one while it is valid."""
+    try:
+        return await _fetch_access_token(panel_info)
+    except httpx.HTTPError as e:
+        logger.error(f'Error obtaining access token for {panel_info["domain"]}: {e}')
+        return None
+
+
+def cert_fingerprint(cert: str) -> str:
+    """Returns the SHA-256 fingerprint of a PEM certificate as a hex string."""
+    return hashlib.sha256(cert.strip().encode()).hexdigest()
+
+
+def invalidate_cert(panel_info: dict) -> None:
+    """Drops the cached node certificate of a panel."""
+    _cert_cache.pop(panel_key(panel_info), None)
+
+
+def invalidate_panel_caches(panel_info: dict) -> None:
+    """Drops every cached credential of a panel, e.g. after its login details changed."""
+    invalidate_access_token(panel_info)
+    invalidate_cert(panel_info)
+
+
+def cached_cert_fingerprint(panel_info: dict):
+    """Returns the fingerprint of the cached certificate, or None if nothing is cached."""
+    cached = _cert_cache.get(panel_key(panel_info))
+    return cached[1] if cached else None
+
+
+def is_tls_error(message: str) -> bool:
+    """Tells whether a node status message looks like a TLS client-cert failure."""
+    message = (message or '').lower()
+    return any(marker in message for marker in TLS_ERROR_MARKERS)
+
+
+def report_node_tls_failure(panel_info: dict, node_address: str) -> None:
+    """Called when a node fails TLS with its panel; the next cert lookup refetches it."""
+    logger.warning(f"Node {node_address} reported a TLS failure on panel {panel_info['domain']}, invalidating cached certificate")
+    invalidate_cert(panel_info)
+
+
+async def get_marzban_cert(panel_info: dict, force_refresh: bool = False):
+    """Gets certificate from Marzban panel, served from cache for CERT_CACHE_TTL seconds."""
+    key = panel_key(panel_info)
+    cached = _cert_cache.get(key)
+    if cached and not force_refresh and time.time() - cached[2] < CERT_CACHE_TTL:
+        return cached[0]
+    try:
+        response = await authorized_panel_request(panel_info, 'GET', '/api/node/settings')
+        cert = response.json()["certificate"]
+        logger.info(f"Successfully retrieved certificate from {panel_info['domain']}")
+    except httpx.HTTPError as e:
+        logger.error(f'Error retrieving certificate from {panel_info["domain"]}: {e}')
+        return None
+
+    fingerprint = cert_fingerprint(cert)
+    if cached and cached[1] != fingerprint:
+        logger.warning(f"Certificate of panel {panel_info['domain']} changed ({cached[1][:16]} -> {fingerprint[:16]})")
+    _cert_cache[key] = (cert, fingerprint, time.time())
+    return cert
+
+
+async def get_marzban_nodes(panel_info: dict):
+    """Returns the nodes registered on a panel, or None on error."""
+    try:
+        response = await authorized_panel_request(panel_info, 'GET', '/api/nodes')
+        return response.json()
+    except httpx.HTTPError as e:
+        logger.error(f'Error listing nodes of panel {panel_info["domain"]}: {e}')
+        return None
+
+
+async def reconnect_marzban_node(panel_info: dict, node_id: int) -> bool:
+    """Asks the panel to reconnect to a node (e.g. after its container was recreated)."""
+    try:
+        await authorized_panel_request(panel_info, 'POST', f'/api/node/{node_id}/reconnect', idempotent=True)
+        return True
+    except httpx.HTTPError as e:
+        logger.warning(f'Error reconnecting node {node_id} of panel {panel_info["domain"]}: {e}')
+        return False
+
+
+async def delete_marzban_node(panel_info: dict, node_id: int) -> bool:
+    """Removes a node from the panel; a node that is already gone counts as removed."""
+    try:
+        await authorized_panel_request(panel_info, 'DELETE', f'/api/node/{node_id}')
+        logger.info(f"Node {node_id} deleted from panel {panel_info['domain']}")
+        return True
+    except httpx.HTTPStatusError as e:
+        # A retried DELETE whose first attempt went through finds nothing left to delete
+        if e.response.status_code == 404:
+            return True
+        error = e
+    except httpx.HTTPError as e:
+        error = e
+    logger.error(f'Error deleting node {node_id} from panel {panel_info["domain"]}: {error}')
+    return False
+
+
+async def set_marzban_node_status(panel_info: dict, node_id: int, status: str) -> bool:
+    """Sets a node's status on the panel (``disabled`` stops the panel from using it, ``connected`` re-enables it)."""
+    try:
+        await authorized_panel_request(panel_info, 'PUT', f'/api/node/{node_id}', json={'status': status})
+        logger.info(f"Node {node_id} of panel {panel_info['domain']} set to {status}")
+        return True
+    except httpx.HTTPError as e:
+        logger.error(f'Error setting status of node {node_id} of panel {panel_info["domain"]}: {e}')
+        return False
+
+
+async def get_marzban_nodes_usage(panel_info: dict, start: str, end: str):
+    """Returns the panel's per-node traffic (``[{'node_id', 'node_name', 'uplink', 'downlink'}]``)
+    recorded between two ``YYYY-MM-DDTHH:MM:SS`` UTC timestamps, or None on error."""
+    try:
+        response = await authorized_panel_request(panel_info, 'GET', '/api/nodes/usage', params={'start': start, 'end': end})
+        return response.json().get('usages', [])
+    except httpx.HTTPError as e:
+        logger.error(f'Error fetching node usage of panel {panel_info["domain"]}: {e}')
+        return None
+
+
+async def add_marzban_node_api(panel_info: dict, node_ip: str, add_as_host: bool = True):
+    """Adds a node to the Marzban panel via API."""
+    node_information = {
+        "name": f"{node_ip}",
+        "address": f"{node_ip}",
+        "port": NODE_SERVICE_PORT,
+        "api_port": NODE_API_PORT,
+        "add_as_new_host": add_as_host,
+        "usage_coefficient": 1
+    }
+    for attempt in range(1, PANEL_RETRY_ATTEMPTS + 1):
+        try:
+            await authorized_panel_request(panel_info, 'POST', '/api/node', json=node_information)
+            logger.info(f"Node {node_ip} added successfully to panel {panel_info['domain']}")
+            return True
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 409:
+                # Already registered (e.g. re-running a repair of an existing node): nothing left to do
+                logger.info(f"Node {node_ip} is already registered on panel {panel_info['domain']}")
+                return True
+            error = e
+        except httpx.HTTPError as e:
+            error = e
+        if attempt == PANEL_RETRY_ATTEMPTS or not is_transient_error(error):
+            break
+        # The panel may have created the node before failing; only retry if it didn't
+        nodes = await get_marzban_nodes(panel_info)
+        if nodes is None:
+            break
+        if any(node.get('address') == node_ip for node in nodes):
+            logger.info(f"Node {node_ip} was added to panel {panel_info['domain']} despite the error: {error}")
+            return True
+        PANEL_RETRIES.inc(panel=panel_key(panel_info), endpoint='/api/node')
+        await asyncio.sleep(backoff_delay(attempt))
+    logger.error(f'Error adding node {node_ip} to panel {panel_info["domain"]}: {error}')
+    return False
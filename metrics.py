@@ -0,0 +1,238 @@
+"""In-process counters and histograms, exported in the Prometheus text format.
+
+Metrics are recorded from the event loop only. Set METRICS_PORT to serve them
+on ``http://METRICS_HOST:METRICS_PORT/metrics``; the bot's ``/stats`` command
+summarizes the same histograms as percentiles.
+"""
+import asyncio
+import bisect
+import logging
+import math
+import os
+import re
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0")) # 0 disables the endpoint
+
+# Seconds; wide enough for a Docker install over a slow link
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Monotonic counter with labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    """Value that can go up and down, with labels."""
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        self.values[tuple(str(labels[name]) for name in self.labelnames)] = value
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels, as in Prometheus."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the ``with`` block."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def quantile(self, q: float, key: tuple):
+        """Estimates a quantile by linear interpolation inside its bucket (like ``histogram_quantile``)."""
+        counts = self.values[key][0]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1] # Beyond the last bucket
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def summary(self) -> list:
+        """Returns ``[(labels dict, count, mean, p50, p95, p99)]`` ordered by label values."""
+        rows = []
+        for key, (counts, total) in sorted(self.values.items()):
+            count = sum(counts)
+            rows.append((
+                dict(zip(self.labelnames, key)), count, total / count if count else math.nan,
+                self.quantile(0.5, key), self.quantile(0.95, key), self.quantile(0.99, key),
+            ))
+        return rows
+
+    def render(self) -> list:
+        lines = []
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+_metrics = []
+
+
+def counter(name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+    metric = Counter(name, documentation, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def gauge(name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+    metric = Gauge(name, documentation, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    metric = Histogram(name, documentation, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def render_metrics() -> str:
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Metrics recorded by the bot --- #
+PROVISION_STAGE_SECONDS = histogram(
+    'marzban_provision_stage_seconds', 'Duration of each add-node pipeline stage.', ('stage', 'outcome'))
+PROVISION_RESULTS = counter(
+    'marzban_provision_results_total', 'Finished add-node pipelines by result (done or the failing stage).', ('result',))
+SSH_STEP_SECONDS = histogram(
+    'marzban_ssh_step_seconds', 'Duration of each SSH provisioning step on the node.', ('step', 'outcome'))
+PANEL_REQUEST_SECONDS = histogram(
+    'marzban_panel_request_seconds', 'Latency of Marzban panel API requests.', ('panel', 'method', 'endpoint'))
+PANEL_RESPONSES = counter(
+    'marzban_panel_responses_total', 'Marzban panel API responses by status code (error for transport failures).',
+    ('panel', 'endpoint', 'status'))
+PANEL_RETRIES = counter(
+    'marzban_panel_retries_total', 'Marzban panel API requests retried after a failed attempt.', ('panel', 'endpoint'))
+PANEL_BREAKER_STATE = gauge(
+    'marzban_panel_breaker_state', 'Circuit breaker state per panel (0 closed, 1 half-open, 2 open).', ('panel',))
+PANEL_BREAKER_TRANSITIONS = counter(
+    'marzban_panel_breaker_transitions_total', 'Circuit breaker state changes per panel.', ('panel', 'state'))
+PANEL_BREAKER_REJECTED = counter(
+    'marzban_panel_breaker_rejected_total', 'Panel API calls failed fast by an open circuit breaker.', ('panel',))
+UPGRADE_WAVE_SECONDS = histogram(
+    'marzban_upgrade_wave_seconds', 'Duration of rolling upgrade waves, from restart to health gate.')
+UPGRADE_RESULTS = counter(
+    'marzban_upgrade_nodes_total', 'Nodes processed by rolling upgrades by result.', ('result',))
+TELEGRAM_QUEUE_SECONDS = histogram(
+    'marzban_telegram_queue_seconds', 'Time outgoing messages wait in the outbound queue for their chat.', ('endpoint',))
+TELEGRAM_COALESCED_EDITS = counter(
+    'marzban_telegram_coalesced_edits_total', 'Queued message edits replaced by a newer edit before being sent.')
+TELEGRAM_FLOOD_WAITS = counter(
+    'marzban_telegram_flood_waits_total', 'Telegram 429 (RetryAfter) responses waited out and retried.')
+HANDLER_SECONDS = histogram(
+    'marzban_bot_handler_seconds', 'Telegram update handler latency by conversation state.', ('handler', 'state'))
+TELEGRAM_REQUEST_SECONDS = histogram(
+    'marzban_telegram_request_seconds', 'Latency of Telegram Bot API calls (getUpdates excluded).', ('method',))
+TELEGRAM_RESPONSES = counter(
+    'marzban_telegram_responses_total', 'Telegram Bot API responses by HTTP status (error for transport failures).',
+    ('method', 'status'))
+
+
+def endpoint_label(path: str) -> str:
+    """Collapses numeric path segments so per-object URLs share one label."""
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path.split('?')[0])
+
+
+# --- HTTP endpoint --- #
+async def _handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        while (await asyncio.wait_for(reader.readline(), 10)).strip():
+            pass # Headers are ignored
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', render_metrics().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Serves ``GET /metrics``; returns the asyncio server, or None when no port is configured."""
+    if not port:
+        return None
+    server = await asyncio.start_server(_handle_metrics_request, host, port)
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,99 @@
+"""Cross-panel node listing served from a short-TTL cache.
+
+Node lists of all panels are fetched concurrently, each with its own timeout so
+one unreachable panel doesn't hold up the others. Entries older than
+NODES_CACHE_TTL are still served while a background refresh replaces them;
+only panels never fetched before are waited for.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from marzban_api import get_marzban_nodes
+from panel_registry import get_registry
+
+logger = logging.getLogger(__name__)
+
+NODES_CACHE_TTL = float(os.environ.get("NODES_CACHE_TTL", "30"))
+NODES_PANEL_TIMEOUT = float(os.environ.get("NODES_PANEL_TIMEOUT", "8"))
+
+
+class NodeDirectory:
+    """TTL cache of ``{panel_name: {'nodes', 'fetched_at', 'error'}}`` with background refresh."""
+
+    def __init__(self, ttl: float = NODES_CACHE_TTL, panel_timeout: float = NODES_PANEL_TIMEOUT):
+        self.ttl = ttl
+        self.panel_timeout = panel_timeout
+        self._entries = {}
+        self._inflight = {}
+
+    async def _fetch_panel(self, panel_name: str, panel_info: dict) -> dict:
+        try:
+            nodes = await asyncio.wait_for(get_marzban_nodes(panel_info), self.panel_timeout)
+            error = None if nodes is not None else "خطا در دریافت لیست نودها"
+        except asyncio.TimeoutError:
+            nodes, error = None, "پاسخی از پنل دریافت نشد"
+        previous = self._entries.get(panel_name)
+        if nodes is None and previous and previous['nodes'] is not None:
+            # Keep showing the last known list, flagged with the error
+            entry = dict(previous, error=error)
+        else:
+            entry = {'nodes': nodes or [], 'fetched_at': time.time(), 'error': error}
+        self._entries[panel_name] = entry
+        return entry
+
+    def _refresh(self, panel_name: str, panel_info: dict) -> asyncio.Task:
+        """Starts (or joins) the fetch of one panel."""
+        task = self._inflight.get(panel_name)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._fetch_panel(panel_name, panel_info))
+            self._inflight[panel_name] = task
+            task.add_done_callback(lambda _: self._inflight.pop(panel_name, None))
+        return task
+
+    async def get(self, force: bool = False, panel_names: list = None) -> dict:
+        """Returns the node lists of all panels (or of ``panel_names``), waiting only for panels
+        without a cached list."""
+        panels = get_registry().panels()
+        for panel_name in [name for name in self._entries if name not in panels]:
+            del self._entries[panel_name]
+        if panel_names is not None:
+            panels = {name: panels[name] for name in panel_names if name in panels}
+        waiting = []
+        now = time.time()
+        for panel_name, panel_info in panels.items():
+            entry = self._entries.get(panel_name)
+            if entry is None or force:
+                waiting.append(self._refresh(panel_name, panel_info))
+            elif now - entry['fetched_at'] > self.ttl or entry['error']:
+                self._refresh(panel_name, panel_info)
+        if waiting:
+            await asyncio.gather(*waiting)
+        return {name: self._entries[name] for name in panels if name in self._entries}
+
+    def invalidate(self, panel_name: str = None) -> None:
+        if panel_name is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(panel_name, None)
+
+
+def node_rows(directory: dict) -> list:
+    """Flattens ``get()`` results into ``(panel_name, node)`` rows sorted by panel and name."""
+    rows = []
+    for panel_name in sorted(directory):
+        for node in sorted(directory[panel_name]['nodes'], key=lambda node: (node.get('name') or '', node.get('address') or '')):
+            rows.append((panel_name, node))
+    return rows
+
+
+_directory = None
+
+
+def get_node_directory() -> NodeDirectory:
+    """Returns the process-wide node directory."""
+    global _directory
+    if _directory is None:
+        _directory = NodeDirectory()
+    return _directory
@@ -0,0 +1,93 @@
+"""Day-to-day operations on provisioned nodes over pooled SSH sessions."""
+import asyncio
+import logging
+import os
+import shlex
+
+from marzban_api import delete_marzban_node, set_marzban_node_status
+from node_provisioning import NODE_COMPOSE_DIR, RESTART_CONTAINER_COMMAND
+from ssh_pool import get_ssh_pool
+
+logger = logging.getLogger(__name__)
+
+NODE_EXEC_TIMEOUT = float(os.environ.get("NODE_EXEC_TIMEOUT", "60"))
+# Nodes deleted or disabled at the same time by a bulk action
+NODE_ACTION_CONCURRENCY = int(os.environ.get("NODE_ACTION_CONCURRENCY", "10"))
+NODE_LOGS_DEFAULT_LINES = 50
+NODE_LOGS_MAX_LINES = 500
+
+CONTAINER_ID = '$(sudo docker ps -q --filter name=marzban-node | head -n 1)'
+
+# Nodes set up before the compose directory existed only have the container to remove
+TEARDOWN_COMMAND = (
+    f'if [ -f {NODE_COMPOSE_DIR}/docker-compose.yml ]; then cd {NODE_COMPOSE_DIR} && sudo docker compose down; '
+    'else sudo docker ps -aq --filter name=marzban-node | xargs -r sudo docker rm -f; fi'
+)
+
+ACTION_DELETE, ACTION_DISABLE = 'delete', 'disable'
+
+
+async def run_on_node(node_details: dict, command: str, timeout: float = NODE_EXEC_TIMEOUT):
+    """Runs a shell command on a node over a pooled session; returns ``(exit_status, output)``.
+
+    Raises on connection failures and ``asyncio.TimeoutError`` after ``timeout`` seconds.
+    """
+    async with get_ssh_pool().session(node_details) as session:
+        return await asyncio.wait_for(session.run(command, pty=True), timeout) # pty for sudo
+
+
+async def restart_node(node_details: dict):
+    """Restarts the marzban-node container of a node."""
+    return await run_on_node(node_details, RESTART_CONTAINER_COMMAND)
+
+
+async def node_logs(node_details: dict, lines: int = NODE_LOGS_DEFAULT_LINES):
+    """Returns the last ``lines`` log lines of the node's marzban-node container."""
+    lines = max(1, min(lines, NODE_LOGS_MAX_LINES))
+    return await run_on_node(node_details, f'sudo docker logs --tail {shlex.quote(str(lines))} {CONTAINER_ID} 2>&1')
+
+
+async def teardown_node(node_details: dict):
+    """Stops and removes the marzban-node container of a node."""
+    return await run_on_node(node_details, TEARDOWN_COMMAND)
+
+
+async def run_node_actions(panel_info: dict, nodes: list, action: str, teardown: bool = False,
+                           results: dict = None, concurrency: int = NODE_ACTION_CONCURRENCY) -> dict:
+    """Deletes or disables panel nodes, at most ``concurrency`` at a time.
+
+    ``nodes`` are ``{'id', 'name', 'address', 'node_details'}`` dicts, ``node_details``
+    being None for nodes whose container must not be touched (no recorded SSH access,
+    or still serving another panel). With ``teardown`` the container
+    of each node the panel let go of is removed as well. ``results`` is filled in
+    place with ``{node id: {'name', 'address', 'api', 'ssh'}}`` (None while pending,
+    then True/False; ``ssh`` is 'skipped' when there is nothing to tear down), so a
+    live summary can render it.
+    """
+    if results is None:
+        results = {}
+    results.update((node['id'], {'name': node['name'], 'address': node['address'], 'api': None, 'ssh': None}) for node in nodes)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(node):
+        result = results[node['id']]
+        async with semaphore:
+            if action == ACTION_DELETE:
+                result['api'] = await delete_marzban_node(panel_info, node['id'])
+            else:
+                result['api'] = await set_marzban_node_status(panel_info, node['id'], 'disabled')
+            # Leave the container alone while the panel still uses the node
+            if not teardown or not result['api'] or node['node_details'] is None:
+                result['ssh'] = 'skipped'
+                return
+            try:
+                exit_status, output = await teardown_node(node['node_details'])
+                result['ssh'] = exit_status == 0
+                if exit_status != 0:
+                    logger.error(f"Teardown of node {node['address']} failed:\n{output}")
+            except Exception as e:
+                logger.error(f"Teardown of node {node['address']} failed: {e}")
+                result['ssh'] = False
+
+    await asyncio.gather(*(run_one(node) for node in nodes))
+    return results
@@ -0,0 +1,635 @@
+"""SSH provisioning of Marzban nodes (adapted from curlscript.py).
+
+Shared by the single-node conversation and bulk onboarding in telegram_bot.py.
+"""
+import asyncio
+import collections
+import hashlib
+import logging
+import os
+import posixpath
+import shlex
+import time
+import uuid
+
+from artifact_relay import ARTIFACT_RELAY_ENABLED, REMOTE_ARTIFACT_DIR, cached_artifacts, image_tarball_id
+from marzban_api import get_marzban_access_token, get_marzban_cert, add_marzban_node_api, cert_fingerprint
+from metrics import PROVISION_RESULTS, PROVISION_STAGE_SECONDS, SSH_STEP_SECONDS
+from ssh_backends import get_ssh_backend
+from ssh_pool import SSH_POOL_KEEPALIVE, get_ssh_pool
+
+logger = logging.getLogger(__name__)
+
+# Provisioning stages reported by provision_node, in execution order
+STAGE_TOKEN, STAGE_CERT, STAGE_SSH, STAGE_API, STAGE_DONE = 'token', 'cert', 'ssh', 'api', 'done'
+PIPELINE_STAGES = (STAGE_TOKEN, STAGE_CERT, STAGE_SSH, STAGE_API)
+
+
+# Node image run by the compose file (and shipped by artifact relay mode)
+NODE_IMAGE = os.environ.get("MARZBAN_NODE_IMAGE", "gozargah/marzban-node:latest")
+# Registry digest (sha256:...) NODE_IMAGE is pinned to; unset accepts any local copy of the tag
+NODE_IMAGE_DIGEST = os.environ.get("MARZBAN_NODE_IMAGE_DIGEST", "")
+
+COMPOSE_FILE = f"""services:
+  marzban-node:
+    image: {NODE_IMAGE}
+    restart: always
+    network_mode: host
+    environment:
+      SSL_CERT_FILE: "/var/lib/marzban-node/ssl_cert.pem"
+      SSL_KEY_FILE: "/var/lib/marzban-node/ssl_key.pem"
+      SSL_CLIENT_CERT_FILE: "/var/lib/marzban-node/ssl_client_cert.pem"
+    volumes:
+      - /var/lib/marzban-node:/var/lib/marzban-node
+"""
+
+# Printed by the generated script around every step so results can be split per step
+STEP_MARKER = "__MARZBAN_NODE_STEP__"
+# Printed by the probe script with the index of every checked step and 0/1
+PROBE_MARKER = "__MARZBAN_NODE_PROBE__"
+
+# Where the node keeps its certificates and its compose file
+NODE_DATA_DIR = "/var/lib/marzban-node"
+NODE_COMPOSE_DIR = "/opt/marzban-node"
+
+
+def write_file_command(path: str, content: str, delimiter: str = 'MARZBAN_NODE_EOF') -> str:
+    """Shell command writing ``content`` to ``path`` through sudo tee and a quoted heredoc."""
+    return f"sudo tee {shlex.quote(path)} > /dev/null <<'{delimiter}'\n{content.rstrip()}\n{delimiter}"
+
+
+def file_sha256(content: str) -> str:
+    """SHA-256 of a file as written by write_file_command, for comparing with sha256sum."""
+    return hashlib.sha256((content.rstrip() + '\n').encode()).hexdigest()
+
+
+def file_matches_check(path: str, content: str) -> str:
+    """Shell condition that holds when ``path`` already contains ``content``."""
+    return f'[ "$(sudo sha256sum {shlex.quote(path)} 2>/dev/null | cut -c1-64)" = "{file_sha256(content)}" ]'
+
+
+def image_repository(image: str) -> str:
+    """Returns ``image`` without its tag or digest."""
+    image = image.split('@', 1)[0]
+    name, _, tag = image.rpartition(':')
+    return name if name and '/' not in tag else image
+
+
+def image_id_command(image: str) -> str:
+    """Shell command printing the ID of a local image (nothing when it is missing)."""
+    return f"sudo docker image inspect --format '{{{{.Id}}}}' {shlex.quote(image)} 2>/dev/null"
+
+
+def pull_image_step(digest: str = NODE_IMAGE_DIGEST) -> dict:
+    """Step pulling NODE_IMAGE unless the node already has it. With ``digest`` the local
+    image must carry that registry digest; otherwise the pinned image is pulled and
+    tagged as NODE_IMAGE, which the compose file runs."""
+    image = shlex.quote(NODE_IMAGE)
+    if not digest:
+        return {'name': 'pull_image', 'command': f'sudo docker pull {image}',
+                'check': f'sudo docker image inspect {image}'}
+    pinned = shlex.quote(f"{image_repository(NODE_IMAGE)}@{digest}")
+    return {'name': 'pull_image', 'command': f'sudo docker pull {pinned} && sudo docker tag {pinned} {image}',
+            'check': f"sudo docker image inspect --format '{{{{json .RepoDigests}}}}' {image} | grep -qF {shlex.quote('@' + digest)}"}
+
+
+def node_setup_steps(node_details: dict) -> list:
+    """Returns the ordered setup steps that don't depend on the panel certificate.
+
+    Steps are ``{'name', 'command', 'check'}`` dicts. ``check`` is a shell condition
+    that holds when the step's outcome is already in place on the node; such steps
+    are skipped, so re-provisioning a healthy node only verifies it.
+    """
+    node_certs_present = f"sudo test -s {NODE_DATA_DIR}/ssl_cert.pem && sudo test -s {NODE_DATA_DIR}/ssl_key.pem"
+    return [
+        {'name': 'disable_firewall', 'command': 'sudo ufw disable',
+         'check': '! command -v ufw || sudo ufw status | grep -qw inactive'},
+        # Ensure curl and git are installed
+        {'name': 'install_packages', 'command': 'sudo apt-get update && sudo apt-get install -y curl git',
+         'check': 'command -v curl && command -v git'},
+        # Check if docker group exists, if not create it. Then add user to docker group.
+        # We keep using sudo for docker commands since group changes need a new session.
+        {'name': 'docker_group', 'command': 'getent group docker || sudo groupadd docker',
+         'check': 'getent group docker'},
+        {'name': 'docker_group_user', 'command': f"sudo usermod -aG docker {shlex.quote(node_details['user'])}",
+         'check': f"id -nG {shlex.quote(node_details['user'])} | grep -qw docker"},
+        {'name': 'install_docker', 'command': 'curl -fsSL https://get.docker.com | sudo sh',
+         'check': 'command -v docker && sudo docker compose version'},
+        # First start of the upstream compose file generates the node's own SSL cert/key
+        # in /var/lib/marzban-node; not needed once they exist. Operate in /tmp to avoid
+        # permission issues in home dir.
+        {'name': 'remove_old_checkout', 'command': 'cd /tmp && sudo rm -rf Marzban-node',
+         'check': node_certs_present},
+        {'name': 'clone_marzban_node', 'command': 'cd /tmp && git clone https://github.com/Gozargah/Marzban-node',
+         'check': node_certs_present},
+        pull_image_step(),
+        {'name': 'warm_up_container', 'command': 'cd /tmp/Marzban-node && sudo docker compose up -d && sudo docker compose down && sudo rm -f docker-compose.yml',
+         'check': node_certs_present},
+        {'name': 'create_data_dir', 'command': f'sudo mkdir -p {NODE_DATA_DIR}',
+         'check': f'test -d {NODE_DATA_DIR}'},
+    ]
+
+
+def cert_steps(cert_info: str) -> list:
+    """Returns the final steps that install the panel certificate and start the node."""
+    client_cert_path = f"{NODE_DATA_DIR}/ssl_client_cert.pem"
+    compose_path = f"{NODE_COMPOSE_DIR}/docker-compose.yml"
+    return [
+        {'name': 'write_client_cert', 'command': write_file_command(client_cert_path, cert_info),
+         'check': file_matches_check(client_cert_path, cert_info)},
+        # Recreate so a rewritten client certificate is picked up by a running container
+        {'name': 'start_container',
+         'command': f'sudo mkdir -p {NODE_COMPOSE_DIR} && cd {NODE_COMPOSE_DIR}\n' + write_file_command('docker-compose.yml', COMPOSE_FILE) + '\nsudo docker compose up -d --force-recreate',
+         'check': ' && '.join([
+             file_matches_check(compose_path, COMPOSE_FILE),
+             file_matches_check(client_cert_path, cert_info),
+             'sudo docker ps --filter name=marzban-node --filter status=running -q | grep -q .',
+             # A container left on an older image than the one pulled or loaded above is recreated
+             f'[ "$(sudo docker inspect --format \'{{{{.Image}}}}\' $(sudo docker ps -q --filter name=marzban-node | head -n 1))" = "$({image_id_command(NODE_IMAGE)})" ]',
+         ])},
+    ]
+
+
+def provisioning_steps(node_details: dict, cert_info: str = None, relay: bool = None) -> list:
+    """Returns all setup steps of a node in order; without ``cert_info`` only the
+    steps that don't need the certificate.
+
+    With ``relay`` (default: MARZBAN_ARTIFACT_RELAY) the Docker installer, upstream
+    compose file and node image are uploaded from the local artifact cache instead
+    of being downloaded by the node.
+    """
+    steps = node_setup_steps(node_details)
+    if ARTIFACT_RELAY_ENABLED if relay is None else relay:
+        steps = relay_provisioning_steps(steps, cached_artifacts())
+    return steps + cert_steps(cert_info) if cert_info else steps
+
+
+def relay_provisioning_steps(steps: list, artifacts: dict) -> list:
+    """Swaps the download steps for uploads of the bot host's cached artifacts.
+
+    Steps gain an ``uploads`` list of ``(local_path, remote_path)`` pairs that are
+    sent over SFTP before the script runs. Artifacts missing from the cache leave
+    the corresponding online step unchanged.
+    """
+    by_name = {step['name']: dict(step) for step in steps}
+    relayed = []
+
+    def staged(local_path: str, subdir: str = '') -> tuple:
+        return local_path, posixpath.join(REMOTE_ARTIFACT_DIR, subdir, os.path.basename(local_path))
+
+    install_docker = by_name['install_docker']
+    if artifacts.get('packages'):
+        uploads = [staged(path, 'packages') for path in artifacts['packages']]
+        packages = ' '.join(shlex.quote(remote) for _, remote in uploads)
+        # apt resolves the packages' remaining dependencies from the distribution mirror, which needs
+        # fresh package lists even when install_packages (the other apt-get update) is skipped below
+        install_docker.update(command=f'sudo apt-get update && sudo apt-get install -y {packages} && rm -f {packages}', uploads=uploads)
+    elif artifacts.get('installer'):
+        upload = staged(artifacts['installer'])
+        install_docker.update(command=f'sudo sh {shlex.quote(upload[1])} && rm -f {shlex.quote(upload[1])}', uploads=[upload])
+
+    clone = by_name['clone_marzban_node']
+    if artifacts.get('compose'):
+        upload = staged(artifacts['compose'])
+        clone.update(
+            name='stage_upstream_compose',
+            # Point the warm-up at the relayed image so the node never pulls it
+            command=f'sudo mkdir -p /tmp/Marzban-node && sudo mv {shlex.quote(upload[1])} /tmp/Marzban-node/docker-compose.yml\n'
+                    f'sudo sed -i {shlex.quote("s#image: .*#image: " + NODE_IMAGE + "#")} /tmp/Marzban-node/docker-compose.yml',
+            uploads=[upload],
+        )
+
+    if artifacts.get('image'):
+        upload = staged(artifacts['image'])
+        # docker load drops registry digests, so the loaded image is compared by its ID instead
+        image_id = image_tarball_id(artifacts['image'])
+        by_name['pull_image'] = {
+            'name': 'load_image',
+            'command': f'sudo docker load -i {shlex.quote(upload[1])} && rm -f {shlex.quote(upload[1])}',
+            'check': f'[ "$({image_id_command(NODE_IMAGE)})" = {shlex.quote(image_id)} ]' if image_id
+                     else f'sudo docker image inspect {shlex.quote(NODE_IMAGE)}',
+            'uploads': [upload],
+        }
+
+    for step in steps:
+        step = by_name[step['name']]
+        if step['name'] == 'install_packages' and install_docker.get('uploads') and clone.get('uploads'):
+            continue # curl and git are only needed to download what was relayed
+        relayed.append(step)
+    return relayed
+
+
+def build_probe_script(steps: list) -> str:
+    """Compiles the ``check`` conditions of steps into one script reporting each as 0/1."""
+    lines = []
+    for index, step in enumerate(steps):
+        if step.get('check'):
+            lines.append(
+                f'if ( {step["check"]} ) > /dev/null 2>&1; '
+                f'then echo "{PROBE_MARKER} {index} 1"; else echo "{PROBE_MARKER} {index} 0"; fi'
+            )
+    return "\n".join(lines) + "\n"
+
+
+def parse_probe_output(output: str) -> set:
+    """Returns the indexes of steps whose check reported them as already satisfied."""
+    satisfied = set()
+    for line in output.replace('\r', '').split('\n'):
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == PROBE_MARKER and parts[2] == '1':
+            satisfied.add(int(parts[1]))
+    return satisfied
+
+
+def build_step_script(steps: list) -> str:
+    """Compiles steps into one bash script that stops at the first failing step.
+
+    Every step runs in its own ``set -e`` subshell (so ``cd`` does not leak and a
+    multi-line step fails on its first failing command) and is wrapped in begin/end
+    markers carrying its index and exit status.
+    """
+    lines = ['#!/bin/bash', 'trap \'rm -f "$0"\' EXIT']
+    for index, step in enumerate(steps):
+        lines += [
+            f'echo "{STEP_MARKER} begin {index}"',
+            '(',
+            'set -e',
+            step['command'],
+            ')',
+            'status=$?',
+            f'echo "{STEP_MARKER} end {index} $status"',
+            '[ "$status" -eq 0 ] || exit "$status"',
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def parse_step_output(steps: list, output: str) -> list:
+    """Splits the script output by step markers into ``(step, exit_status, output)`` tuples.
+
+    A step that started but never reported its end gets an exit status of None.
+    """
+    results = {}
+    current = None
+    buffer = []
+    for line in output.replace('\r', '').split('\n'):
+        if line.startswith(STEP_MARKER):
+            parts = line.split()
+            if parts[1] == 'begin':
+                current, buffer = int(parts[2]), []
+                results[current] = None
+            elif parts[1] == 'end' and current is not None:
+                results[current] = (int(parts[3]), "\n".join(buffer))
+                current = None
+            continue
+        if current is not None:
+            buffer.append(line)
+    if current is not None:
+        results[current] = (None, "\n".join(buffer))
+    return [(steps[index], status_output[0], status_output[1]) for index, status_output in sorted(results.items())]
+
+
+class OutputTail:
+    """Bounded ring buffer of streamed script output that also tracks the running step.
+
+    Fed incrementally while a step script runs, so a live status message can show
+    the current step, elapsed time and the last lines of output.
+    """
+
+    def __init__(self, max_lines: int = 12, max_line_length: int = 200):
+        self.lines = collections.deque(maxlen=max_lines)
+        self.max_line_length = max_line_length
+        self.steps = []
+        self.current_step = None
+        self.started = time.monotonic()
+        self._partial = ''
+
+    def set_steps(self, steps: list) -> None:
+        self.steps = steps
+        self.started = time.monotonic()
+
+    def feed(self, text: str) -> None:
+        *complete, self._partial = (self._partial + text.replace('\r', '')).split('\n')
+        for line in complete:
+            if line.startswith(STEP_MARKER):
+                parts = line.split()
+                if parts[1] == 'begin':
+                    self.current_step = int(parts[2])
+                continue
+            self.lines.append(line[:self.max_line_length])
+        # Keep an unterminated progress line bounded too
+        self._partial = self._partial[-self.max_line_length:]
+
+    @property
+    def step_name(self) -> str:
+        if self.current_step is None or self.current_step >= len(self.steps):
+            return ''
+        return self.steps[self.current_step]['name']
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def tail(self) -> str:
+        lines = list(self.lines)
+        if self._partial:
+            lines.append(self._partial)
+        return "\n".join(lines)
+
+
+class StepTimer:
+    """Records the duration of each step of a running script from its streamed step markers."""
+
+    def __init__(self, steps: list):
+        self.steps = steps
+        self._started = {}
+        self._partial = ''
+
+    def feed(self, text: str) -> None:
+        *complete, self._partial = (self._partial + text.replace('\r', '')).split('\n')
+        for line in complete:
+            if not line.startswith(STEP_MARKER):
+                continue
+            parts = line.split()
+            index = int(parts[2])
+            if parts[1] == 'begin':
+                self._started[index] = time.monotonic()
+            elif index in self._started and index < len(self.steps):
+                outcome = 'ok' if parts[3] == '0' else 'failed'
+                SSH_STEP_SECONDS.observe(time.monotonic() - self._started.pop(index), step=self.steps[index]['name'], outcome=outcome)
+        # Markers are short lines; only the tail of a long unterminated line matters
+        self._partial = self._partial[-200:]
+
+
+async def run_session_steps(session, node_details: dict, steps: list, output_tail: OutputTail = None):
+    """Runs steps as one uploaded script over an open SSH session.
+
+    If any step has a ``check``, all checks are first evaluated in one probe command
+    and steps already satisfied on the node are skipped. The ``uploads`` of pending
+    steps and the script are sent over SFTP, then the script is executed with a PTY
+    (for sudo). Output is fed to ``output_tail`` as it arrives. Returns
+    ``(success, output)`` where the output keeps one log block per step.
+    """
+    script_path = f"/tmp/marzban-node-{uuid.uuid4().hex}.sh"
+    command_output = []
+
+    try:
+        satisfied = set()
+        if any(step.get('check') for step in steps):
+            _, probe_output = await session.run(f"bash -c {shlex.quote(build_probe_script(steps))}", pty=True)
+            satisfied = parse_probe_output(probe_output)
+        pending = [step for index, step in enumerate(steps) if index not in satisfied]
+        skipped = [step for index, step in enumerate(steps) if index in satisfied]
+        if output_tail:
+            output_tail.set_steps(pending)
+
+        exit_status, output = 0, ''
+        if pending:
+            uploads = [upload for step in pending for upload in step.get('uploads', ())]
+            if uploads:
+                logger.info(f"Uploading {len(uploads)} artifacts to {node_details['ip']}")
+            await session.upload(uploads, [(script_path, build_step_script(pending), 0o700)])
+            logger.info(f"Executing {len(pending)} steps on {node_details['ip']} as {script_path} ({len(skipped)} already satisfied)")
+            step_timer = StepTimer(pending)
+
+            def on_text(text):
+                step_timer.feed(text)
+                if output_tail:
+                    output_tail.feed(text)
+
+            exit_status, output = await session.run(f"bash {script_path}", on_text=on_text, pty=True) # pty for sudo
+
+        for step in skipped:
+            command_output.append(f"CMD: {step['name']}: SKIPPED (already satisfied)")
+        step_results = parse_step_output(pending, output)
+        for step, step_status, step_output in step_results:
+            log_msg = f"CMD: {step['name']}: {step['command']}\nEXIT_STATUS: {step_status}\nOUTPUT: {step_output}"
+            logger.info(log_msg)
+            command_output.append(log_msg)
+            if step_status != 0:
+                logger.error(f"Step '{step['name']}' failed on {node_details['ip']} with exit status {step_status}.")
+        success = exit_status == 0 and len(step_results) == len(pending)
+        return success, "\n".join(command_output)
+
+    except Exception as e:
+        logger.error(f"SSH command execution failed for {node_details['ip']}: {e}")
+        command_output.append(f"Error: {str(e)}")
+        return False, "\n".join(command_output)
+
+
+async def connect_node(node_details: dict, backend=None):
+    """Opens an SSH session to a node; returns ``(session, error)`` with exactly one set."""
+    try:
+        return await (backend or get_ssh_backend()).connect(node_details, keepalive_interval=SSH_POOL_KEEPALIVE), None
+    except Exception as e:
+        logger.error(f"SSH connection failed for {node_details['ip']}: {e}")
+        return None, f"Error: {str(e)}"
+
+
+async def run_ssh_steps(node_details: dict, steps: list, output_tail: OutputTail = None, backend=None):
+    """Connects to a node, runs steps with run_session_steps and disconnects.
+
+    ``backend`` defaults to the configured SSH backend.
+    """
+    session, error = await connect_node(node_details, backend)
+    if error:
+        return False, error
+    try:
+        return await run_session_steps(session, node_details, steps, output_tail)
+    finally:
+        await session.close()
+
+
+class StageFailed(Exception):
+    """Raised by a stage of run_stage_graph to stop the graph."""
+
+
+async def run_stage_graph(stages: dict):
+    """Runs ``{name: (dependencies, coroutine_function)}`` stages concurrently.
+
+    Each stage starts as soon as all its dependencies finished; its coroutine
+    function is called with the dict of results so far. Stages must be given in
+    dependency order. The first stage that raises cancels the others. Returns
+    ``(results, failed_stage)`` where ``failed_stage`` is None on success. The run
+    time of each stage (excluding the wait for its dependencies) is recorded in
+    PROVISION_STAGE_SECONDS.
+    """
+    results = {}
+    tasks = {}
+
+    async def run_stage(name, dependencies, stage):
+        for dependency in dependencies:
+            await tasks[dependency]
+        started = time.monotonic()
+        try:
+            results[name] = await stage(results)
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            PROVISION_STAGE_SECONDS.observe(time.monotonic() - started, stage=name, outcome='failed')
+            raise
+        PROVISION_STAGE_SECONDS.observe(time.monotonic() - started, stage=name, outcome='ok')
+
+    for name, (dependencies, stage) in stages.items():
+        tasks[name] = asyncio.ensure_future(run_stage(name, dependencies, stage))
+    names = {task: name for name, task in tasks.items()}
+    order = list(tasks.values())
+    pending = set(tasks.values())
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+            # Dependents re-raise their dependency's error, so report the earliest stage
+            for task in sorted(done, key=order.index):
+                if task.exception() is not None:
+                    if not isinstance(task.exception(), StageFailed):
+                        logger.error(f"Stage {names[task]} crashed: {task.exception()!r}")
+                    return results, names[task]
+        return results, None
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+# Restarts the running marzban-node container, whatever compose project started it
+RESTART_CONTAINER_COMMAND = 'sudo docker ps -q --filter name=marzban-node | xargs -r sudo docker restart'
+
+
+async def push_node_cert(node_details: dict, cert_info: str):
+    """Writes a new client certificate on an already provisioned node and restarts its container."""
+    steps = [
+        {'name': 'write_client_cert', 'command': write_file_command(f'{NODE_DATA_DIR}/ssl_client_cert.pem', cert_info)},
+        {'name': 'restart_container', 'command': RESTART_CONTAINER_COMMAND},
+    ]
+    try:
+        async with get_ssh_pool().session(node_details) as session:
+            return await run_session_steps(session, node_details, steps)
+    except Exception as e:
+        logger.error(f"SSH connection failed for {node_details['ip']}: {e}")
+        return False, f"Error: {str(e)}"
+
+
+async def provision_node(panel_info: dict, node_details: dict, progress=None, output_tail: OutputTail = None,
+                         checkpoints: dict = None, on_checkpoint=None) -> dict:
+    """Runs the token -> cert -> SSH -> API pipeline for one node, overlapping
+    the panel calls with the node setup.
+
+    ``progress`` is an optional coroutine function called with the furthest running
+    stage whenever it changes (the SSH setup outranks the overlapping panel calls);
+    ``output_tail`` receives the SSH output while it streams. Stages listed in
+    ``checkpoints`` (``{stage: data}``, the cert stage carrying the certificate) are
+    skipped, and ``on_checkpoint(stage, data)`` is awaited after each stage completes,
+    so an interrupted run can resume where it stopped. Returns a result dict with
+    ``success``, the ``stage`` reached (the failing stage on error), the SSH ``output``
+    and the ``cert_fingerprint`` the node received.
+    """
+    result = {'ip': node_details['ip'], 'success': False, 'stage': STAGE_TOKEN, 'output': '', 'cert_fingerprint': None}
+    checkpoints = dict(checkpoints or {})
+    # Stages run concurrently, so the reported stage is the furthest one still running:
+    # the token and certificate fetches must not hide the SSH setup they overlap with
+    active = set()
+    shown = [None]
+
+    async def report():
+        stage = max(active, key=PIPELINE_STAGES.index) if active else shown[0]
+        if stage != shown[0]:
+            shown[0] = result['stage'] = stage
+            if progress:
+                await progress(stage)
+
+    async def enter(stage):
+        active.add(stage)
+        await report()
+
+    async def complete(stage, data=True):
+        active.discard(stage)
+        checkpoints[stage] = data
+        if on_checkpoint:
+            await on_checkpoint(stage, data)
+        await report()
+
+    ssh_output = []
+    session = None
+
+    # Token and certificate are fetched while the node is being set up over SSH;
+    # only the certificate steps wait for both, and the API call for the container.
+    async def token_stage(results):
+        # Served from the per-panel cache when still valid
+        if STAGE_TOKEN in checkpoints:
+            return
+        await enter(STAGE_TOKEN)
+        if not await get_marzban_access_token(panel_info):
+            raise StageFailed(STAGE_TOKEN)
+        await complete(STAGE_TOKEN)
+
+    async def cert_stage(results):
+        cert_info = checkpoints.get(STAGE_CERT)
+        if not cert_info:
+            await enter(STAGE_CERT)
+            cert_info = await get_marzban_cert(panel_info)
+            if not cert_info:
+                raise StageFailed(STAGE_CERT)
+            await complete(STAGE_CERT, cert_info)
+        result['cert_fingerprint'] = cert_fingerprint(cert_info)
+        return cert_info
+
+    async def run_steps(steps):
+        success, output = await run_session_steps(session, node_details, steps, output_tail)
+        ssh_output.append(output)
+        result['output'] = "\n".join(ssh_output)
+        if not success:
+            raise StageFailed(STAGE_SSH)
+
+    async def setup_stage(results):
+        nonlocal session
+        if STAGE_SSH in checkpoints:
+            return
+        await enter(STAGE_SSH)
+        session, error = await connect_node(node_details)
+        if error:
+            result['output'] = error
+            raise StageFailed(STAGE_SSH)
+        await run_steps(provisioning_steps(node_details))
+
+    async def ssh_cert_stage(results):
+        if STAGE_SSH in checkpoints:
+            return
+        await run_steps(cert_steps(results[STAGE_CERT]))
+        logger.info(f"SSH Execution Output for {node_details['ip']}:\n{result['output']}")
+        await complete(STAGE_SSH)
+
+    async def api_stage(results):
+        if STAGE_API in checkpoints:
+            return
+        await enter(STAGE_API)
+        add_as_host_preference = panel_info.get('add_as_new_host', True)
+        if not await add_marzban_node_api(panel_info, node_details['ip'], add_as_host_preference):
+            raise StageFailed(STAGE_API)
+        await complete(STAGE_API)
+
+    try:
+        _, failed_stage = await run_stage_graph({
+            STAGE_TOKEN: ((), token_stage),
+            STAGE_CERT: ((STAGE_TOKEN,), cert_stage),
+            'ssh_setup': ((), setup_stage),
+            STAGE_SSH: ((STAGE_CERT, 'ssh_setup'), ssh_cert_stage),
+            STAGE_API: ((STAGE_SSH,), api_stage),
+        })
+    except BaseException:
+        if session:
+            await session.close()
+        raise
+    if session:
+        # Keep the session warm for later operations on the node
+        if failed_stage:
+            await session.close()
+        else:
+            await get_ssh_pool().adopt(node_details, session)
+    if failed_stage:
+        result['stage'] = STAGE_SSH if failed_stage == 'ssh_setup' else failed_stage
+        PROVISION_RESULTS.inc(result=result['stage'])
+        return result
+
+    result['stage'] = STAGE_DONE
+    result['success'] = True
+    PROVISION_RESULTS.inc(result=STAGE_DONE)
+    logger.info(f"Node addition process completed for {node_details['ip']} to panel {panel_info['domain']}")
+    return result
@@ -0,0 +1,270 @@
+"""Rolling upgrade of the marzban-node containers of recorded nodes.
+
+1. Pre-staging: every node pulls NODE_IMAGE in parallel (UPGRADE_PULL_CONCURRENCY
+   at a time) while its container keeps serving, and the image the container
+   runs is remembered for rollback. Nodes already running the pulled image are
+   left alone.
+2. Waves: at most UPGRADE_MAX_UNAVAILABLE nodes at a time recreate their container
+   on the new image. The panel is asked to reconnect to them and the next wave
+   only starts once each of them is reported ``connected`` again, or
+   UPGRADE_HEALTH_TIMEOUT seconds have passed.
+3. A node that doesn't come back is rolled back to its previous image. Once more
+   than UPGRADE_MAX_FAILURE_RATE of the upgraded nodes failed, the rollout halts
+   and the remaining nodes keep their current version.
+"""
+import asyncio
+import logging
+import os
+import re
+import shlex
+import time
+
+from marzban_api import get_marzban_nodes, reconnect_marzban_node
+from metrics import UPGRADE_RESULTS, UPGRADE_WAVE_SECONDS
+from node_operations import run_on_node
+from node_provisioning import NODE_COMPOSE_DIR, NODE_IMAGE
+
+logger = logging.getLogger(__name__)
+
+UPGRADE_PULL_CONCURRENCY = int(os.environ.get("UPGRADE_PULL_CONCURRENCY", "10"))
+UPGRADE_PULL_TIMEOUT = float(os.environ.get("UPGRADE_PULL_TIMEOUT", "900"))
+UPGRADE_MAX_UNAVAILABLE = int(os.environ.get("UPGRADE_MAX_UNAVAILABLE", "1"))
+UPGRADE_HEALTH_TIMEOUT = float(os.environ.get("UPGRADE_HEALTH_TIMEOUT", "180"))
+UPGRADE_HEALTH_POLL_INTERVAL = float(os.environ.get("UPGRADE_HEALTH_POLL_INTERVAL", "5"))
+UPGRADE_MAX_FAILURE_RATE = float(os.environ.get("UPGRADE_MAX_FAILURE_RATE", "0.2"))
+UPGRADE_RESTART_TIMEOUT = 300
+
+STATUS_ICONS = {
+    'queued': '⏳',
+    'pulling': '⬇️',
+    'pulled': '📦',
+    'current': '✅',
+    'pull_failed': '⚠️',
+    'restarting': '🔄',
+    'waiting': '🩺',
+    'upgraded': '✅',
+    'rolled_back': '↩️',
+    'rollback_failed': '❌',
+    'skipped': '⏸',
+}
+
+PRESTAGE_SCRIPT = f"""container=$(sudo docker ps -aq --filter name=marzban-node | head -n 1)
+[ -n "$container" ] || {{ echo "marzban-node container not found"; exit 1; }}
+echo "PREVIOUS_IMAGE=$(sudo docker inspect --format '{{{{.Image}}}}' "$container")"
+sudo docker pull -q {shlex.quote(NODE_IMAGE)} || exit 1
+echo "TARGET_IMAGE=$(sudo docker image inspect --format '{{{{.Id}}}}' {shlex.quote(NODE_IMAGE)})"
+"""
+
+# Compose files written before MARZBAN_NODE_IMAGE changed still name the old image
+UPGRADE_SCRIPT = (
+    f'cd {NODE_COMPOSE_DIR} && '
+    f'sudo sed -i {shlex.quote("s#image: .*#image: " + NODE_IMAGE + "#")} docker-compose.yml && '
+    'sudo docker compose up -d --force-recreate'
+)
+
+
+def rollback_script(previous_image: str) -> str:
+    """Points the image tag back at the previous image and recreates the container on it."""
+    return (
+        f'sudo docker tag {shlex.quote(previous_image)} {shlex.quote(NODE_IMAGE)} && '
+        f'cd {NODE_COMPOSE_DIR} && sudo docker compose up -d --force-recreate'
+    )
+
+
+def parse_image_ids(output: str) -> dict:
+    """Returns the ``PREVIOUS_IMAGE``/``TARGET_IMAGE`` values printed by the pre-staging script."""
+    return dict(re.findall(r'^(PREVIOUS_IMAGE|TARGET_IMAGE)=(\S+)', output.replace('\r', ''), re.MULTILINE))
+
+
+class UpgradeHalted(Exception):
+    """Raised inside the rollout when the failure rate passed the threshold."""
+
+
+class RollingUpgrade:
+    """One rollout of NODE_IMAGE over ``targets`` (``[{'panel', 'panel_info', 'address', 'node_details'}]``).
+
+    ``statuses`` (address -> status) and ``errors`` (address -> reason) are updated
+    as the rollout progresses, so a live summary can render them.
+    """
+
+    def __init__(self, targets: list, max_unavailable: int = UPGRADE_MAX_UNAVAILABLE,
+                 max_failure_rate: float = UPGRADE_MAX_FAILURE_RATE, health_timeout: float = UPGRADE_HEALTH_TIMEOUT,
+                 pull_concurrency: int = UPGRADE_PULL_CONCURRENCY):
+        self.targets = targets
+        self.max_unavailable = max(1, max_unavailable)
+        self.max_failure_rate = max_failure_rate
+        self.health_timeout = health_timeout
+        self.pull_concurrency = pull_concurrency
+        self.statuses = {target['address']: 'queued' for target in targets}
+        self.errors = {}
+        self.previous_images = {}
+        self.wave = 0
+        self.waves = 0
+        self.halted = None
+        self.finished = False
+
+    def _set(self, address: str, status: str, error: str = None) -> None:
+        self.statuses[address] = status
+        if error:
+            self.errors[address] = error
+        if status in ('current', 'pull_failed', 'upgraded', 'rolled_back', 'rollback_failed', 'skipped'):
+            UPGRADE_RESULTS.inc(result=status)
+
+    def count(self, *statuses) -> int:
+        return sum(1 for status in self.statuses.values() if status in statuses)
+
+    def failure_rate(self) -> float:
+        failed = self.count('rolled_back', 'rollback_failed')
+        finished = failed + self.count('upgraded')
+        return failed / finished if finished else 0.0
+
+    # --- Pre-staging --- #
+    async def _prestage(self, target: dict, semaphore: asyncio.Semaphore) -> bool:
+        address = target['address']
+        async with semaphore:
+            self._set(address, 'pulling')
+            try:
+                exit_status, output = await run_on_node(target['node_details'], PRESTAGE_SCRIPT, UPGRADE_PULL_TIMEOUT)
+            except asyncio.TimeoutError:
+                self._set(address, 'pull_failed', "image pull timed out")
+                return False
+            except Exception as e:
+                self._set(address, 'pull_failed', f"SSH error: {e}")
+                return False
+        images = parse_image_ids(output)
+        if exit_status != 0 or 'PREVIOUS_IMAGE' not in images or 'TARGET_IMAGE' not in images:
+            self._set(address, 'pull_failed', output.replace('\r', '').strip()[-200:] or f"exit status {exit_status}")
+            return False
+        if images['PREVIOUS_IMAGE'] == images['TARGET_IMAGE']:
+            self._set(address, 'current')
+            return False
+        self.previous_images[address] = images['PREVIOUS_IMAGE']
+        self._set(address, 'pulled')
+        return True
+
+    # --- Waves --- #
+    @staticmethod
+    async def _panel_nodes(targets: list) -> dict:
+        """Returns ``{address: node as reported by its panel, or None}``, listing each panel once."""
+        panels = {target['panel']: target['panel_info'] for target in targets}
+        panel_nodes = dict(zip(panels, await asyncio.gather(*(get_marzban_nodes(info) for info in panels.values()))))
+        return {
+            target['address']: next((node for node in panel_nodes[target['panel']] or [] if node.get('address') == target['address']), None)
+            for target in targets
+        }
+
+    async def _wait_healthy(self, wave: list) -> set:
+        """Polls the panels until every node of the wave is connected; returns the addresses that never were."""
+        pending = {target['address']: target for target in wave}
+        deadline = time.monotonic() + self.health_timeout
+        while pending and time.monotonic() < deadline:
+            await asyncio.sleep(UPGRADE_HEALTH_POLL_INTERVAL)
+            for address, node in (await self._panel_nodes(list(pending.values()))).items():
+                if node and node.get('status') == 'connected':
+                    del pending[address]
+        return set(pending)
+
+    async def _run_on(self, target: dict, command: str) -> str:
+        """Runs a restart command; returns an error message, or None on success."""
+        try:
+            exit_status, output = await run_on_node(target['node_details'], command, UPGRADE_RESTART_TIMEOUT)
+        except asyncio.TimeoutError:
+            return "timed out"
+        except Exception as e:
+            return f"SSH error: {e}"
+        if exit_status != 0:
+            return output.replace('\r', '').strip()[-200:] or f"exit status {exit_status}"
+        return None
+
+    async def _rollback(self, target: dict, reason: str) -> None:
+        address = target['address']
+        logger.warning(f"Upgrade of node {address} failed ({reason}), rolling back to {self.previous_images[address][:19]}")
+        error = await self._run_on(target, rollback_script(self.previous_images[address]))
+        if error:
+            logger.error(f"Rollback of node {address} failed: {error}")
+            self._set(address, 'rollback_failed', f"{reason}; rollback: {error}")
+        else:
+            self._set(address, 'rolled_back', reason)
+
+    async def _upgrade_wave(self, wave: list) -> None:
+        started = time.monotonic()
+        for target in wave:
+            self._set(target['address'], 'restarting')
+        errors = await asyncio.gather(*(self._run_on(target, UPGRADE_SCRIPT) for target in wave))
+        restarted = []
+        for target, error in zip(wave, errors):
+            if error:
+                await self._rollback(target, f"restart: {error}")
+            else:
+                self._set(target['address'], 'waiting')
+                restarted.append(target)
+
+        if restarted:
+            # Reconnecting makes the panel drop its stale 'connected' status and dial the new container
+            panel_nodes = await self._panel_nodes(restarted)
+            await asyncio.gather(*(
+                reconnect_marzban_node(target['panel_info'], panel_nodes[target['address']]['id'])
+                for target in restarted if panel_nodes[target['address']]
+            ))
+            unhealthy = await self._wait_healthy(restarted)
+            await asyncio.gather(*(
+                self._rollback(target, f"not connected to the panel after {self.health_timeout:.0f}s")
+                for target in restarted if target['address'] in unhealthy
+            ))
+            for target in restarted:
+                if target['address'] not in unhealthy:
+                    self._set(target['address'], 'upgraded')
+        UPGRADE_WAVE_SECONDS.observe(time.monotonic() - started)
+
+        if self.failure_rate() > self.max_failure_rate:
+            raise UpgradeHalted(f"failure rate {self.failure_rate():.0%} is over {self.max_failure_rate:.0%}")
+
+    async def run(self) -> None:
+        ready = []
+        try:
+            semaphore = asyncio.Semaphore(self.pull_concurrency)
+            staged = await asyncio.gather(*(self._prestage(target, semaphore) for target in self.targets))
+            ready = [target for target, ok in zip(self.targets, staged) if ok]
+            logger.info(f"Upgrade pre-staging done: {len(ready)} of {len(self.targets)} nodes to upgrade to {NODE_IMAGE}")
+
+            while ready:
+                # Nodes left down by a failed rollback still count as unavailable
+                wave_size = self.max_unavailable - self.count('rollback_failed')
+                if wave_size <= 0:
+                    raise UpgradeHalted(f"{self.count('rollback_failed')} nodes are still unavailable")
+                self.wave += 1
+                self.waves = self.wave + (len(ready) - 1) // wave_size
+                wave, ready = ready[:wave_size], ready[wave_size:]
+                await self._upgrade_wave(wave)
+        except Exception as e:
+            if isinstance(e, UpgradeHalted):
+                self.halted = str(e)
+                logger.error(f"Rolling upgrade halted: {e}")
+            else:
+                self.halted = f"error: {e}"
+                logger.exception("Rolling upgrade failed")
+            for target in ready:
+                self._set(target['address'], 'skipped')
+        finally:
+            self.finished = True
+
+    def summary(self, title: str) -> str:
+        """Renders the progress of the rollout."""
+        if self.finished:
+            phase = "پایان"
+        elif self.wave:
+            phase = f"موج {self.wave}/{self.waves}"
+        elif self.count('queued', 'pulling'):
+            phase = f"دریافت ایمیج: {len(self.statuses) - self.count('queued', 'pulling')}/{len(self.statuses)}"
+        else:
+            phase = "آماده‌سازی"
+        lines = [f"{title} ({NODE_IMAGE}) - {phase}"]
+        if self.halted:
+            lines.append(f"⛔️ متوقف شد: {self.halted}")
+        for address, status in self.statuses.items():
+            line = f"{STATUS_ICONS.get(status, '•')} {address}: {status}"
+            if address in self.errors:
+                line += f" ({self.errors[address][:100]})"
+            lines.append(line)
+        text = "\n".join(lines)
+        return text if len(text) <= 4000 else text[:3990] + "\n..."
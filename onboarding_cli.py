@@ -0,0 +1,77 @@
+"""Command line onboarding shared by main.py (settings from config.py) and curlscript.py (interactive).
+
+Without ``--inventory`` the single node given by the entry point is provisioned;
+with it every node of a CSV/YAML inventory (the same format as the bot's
+/bulk_add) is provisioned, ``--parallel`` at a time, through the same pipeline
+the bot uses. The panel login and certificate are fetched once up front and
+shared by the whole batch. Per-node results are written to a JSON report.
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+from bulk_onboarding import BULK_CONCURRENCY, InventoryError, build_json_report, parse_inventory, run_bulk_onboarding
+from marzban_api import close_panel_clients, get_marzban_access_token, get_marzban_cert
+from ssh_pool import get_ssh_pool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPORT_FILE = "onboarding_report.json"
+
+
+def parse_args(description: str = None, argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--inventory', help='CSV or YAML file with one node per row (ip,port,user,password,key)')
+    parser.add_argument('--parallel', type=int, default=BULK_CONCURRENCY, help=f'nodes provisioned at the same time (default {BULK_CONCURRENCY})')
+    parser.add_argument('--report', default=DEFAULT_REPORT_FILE, help=f'JSON results report to write (default {DEFAULT_REPORT_FILE})')
+    args = parser.parse_args(argv)
+    if args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    return args
+
+
+def load_inventory(path: str) -> list:
+    """Reads and parses an inventory file; exits with a message when it can't be used."""
+    try:
+        with open(path, 'rb') as f:
+            return parse_inventory(path, f.read())
+    except OSError as e:
+        raise SystemExit(f"Cannot read inventory {path}: {e}")
+    except InventoryError as e:
+        raise SystemExit(f"Invalid inventory {path}: {e}")
+
+
+def print_result(result: dict) -> None:
+    status = "done" if result['success'] else f"FAILED at {result['stage']}"
+    print(f"{result['ip']}: {status} ({result.get('duration', 0):.1f}s)", flush=True)
+
+
+async def onboard(panel_info: dict, nodes: list, parallel: int):
+    """Provisions ``nodes`` on the panel; returns the results, or None when the panel can't be used."""
+    try:
+        # Warm the per-panel token and certificate caches, so every node reuses one login and certificate
+        if not await get_marzban_access_token(panel_info):
+            print("Could not log in to the Marzban panel, check its address and credentials.")
+            return None
+        if not await get_marzban_cert(panel_info):
+            print("Could not retrieve the node certificate from the Marzban panel.")
+            return None
+        print(f"Logged in to {panel_info['domain']}, provisioning {len(nodes)} node(s), {parallel} at a time...", flush=True)
+        return await run_bulk_onboarding(panel_info, nodes, concurrency=parallel, on_result=print_result)
+    finally:
+        await get_ssh_pool().close()
+        await close_panel_clients()
+
+
+def run(panel_info: dict, nodes: list, args: argparse.Namespace) -> int:
+    """Provisions the nodes and writes the report; returns the process exit status."""
+    started = time.monotonic()
+    results = asyncio.run(onboard(panel_info, nodes, args.parallel))
+    if results is None:
+        return 2
+    with open(args.report, 'wb') as f:
+        f.write(build_json_report(f"{panel_info['domain']}:{panel_info['port']}", results, time.monotonic() - started))
+    succeeded = sum(1 for result in results if result['success'])
+    print(f"{succeeded}/{len(results)} node(s) added. Report written to {args.report}")
+    return 0 if succeeded == len(results) else 1
@@ -0,0 +1,176 @@
+"""Central scheduler for everything the bot sends to Telegram.
+
+Installed as the application's rate limiter, so every Bot API call (replies,
+edits, documents, the main menu, live status edits) passes through it:
+
+- messages to one chat are sent one at a time, in order, within a per-chat token
+  bucket (OUTBOUND_CHAT_RATE/s for private chats, OUTBOUND_GROUP_RATE/min for groups);
+- all chats share a global bucket of OUTBOUND_GLOBAL_RATE/s;
+- an edit of a message that is still waiting for its turn replaces the queued one,
+  so fast progress updates collapse into one request;
+- a 429 (RetryAfter) pauses the chat for the time Telegram asks, then retries.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import TELEGRAM_COALESCED_EDITS, TELEGRAM_FLOOD_WAITS, TELEGRAM_QUEUE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "25"))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = int(os.environ.get("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", "20")) # per minute
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "5"))
+
+# Number of tracked chats above which idle ones are forgotten
+CHAT_SWEEP_THRESHOLD = 256
+
+# Edits where only the latest queued version of a message matters
+COALESCED_ENDPOINTS = {'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup'}
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+class TokenBucket:
+    """``rate`` tokens per second up to ``burst``; ``pause`` blocks it entirely for a while."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available."""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self) -> None:
+        while (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
+        self.take()
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """Rate limiter that orders, paces, coalesces and retries outgoing Bot API calls."""
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 chat_burst: int = OUTBOUND_CHAT_BURST, group_rate: float = OUTBOUND_GROUP_RATE,
+                 max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        # chat_id -> [bucket, lock, number of requests using them]
+        self._chats = {}
+        # (endpoint, chat_id, message_id) -> {'call', 'future'} of an edit waiting for its turn
+        self._pending_edits = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat(self, chat_id) -> list:
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            if len(self._chats) >= CHAT_SWEEP_THRESHOLD:
+                self._forget_idle_chats()
+            # Negative ids and @usernames are groups and channels, which have a per-minute limit
+            is_group = isinstance(chat_id, str) or int(chat_id) < 0
+            bucket = TokenBucket(self.group_rate / 60, 1) if is_group else TokenBucket(self.chat_rate, self.chat_burst)
+            entry = self._chats[chat_id] = [bucket, asyncio.Lock(), 0]
+        return entry
+
+    def _forget_idle_chats(self) -> None:
+        """Drops chats with nothing queued whose bucket has fully refilled (so no limit is lost)."""
+        for chat_id, (bucket, _, users) in list(self._chats.items()):
+            if not users and bucket.delay() == 0 and bucket.tokens >= bucket.burst:
+                del self._chats[chat_id]
+
+    async def _send(self, chat_bucket, callback, args, kwargs, max_retries: int):
+        for attempt in range(max_retries + 1):
+            if chat_bucket:
+                await chat_bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                delay = retry_after_seconds(e) + 0.1
+                TELEGRAM_FLOOD_WAITS.inc()
+                logger.info(f"Flood control hit, pausing {'chat' if chat_bucket else 'all chats'} for {delay:.1f}s")
+                (chat_bucket or self.global_bucket).pause(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = rate_limit_args if rate_limit_args is not None else self.max_retries
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            # Not a message (answerCallbackQuery, getMe, ...): only the global limit applies
+            return await self._send(None, callback, args, kwargs, max_retries)
+        started = time.monotonic()
+
+        edit_key = (endpoint, chat_id, data.get('message_id')) if endpoint in COALESCED_ENDPOINTS else None
+        pending = self._pending_edits.get(edit_key) if edit_key else None
+        if pending:
+            # The queued edit hasn't been sent yet: send this newer version in its place
+            pending['call'] = (callback, args, kwargs)
+            TELEGRAM_COALESCED_EDITS.inc()
+            return await asyncio.shield(pending['future'])
+        if edit_key:
+            pending = self._pending_edits[edit_key] = {'call': (callback, args, kwargs), 'future': asyncio.get_running_loop().create_future()}
+            # Mark a failure as retrieved even when no coalesced caller waits for it
+            pending['future'].add_done_callback(lambda future: future.cancelled() or future.exception())
+
+        chat = self._chat(chat_id)
+        chat[2] += 1
+        try:
+            async with chat[1]: # FIFO, keeps the chat's messages in order
+                if pending:
+                    # From now on newer edits queue behind this one instead of replacing it
+                    del self._pending_edits[edit_key]
+                    callback, args, kwargs = pending['call']
+                TELEGRAM_QUEUE_SECONDS.observe(time.monotonic() - started, endpoint=endpoint)
+                result = await self._send(chat[0], callback, args, kwargs, max_retries)
+        except BaseException as e:
+            if pending and not pending['future'].done():
+                if self._pending_edits.get(edit_key) is pending:
+                    del self._pending_edits[edit_key]
+                if isinstance(e, asyncio.CancelledError):
+                    pending['future'].cancel()
+                else:
+                    pending['future'].set_exception(e)
+            raise
+        finally:
+            chat[2] -= 1
+        if pending:
+            pending['future'].set_result(result)
+        return result
@@ -0,0 +1,248 @@
+"""In-memory registry of Marzban panels and the nodes provisioned on them.
+
+Everything is loaded once from SQLite and then served from dicts indexed by panel
+name, owner (Telegram user id) and node address. Every change is written through
+to SQLite inside a transaction before the in-memory view is updated, so
+concurrent writers can never leave a half-written file behind.
+
+Panels stored in the legacy ``marzban_panels.json`` are imported on first start.
+
+Node SSH passwords and keys are only stored encrypted with NODE_CREDENTIALS_KEY (a
+Fernet key, ``Fernet.generate_key()``); without it only the SSH port and user are
+kept, and the bot cannot reach recorded nodes over SSH on its own.
+"""
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_DB_FILE = os.environ.get("MARZBAN_REGISTRY_DB", "marzban_bot.db")
+LEGACY_PANEL_DATA_FILE = "marzban_panels.json"
+NODE_CREDENTIALS_KEY = os.environ.get("NODE_CREDENTIALS_KEY", "")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS panels (
+    name TEXT PRIMARY KEY,
+    owner_id INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS panels_owner ON panels (owner_id);
+CREATE TABLE IF NOT EXISTS nodes (
+    panel_name TEXT NOT NULL REFERENCES panels (name) ON DELETE CASCADE,
+    address TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (panel_name, address)
+);
+CREATE INDEX IF NOT EXISTS nodes_address ON nodes (address);
+"""
+
+
+class PanelRegistry:
+    """Panels and nodes kept in memory with write-through SQLite persistence.
+
+    Lookups return copies, so callers must go through ``save_*`` to change data.
+    """
+
+    def __init__(self, db_file: str = REGISTRY_DB_FILE, legacy_json_file: str = LEGACY_PANEL_DATA_FILE):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SCHEMA)
+
+        self._panels = {}    # panel name -> panel_info
+        self._owners = {}    # panel name -> owner id
+        self._by_owner = {}  # owner id -> {panel name: None}, in insertion order
+        self._nodes = {}     # panel name -> {address: node}
+        self._by_address = {}  # node address -> set of panel names
+
+        self._import_legacy_json(legacy_json_file)
+        self._load()
+
+    def _load(self) -> None:
+        for name, owner_id, data in self._conn.execute("SELECT name, owner_id, data FROM panels"):
+            self._index_panel(name, json.loads(data), owner_id)
+        for panel_name, address, data in self._conn.execute("SELECT panel_name, address, data FROM nodes"):
+            self._index_node(panel_name, address, json.loads(data))
+        logger.info(f"Loaded {len(self._panels)} panels and {len(self._by_address)} node addresses from registry")
+
+    def _import_legacy_json(self, legacy_json_file: str) -> None:
+        """Imports panels (and nested nodes) from marzban_panels.json once."""
+        if self._conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_json_imported'").fetchone():
+            return
+        panels = {}
+        if legacy_json_file and os.path.exists(legacy_json_file):
+            with open(legacy_json_file, 'r') as f:
+                try:
+                    panels = json.load(f)
+                except json.JSONDecodeError:
+                    logger.error(f"Could not parse {legacy_json_file}, skipping import")
+        with self._conn:
+            for name, panel_info in panels.items():
+                nodes = panel_info.pop('nodes', {})
+                self._conn.execute("INSERT OR REPLACE INTO panels (name, owner_id, data) VALUES (?, NULL, ?)", (name, json.dumps(panel_info)))
+                for address, node in nodes.items():
+                    self._conn.execute("INSERT OR REPLACE INTO nodes (panel_name, address, data) VALUES (?, ?, ?)", (name, address, json.dumps(node)))
+            self._conn.execute("INSERT INTO meta (key, value) VALUES ('legacy_json_imported', '1')")
+        if panels:
+            logger.info(f"Imported {len(panels)} panels from {legacy_json_file}")
+
+    def _index_panel(self, name: str, panel_info: dict, owner_id) -> None:
+        self._panels[name] = panel_info
+        self._owners[name] = owner_id
+        self._by_owner.setdefault(owner_id, {})[name] = None
+        self._nodes.setdefault(name, {})
+
+    def _index_node(self, panel_name: str, address: str, node: dict) -> None:
+        self._nodes.setdefault(panel_name, {})[address] = node
+        self._by_address.setdefault(address, set()).add(panel_name)
+
+    def _unindex_node(self, panel_name: str, address: str) -> None:
+        self._nodes.get(panel_name, {}).pop(address, None)
+        panel_names = self._by_address.get(address)
+        if panel_names is not None:
+            panel_names.discard(panel_name)
+            if not panel_names:
+                del self._by_address[address]
+
+    # --- Panels --- #
+    def panel_names(self) -> list:
+        return list(self._panels)
+
+    def panels(self) -> dict:
+        """Returns ``{name: panel_info}`` for every panel."""
+        return {name: dict(panel_info) for name, panel_info in self._panels.items()}
+
+    def get_panel(self, name: str):
+        panel_info = self._panels.get(name)
+        return dict(panel_info) if panel_info is not None else None
+
+    def panel_owner(self, name: str):
+        return self._owners.get(name)
+
+    def panels_by_owner(self, owner_id: int) -> dict:
+        return {name: dict(self._panels[name]) for name in self._by_owner.get(owner_id, ())}
+
+    def save_panel(self, name: str, panel_info: dict, owner_id: int = None) -> None:
+        """Creates or replaces a panel. Its nodes are kept; ``owner_id`` only applies to a new
+        panel, the owner of an existing one never changes."""
+        panel_info = {key: value for key, value in panel_info.items() if key != 'nodes'}
+        with self._lock:
+            if name in self._owners:
+                owner_id = self._owners[name]
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO panels (name, owner_id, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT (name) DO UPDATE SET data = excluded.data",
+                    (name, owner_id, json.dumps(panel_info)),
+                )
+            self._index_panel(name, panel_info, owner_id)
+
+    # --- Nodes --- #
+    def nodes(self, panel_name: str) -> dict:
+        """Returns ``{address: node}`` for the nodes recorded on a panel."""
+        return {address: dict(node) for address, node in self._nodes.get(panel_name, {}).items()}
+
+    def get_node(self, panel_name: str, address: str):
+        node = self._nodes.get(panel_name, {}).get(address)
+        return dict(node) if node is not None else None
+
+    def find_node(self, address: str) -> list:
+        """Returns ``[(panel_name, node)]`` for every panel a node address is recorded on."""
+        return [(panel_name, dict(self._nodes[panel_name][address])) for panel_name in self._by_address.get(address, ())]
+
+    def save_node(self, panel_name: str, address: str, node: dict) -> None:
+        with self._lock:
+            if panel_name not in self._panels:
+                raise KeyError(f"Unknown panel {panel_name}")
+            node = dict(node)
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO nodes (panel_name, address, data) VALUES (?, ?, ?)",
+                    (panel_name, address, json.dumps(node)),
+                )
+            self._index_node(panel_name, address, node)
+
+    def update_node(self, panel_name: str, address: str, **changes) -> None:
+        """Updates some fields of a recorded node."""
+        node = self.get_node(panel_name, address)
+        if node is None:
+            raise KeyError(f"Unknown node {address} on panel {panel_name}")
+        node.update(changes)
+        self.save_node(panel_name, address, node)
+
+    def delete_node(self, panel_name: str, address: str) -> None:
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM nodes WHERE panel_name = ? AND address = ?", (panel_name, address))
+            self._unindex_node(panel_name, address)
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+@functools.lru_cache(maxsize=None)
+def _fernet(key: str):
+    """The cipher for node credentials, or None (logged once) when ``key`` isn't a valid Fernet key."""
+    from cryptography.fernet import Fernet
+
+    try:
+        return Fernet(key.encode())
+    except ValueError:
+        logger.error("NODE_CREDENTIALS_KEY is not a valid Fernet key, node SSH credentials are not stored")
+        return None
+
+
+def node_record(node_details: dict, cert_fingerprint: str = None) -> dict:
+    """Converts node_details of a provisioned node into the node stored by ``save_node``.
+
+    The SSH password and key are kept only when NODE_CREDENTIALS_KEY is set, encrypted with it.
+    """
+    record = {
+        'ssh_port': node_details['port'],
+        'ssh_user': node_details['user'],
+        'cert_fingerprint': cert_fingerprint,
+    }
+    fernet = _fernet(NODE_CREDENTIALS_KEY) if NODE_CREDENTIALS_KEY else None
+    if fernet:
+        secret = json.dumps({'password': node_details.get('password', ''), 'key': node_details.get('key', '')})
+        record['ssh_secret'] = fernet.encrypt(secret.encode()).decode()
+    return record
+
+
+def node_ssh_details(address: str, node: dict):
+    """Converts a recorded node into the node_details dict used by the SSH helpers, or returns
+    None when its credentials weren't stored or can't be decrypted with NODE_CREDENTIALS_KEY."""
+    fernet = _fernet(NODE_CREDENTIALS_KEY) if NODE_CREDENTIALS_KEY else None
+    if not node.get('ssh_secret') or not fernet:
+        return None
+    from cryptography.fernet import InvalidToken
+
+    try:
+        secret = json.loads(fernet.decrypt(node['ssh_secret'].encode()))
+    except InvalidToken:
+        logger.warning(f"Stored SSH credentials of node {address} don't match NODE_CREDENTIALS_KEY")
+        return None
+    return {
+        'ip': address,
+        'port': node['ssh_port'],
+        'user': node['ssh_user'],
+        'password': secret['password'],
+        'key': secret['key'],
+    }
+
+
+_registry = None
+
+
+def get_registry() -> PanelRegistry:
+    """Returns the process-wide registry, loading it on first use."""
+    global _registry
+    if _registry is None:
+        _registry = PanelRegistry()
+    return _registry
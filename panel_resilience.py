@@ -0,0 +1,137 @@
+"""Retry policy and per-panel circuit breakers for Marzban API calls.
+
+A panel whose calls keep failing (transport errors or 5xx responses) has its
+breaker opened: further calls fail immediately with CircuitOpenError instead of
+each waiting out the HTTP timeout. After BREAKER_RESET_TIMEOUT seconds the
+breaker lets BREAKER_HALF_OPEN_PROBES calls through; a success closes it, a
+failure opens it again.
+"""
+import logging
+import os
+import random
+import time
+
+import httpx
+
+from metrics import PANEL_BREAKER_REJECTED, PANEL_BREAKER_STATE, PANEL_BREAKER_TRANSITIONS
+
+logger = logging.getLogger(__name__)
+
+# Attempts per call (1 disables retries) and the exponential backoff bounds (seconds)
+PANEL_RETRY_ATTEMPTS = int(os.environ.get("PANEL_RETRY_ATTEMPTS", "3"))
+PANEL_RETRY_BASE_DELAY = float(os.environ.get("PANEL_RETRY_BASE_DELAY", "0.5"))
+PANEL_RETRY_MAX_DELAY = float(os.environ.get("PANEL_RETRY_MAX_DELAY", "8"))
+# Consecutive failures that open a panel's breaker, and how long it stays open
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", "30"))
+BREAKER_HALF_OPEN_PROBES = int(os.environ.get("BREAKER_HALF_OPEN_PROBES", "1"))
+
+# Responses that mean the panel (or its proxy) is unhealthy rather than the request wrong
+RETRY_STATUS_CODES = {502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+# Errors raised before the request reached the panel, safe to retry for any method
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN = 'closed', 'half_open', 'open'
+STATE_GAUGE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+
+class CircuitOpenError(httpx.HTTPError):
+    """Raised instead of calling a panel whose breaker is open."""
+
+
+def is_failure_status(status_code: int) -> bool:
+    return status_code >= 500
+
+
+def should_retry(idempotent: bool, error: Exception = None, status_code: int = None) -> bool:
+    """Tells whether a failed attempt may be repeated."""
+    if error is not None:
+        if isinstance(error, CircuitOpenError):
+            return False
+        return isinstance(error, NOT_SENT_ERRORS) or (idempotent and isinstance(error, httpx.TransportError))
+    return idempotent and status_code in RETRY_STATUS_CODES
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Tells whether a failed call may have been a passing panel hiccup (worth checking and retrying)."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRY_STATUS_CODES
+    return isinstance(error, httpx.TransportError)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff before retry number ``attempt`` (1-based)."""
+    return random.uniform(0, min(PANEL_RETRY_MAX_DELAY, PANEL_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker for one panel."""
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT, half_open_probes: int = BREAKER_HALF_OPEN_PROBES):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.last_error = ''
+        PANEL_BREAKER_STATE.set(0, panel=name)
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        logger.warning(f"Circuit breaker of panel {self.name}: {self.state} -> {state}")
+        self.state = state
+        PANEL_BREAKER_STATE.set(STATE_GAUGE_VALUES[state], panel=self.name)
+        PANEL_BREAKER_TRANSITIONS.inc(panel=self.name, state=state)
+
+    def retry_in(self) -> float:
+        """Seconds until an open breaker lets a probe through."""
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic()) if self.state == STATE_OPEN else 0.0
+
+    def before_call(self) -> bool:
+        """Admits a call or raises CircuitOpenError; returns True when the call is a half-open probe."""
+        if self.state == STATE_OPEN and not self.retry_in():
+            self._transition(STATE_HALF_OPEN)
+            self.probes = 0
+        if self.state == STATE_CLOSED:
+            return False
+        if self.state == STATE_HALF_OPEN and self.probes < self.half_open_probes:
+            self.probes += 1
+            return True
+        PANEL_BREAKER_REJECTED.inc(panel=self.name)
+        raise CircuitOpenError(f"Panel {self.name} is unavailable ({self.last_error}); retrying in {self.retry_in():.0f}s")
+
+    def record_success(self, probe: bool = False) -> None:
+        self.failures = 0
+        if probe:
+            self.probes -= 1
+        if self.state != STATE_CLOSED:
+            self._transition(STATE_CLOSED)
+
+    def record_failure(self, error: str, probe: bool = False) -> None:
+        self.last_error = error
+        self.failures += 1
+        if probe:
+            self.probes -= 1
+        if self.state == STATE_HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._transition(STATE_OPEN)
+
+    def release_probe(self) -> None:
+        """Frees a half-open slot taken by a call that ended without an outcome (e.g. cancelled)."""
+        self.probes = max(0, self.probes - 1)
+
+
+_breakers = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Returns the breaker of a panel (keyed like the HTTP clients, by ``domain:port``)."""
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(name)
+    return _breakers[name]
@@ -0,0 +1,233 @@
+"""Persistent queue of node provisioning jobs.
+
+Jobs are stored in SQLite together with a checkpoint per completed provisioning
+stage, so a restarted bot resumes every unfinished job from its last completed
+stage. At most JOBS_MAX_CONCURRENT jobs run at once, and at most
+JOBS_MAX_PER_PANEL of them against the same panel. The SSH password and key of a
+job's node are dropped from the database once the job finished.
+
+Jobs enqueued together (a bulk upload) form a batch; once every job of a batch
+has finished, ``on_batch_finished`` is awaited with the batch and its jobs, also
+when the last of them finished in a previous run of the bot.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB_FILE = os.environ.get("MARZBAN_JOBS_DB", "marzban_bot.db")
+JOBS_MAX_CONCURRENT = int(os.environ.get("JOBS_MAX_CONCURRENT", "10"))
+JOBS_MAX_PER_PANEL = int(os.environ.get("JOBS_MAX_PER_PANEL", "3"))
+
+JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED = 'queued', 'running', 'done', 'failed'
+
+# Fields of node_details kept once a job finished
+PUBLIC_NODE_FIELDS = ('ip', 'port', 'user')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    panel_name TEXT NOT NULL,
+    node_ip TEXT NOT NULL,
+    chat_id INTEGER,
+    state TEXT NOT NULL,
+    stage TEXT,
+    checkpoints TEXT NOT NULL DEFAULT '{}',
+    node_details TEXT NOT NULL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    batch_id INTEGER REFERENCES batches (id),
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE INDEX IF NOT EXISTS jobs_chat ON jobs (chat_id);
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    panel_name TEXT NOT NULL,
+    chat_id INTEGER,
+    created_at REAL NOT NULL,
+    reported_at REAL
+);
+"""
+
+JOB_COLUMNS = ('id', 'panel_name', 'node_ip', 'chat_id', 'state', 'stage', 'checkpoints', 'node_details', 'error', 'created_at', 'updated_at', 'batch_id', 'result')
+BATCH_COLUMNS = ('id', 'panel_name', 'chat_id', 'created_at', 'reported_at')
+
+
+class ProvisioningQueue:
+    """SQLite-backed job queue with global and per-panel worker limits.
+
+    ``runner`` is a coroutine function ``runner(job, queue)`` that performs a job and
+    returns ``(success, error)``; it reports progress through ``set_stage`` and
+    ``save_checkpoint``, and may keep a summary with ``save_result``.
+    ``on_batch_finished(batch, jobs)`` is an optional coroutine function.
+    """
+
+    def __init__(self, runner, db_file: str = JOBS_DB_FILE, max_concurrent: int = JOBS_MAX_CONCURRENT,
+                 max_per_panel: int = JOBS_MAX_PER_PANEL, on_batch_finished=None):
+        self.runner = runner
+        self.on_batch_finished = on_batch_finished
+        self.max_per_panel = max_per_panel
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Overwrite the credentials dropped from finished jobs instead of leaving them in free pages
+        self._conn.execute("PRAGMA secure_delete=ON")
+        self._conn.executescript(SCHEMA)
+        self._global_slots = asyncio.Semaphore(max_concurrent)
+        self._panel_slots = {}
+        self._tasks = {}
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params)
+
+    def _update(self, job_id: int, **fields) -> None:
+        fields['updated_at'] = time.time()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        self._execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    @staticmethod
+    def _row_to_job(row) -> dict:
+        job = dict(zip(JOB_COLUMNS, row))
+        job['checkpoints'] = json.loads(job['checkpoints'])
+        job['node_details'] = json.loads(job['node_details'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    # --- Queries --- #
+    def get(self, job_id: int):
+        row = self._execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def recent(self, chat_id: int = None, limit: int = 15) -> list:
+        if chat_id is None:
+            rows = self._execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+        else:
+            rows = self._execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE chat_id = ? ORDER BY id DESC LIMIT ?", (chat_id, limit))
+        return [self._row_to_job(row) for row in rows.fetchall()]
+
+    def get_batch(self, batch_id: int):
+        row = self._execute(f"SELECT {', '.join(BATCH_COLUMNS)} FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        return dict(zip(BATCH_COLUMNS, row)) if row else None
+
+    def batch_jobs(self, batch_id: int) -> list:
+        """Returns the jobs of a batch in the order they were enqueued."""
+        rows = self._execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE batch_id = ? ORDER BY id", (batch_id,))
+        return [self._row_to_job(row) for row in rows.fetchall()]
+
+    # --- Progress reporting (used by the runner) --- #
+    def set_stage(self, job_id: int, stage: str) -> None:
+        self._update(job_id, stage=stage)
+
+    def save_checkpoint(self, job_id: int, stage: str, data=None) -> None:
+        """Records that ``stage`` completed, with optional data needed to resume after it."""
+        job = self.get(job_id)
+        checkpoints = job['checkpoints'] if job else {}
+        checkpoints[stage] = data
+        self._update(job_id, checkpoints=json.dumps(checkpoints))
+
+    def save_result(self, job_id: int, result: dict) -> None:
+        """Keeps a JSON summary of the job's outcome (e.g. for the report of its batch)."""
+        self._update(job_id, result=json.dumps(result))
+
+    # --- Scheduling --- #
+    def _insert_job(self, panel_name: str, node_details: dict, chat_id: int, batch_id: int, now: float) -> int:
+        return self._conn.execute(
+            "INSERT INTO jobs (panel_name, node_ip, chat_id, state, node_details, created_at, updated_at, batch_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (panel_name, node_details['ip'], chat_id, JOB_QUEUED, json.dumps(node_details), now, now, batch_id),
+        ).lastrowid
+
+    def enqueue(self, panel_name: str, node_details: dict, chat_id: int = None) -> int:
+        """Stores a new job and schedules it; returns the job id."""
+        with self._lock, self._conn:
+            job_id = self._insert_job(panel_name, node_details, chat_id, None, time.time())
+        self._schedule(job_id)
+        return job_id
+
+    def enqueue_batch(self, panel_name: str, nodes: list, chat_id: int = None) -> int:
+        """Stores one job per node as a batch and schedules them; returns the batch id."""
+        now = time.time()
+        with self._lock, self._conn:
+            batch_id = self._conn.execute(
+                "INSERT INTO batches (panel_name, chat_id, created_at) VALUES (?, ?, ?)", (panel_name, chat_id, now),
+            ).lastrowid
+            job_ids = [self._insert_job(panel_name, node_details, chat_id, batch_id, now) for node_details in nodes]
+        for job_id in job_ids:
+            self._schedule(job_id)
+        return batch_id
+
+    def resume(self) -> list:
+        """Re-schedules jobs left queued or running by a previous run; returns their ids."""
+        rows = self._execute("SELECT id FROM jobs WHERE state IN (?, ?) ORDER BY id", (JOB_QUEUED, JOB_RUNNING)).fetchall()
+        # Jobs enqueued since this process started are already scheduled
+        job_ids = [row[0] for row in rows if row[0] not in self._tasks]
+        for job_id in job_ids:
+            self._update(job_id, state=JOB_QUEUED)
+            self._schedule(job_id)
+        if job_ids:
+            logger.info(f"Resuming {len(job_ids)} provisioning jobs: {job_ids}")
+        # Batches whose last job finished just before a restart haven't been reported yet
+        rows = self._execute(
+            "SELECT id FROM batches WHERE reported_at IS NULL AND NOT EXISTS "
+            "(SELECT 1 FROM jobs WHERE jobs.batch_id = batches.id AND jobs.state IN (?, ?))", (JOB_QUEUED, JOB_RUNNING),
+        ).fetchall()
+        for (batch_id,) in rows:
+            asyncio.get_running_loop().create_task(self._finish_batch(batch_id))
+        return job_ids
+
+    def _schedule(self, job_id: int) -> None:
+        if job_id not in self._tasks:
+            self._tasks[job_id] = asyncio.get_running_loop().create_task(self._run(job_id))
+
+    def _panel_slot(self, panel_name: str) -> asyncio.Semaphore:
+        return self._panel_slots.setdefault(panel_name, asyncio.Semaphore(self.max_per_panel))
+
+    async def _run(self, job_id: int) -> None:
+        try:
+            job = self.get(job_id)
+            # The panel slot comes first: jobs waiting for a busy panel must not hold
+            # global slots that jobs on other panels could run in
+            async with self._panel_slot(job['panel_name']), self._global_slots:
+                self._update(job_id, state=JOB_RUNNING)
+                job = self.get(job_id)
+                try:
+                    success, error = await self.runner(job, self)
+                except asyncio.CancelledError:
+                    raise # Left as running, so it is resumed on the next start
+                except Exception as e:
+                    logger.exception(f"Provisioning job {job_id} crashed")
+                    success, error = False, str(e)
+                public_details = {key: job['node_details'][key] for key in PUBLIC_NODE_FIELDS if key in job['node_details']}
+                self._update(job_id, state=JOB_DONE if success else JOB_FAILED, error=error, node_details=json.dumps(public_details))
+        finally:
+            self._tasks.pop(job_id, None)
+        if job['batch_id'] is not None:
+            await self._finish_batch(job['batch_id'])
+
+    async def _finish_batch(self, batch_id: int) -> None:
+        """Reports a batch once none of its jobs is left to run."""
+        jobs = self.batch_jobs(batch_id)
+        batch = self.get_batch(batch_id)
+        if batch['reported_at'] is not None or any(job['state'] in (JOB_QUEUED, JOB_RUNNING) for job in jobs):
+            return
+        self._execute("UPDATE batches SET reported_at = ? WHERE id = ?", (time.time(), batch_id))
+        if self.on_batch_finished:
+            try:
+                await self.on_batch_finished(batch, jobs)
+            except Exception:
+                logger.exception(f"Reporting provisioning batch {batch_id} failed")
+
+    async def stop(self) -> None:
+        """Cancels running jobs; they stay resumable in the database."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._conn.close()
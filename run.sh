@@ -30,7 +30,7 @@ upgrade_library_pip() {
     sudo pip install --upgrade "$1"
 }
 
-required_libraries=("paramiko==3.3.1" "requests==2.31.0")
+required_libraries=("paramiko==3.3.1" "httpx")
 
 for lib in "${required_libraries[@]}"; do
     # Split the string to get the library name for checking
@@ -43,20 +43,20 @@ for lib in "${required_libraries[@]}"; do
     fi
 done
 
-# Command to upgrade requests and urllib3
-if ! upgrade_library_pip "requests"; then
-    echo "Upgrade of requests via pip failed, attempting alternative method..."
-    install_library_apt "requests" || sudo pip install --upgrade "requests"
+# Saving the scripts (curlscript.py imports the provisioning modules next to it, which
+# only the bot repository ships); MARZBAN_NODE_REPO/MARZBAN_NODE_REF select another fork or version
+repo="${MARZBAN_NODE_REPO:-raminol12/marzbannodbot}"
+ref="${MARZBAN_NODE_REF:-main}"
+script_dir=$(mktemp -d)
+curl -fsSL "https://codeload.github.com/$repo/tar.gz/$ref" | tar -xz -C "$script_dir" --strip-components=1
+if [ ! -f "$script_dir/onboarding_cli.py" ]; then
+    echo "Could not download the onboarding scripts from $repo ($ref)."
+    rm -rf "$script_dir"
+    exit 2
 fi
-
-if ! upgrade_library_pip "urllib3"; then
-    echo "Upgrade of urllib3 via pip failed, attempting alternative method..."
-    install_library_apt "urllib3" || sudo pip install --upgrade "urllib3"
-fi
-
-# Saving Script into > curlscript.py
-curl -sSL https://raw.githubusercontent.com/raminol12/MarzbanNode/main/curlscript.py > curlscript.py
-# Running previously saved script
-python3 curlscript.py
-# (OPTIONAL) removing script
-rm curlscript.py
+# Running the script; arguments are passed on, e.g. --inventory nodes.csv --parallel 10
+python3 "$script_dir/curlscript.py" "$@"
+status=$?
+# (OPTIONAL) removing the scripts
+rm -rf "$script_dir"
+exit $status
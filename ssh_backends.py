@@ -0,0 +1,244 @@
+"""Pluggable SSH backends used to provision and operate nodes.
+
+A backend opens an ``SSHSession`` to a node; sessions run commands with streamed
+output and upload files over SFTP. Two backends exist:
+
+- ``asyncssh``: runs every session on the event loop, so hundreds of nodes can be
+  provisioned at once without a thread per node.
+- ``paramiko``: the blocking client run in worker threads, used as a fallback when
+  asyncssh is not installed.
+
+MARZBAN_SSH_BACKEND selects one explicitly; by default asyncssh is used when available.
+"""
+import abc
+import asyncio
+import codecs
+import io
+import logging
+import os
+import posixpath
+
+logger = logging.getLogger(__name__)
+
+SSH_BACKEND = os.environ.get("MARZBAN_SSH_BACKEND", "")
+SSH_CONNECT_TIMEOUT = 10
+
+
+class SSHSession(abc.ABC):
+    """An open connection to a node; backends implement every method."""
+
+    @abc.abstractmethod
+    async def run(self, command: str, on_text=None, pty: bool = False):
+        """Runs ``command``, passing decoded output chunks to ``on_text`` on the event loop.
+
+        Returns ``(exit_status, output)``.
+        """
+
+    @abc.abstractmethod
+    async def upload(self, files=(), contents=()) -> None:
+        """Uploads ``files`` (``(local_path, remote_path)``) and ``contents``
+        (``(remote_path, text, mode)``) over one SFTP session, creating missing
+        remote directories.
+        """
+
+    @abc.abstractmethod
+    def is_alive(self) -> bool:
+        """Whether the underlying transport is still connected."""
+
+    @abc.abstractmethod
+    async def close(self) -> None:
+        ...
+
+
+def _remote_dirs(files) -> list:
+    """Remote directories needed by ``files``, parents first."""
+    dirs = set()
+    for _, remote in files:
+        path = posixpath.dirname(remote)
+        while path not in ('', '/'):
+            dirs.add(path)
+            path = posixpath.dirname(path)
+    return sorted(dirs)
+
+
+# --- paramiko --- #
+def load_private_key(key_text: str):
+    """Parses an OpenSSH/PEM private key given as text, or returns None if no key was given."""
+    import paramiko
+
+    if not key_text:
+        return None
+    for key_class in (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey):
+        try:
+            return key_class.from_private_key(io.StringIO(key_text))
+        except paramiko.SSHException:
+            continue
+    raise paramiko.SSHException("Unsupported or invalid private key")
+
+
+def connect_ssh_client(node_details: dict, keepalive_interval: float = None):
+    """Opens a blocking paramiko connection to a node with its password or key."""
+    import paramiko
+
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(
+        node_details['ip'], port=int(node_details['port']), username=node_details['user'],
+        password=node_details.get('password') or None, pkey=load_private_key(node_details.get('key')),
+        timeout=SSH_CONNECT_TIMEOUT
+    )
+    if keepalive_interval:
+        client.get_transport().set_keepalive(int(keepalive_interval))
+    return client
+
+
+def _read_channel(channel, on_text=None) -> str:
+    """Reads a channel until EOF, passing each decoded chunk to ``on_text``."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    chunks = []
+    while True:
+        data = channel.recv(32768)
+        if not data:
+            break
+        text = decoder.decode(data)
+        chunks.append(text)
+        if on_text:
+            on_text(text)
+    chunks.append(decoder.decode(b'', final=True))
+    return ''.join(chunks)
+
+
+class ParamikoSession(SSHSession):
+    """Blocking paramiko client whose calls run in worker threads."""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def run(self, command: str, on_text=None, pty: bool = False):
+        loop = asyncio.get_running_loop()
+        threaded_on_text = (lambda text: loop.call_soon_threadsafe(on_text, text)) if on_text else None
+
+        def run_blocking():
+            stdin, stdout, stderr = self.client.exec_command(command, get_pty=pty)
+            output = _read_channel(stdout.channel, threaded_on_text)
+            return stdout.channel.recv_exit_status(), output
+
+        return await asyncio.to_thread(run_blocking)
+
+    async def upload(self, files=(), contents=()) -> None:
+        def upload_blocking():
+            sftp = self.client.open_sftp()
+            try:
+                for path in _remote_dirs([*files, *((None, remote) for remote, _, _ in contents)]):
+                    try:
+                        sftp.stat(path)
+                    except IOError:
+                        sftp.mkdir(path, 0o700)
+                for local, remote in files:
+                    sftp.put(local, remote)
+                for remote, text, mode in contents:
+                    with sftp.open(remote, 'w') as f:
+                        f.write(text)
+                    sftp.chmod(remote, mode)
+            finally:
+                sftp.close()
+
+        await asyncio.to_thread(upload_blocking)
+
+    def is_alive(self) -> bool:
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    async def close(self) -> None:
+        self.client.close()
+
+
+class ParamikoBackend:
+    name = 'paramiko'
+
+    async def connect(self, node_details: dict, keepalive_interval: float = None) -> SSHSession:
+        return ParamikoSession(await asyncio.to_thread(connect_ssh_client, node_details, keepalive_interval))
+
+
+# --- asyncssh --- #
+class AsyncSSHSession(SSHSession):
+    """asyncssh connection living on the event loop."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def run(self, command: str, on_text=None, pty: bool = False):
+        import asyncssh
+
+        process = await self.conn.create_process(
+            command, term_type='xterm' if pty else None, stderr=asyncssh.STDOUT, encoding='utf-8', errors='replace'
+        )
+        chunks = []
+        async with process:
+            while True:
+                text = await process.stdout.read(32768)
+                if not text:
+                    break
+                chunks.append(text)
+                if on_text:
+                    on_text(text)
+            completed = await process.wait()
+        return completed.exit_status, ''.join(chunks)
+
+    async def upload(self, files=(), contents=()) -> None:
+        import asyncssh
+
+        async with self.conn.start_sftp_client() as sftp:
+            for path in _remote_dirs([*files, *((None, remote) for remote, _, _ in contents)]):
+                if not await sftp.exists(path):
+                    await sftp.mkdir(path, asyncssh.SFTPAttrs(permissions=0o700))
+            for local, remote in files:
+                await sftp.put(local, remote)
+            for remote, text, mode in contents:
+                async with sftp.open(remote, 'w') as f:
+                    await f.write(text)
+                await sftp.chmod(remote, mode)
+
+    def is_alive(self) -> bool:
+        return not self.conn.is_closed()
+
+    async def close(self) -> None:
+        self.conn.close()
+        await self.conn.wait_closed()
+
+
+class AsyncSSHBackend:
+    name = 'asyncssh'
+
+    async def connect(self, node_details: dict, keepalive_interval: float = None) -> SSHSession:
+        import asyncssh
+
+        client_keys = [asyncssh.import_private_key(node_details['key'])] if node_details.get('key') else None
+        conn = await asyncssh.connect(
+            node_details['ip'], port=int(node_details['port']), username=node_details['user'],
+            password=node_details.get('password') or None, client_keys=client_keys,
+            known_hosts=None, connect_timeout=SSH_CONNECT_TIMEOUT, keepalive_interval=keepalive_interval or 0,
+        )
+        return AsyncSSHSession(conn)
+
+
+SSH_BACKENDS = {'asyncssh': AsyncSSHBackend, 'paramiko': ParamikoBackend}
+
+_backends = {}
+
+
+def get_ssh_backend(name: str = None):
+    """Returns the named backend, or MARZBAN_SSH_BACKEND / asyncssh if installed / paramiko."""
+    name = name or SSH_BACKEND
+    if not name:
+        try:
+            import asyncssh # noqa: F401
+            name = 'asyncssh'
+        except ImportError:
+            name = 'paramiko'
+    if name not in SSH_BACKENDS:
+        raise ValueError(f"Unknown SSH backend {name!r}, expected one of {', '.join(SSH_BACKENDS)}")
+    if name not in _backends:
+        _backends[name] = SSH_BACKENDS[name]()
+        logger.info(f"Using the {name} SSH backend")
+    return _backends[name]
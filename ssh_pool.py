@@ -0,0 +1,158 @@
+"""Pool of warm SSH sessions to provisioned nodes.
+
+Sessions are keyed by (ip, port, user) and shared by concurrent operations (SSH
+multiplexes channels). Idle sessions are closed after SSH_POOL_IDLE_TIMEOUT,
+transport keepalives detect dead peers, and a session is health-checked before
+being handed out again after a quiet period. At most SSH_POOL_MAX_SESSIONS are
+open at once; the least recently used idle session is evicted to make room.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import time
+
+from ssh_backends import get_ssh_backend
+
+logger = logging.getLogger(__name__)
+
+SSH_POOL_IDLE_TIMEOUT = float(os.environ.get("SSH_POOL_IDLE_TIMEOUT", "300"))
+SSH_POOL_MAX_SESSIONS = int(os.environ.get("SSH_POOL_MAX_SESSIONS", "50"))
+SSH_POOL_KEEPALIVE = float(os.environ.get("SSH_POOL_KEEPALIVE", "30"))
+# Sessions unused for longer than this run a no-op command before being reused
+SSH_POOL_HEALTH_CHECK_AFTER = 60
+SSH_POOL_HEALTH_CHECK_TIMEOUT = 5
+
+
+def session_key(node_details: dict) -> tuple:
+    return node_details['ip'], int(node_details['port']), node_details['user']
+
+
+class SSHConnectionPool:
+    """Keyed pool of SSH sessions with idle timeout, size limit, keepalives and health checks."""
+
+    def __init__(self, backend=None, idle_timeout: float = SSH_POOL_IDLE_TIMEOUT,
+                 max_sessions: int = SSH_POOL_MAX_SESSIONS, keepalive_interval: float = SSH_POOL_KEEPALIVE):
+        self.backend = backend
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.keepalive_interval = keepalive_interval
+        # key -> {'session', 'last_used', 'in_use'}
+        self._entries = {}
+        self._key_locks = {}
+        self._connecting = 0
+        self._released = asyncio.Condition()
+        self._reaper = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @contextlib.asynccontextmanager
+    async def session(self, node_details: dict):
+        """Yields a connected session to the node, opening one if no healthy session is pooled."""
+        key = session_key(node_details)
+        entry = await self._acquire(key, node_details)
+        try:
+            yield entry['session']
+        finally:
+            entry['in_use'] -= 1
+            entry['last_used'] = time.monotonic()
+            if not entry['session'].is_alive():
+                await self._discard(key, entry)
+            async with self._released:
+                self._released.notify_all()
+
+    async def adopt(self, node_details: dict, session) -> None:
+        """Takes over an already open session (e.g. left by provisioning); closes it if the pool is full."""
+        key = session_key(node_details)
+        if key in self._entries or not session.is_alive() or not self._evict_idle_if_full():
+            await session.close()
+            return
+        self._entries[key] = {'session': session, 'last_used': time.monotonic(), 'in_use': 0}
+        self._start_reaper()
+
+    async def _acquire(self, key: tuple, node_details: dict) -> dict:
+        async with self._key_locks.setdefault(key, asyncio.Lock()):
+            entry = self._entries.get(key)
+            if entry and not await self._healthy(entry):
+                await self._discard(key, entry)
+                entry = None
+            if entry is None:
+                await self._wait_for_room()
+                self._connecting += 1
+                try:
+                    session = await (self.backend or get_ssh_backend()).connect(node_details, keepalive_interval=self.keepalive_interval)
+                finally:
+                    self._connecting -= 1
+                entry = {'session': session, 'last_used': time.monotonic(), 'in_use': 0}
+                self._entries[key] = entry
+                self._start_reaper()
+            entry['in_use'] += 1
+            return entry
+
+    async def _healthy(self, entry: dict) -> bool:
+        if not entry['session'].is_alive():
+            return False
+        if entry['in_use'] or time.monotonic() - entry['last_used'] < SSH_POOL_HEALTH_CHECK_AFTER:
+            return True
+        try:
+            exit_status, _ = await asyncio.wait_for(entry['session'].run('true'), SSH_POOL_HEALTH_CHECK_TIMEOUT)
+            return exit_status == 0
+        except Exception:
+            return False
+
+    def _evict_idle_if_full(self) -> bool:
+        """Makes room for one session by closing the least recently used idle one; False if all are busy."""
+        if len(self._entries) + self._connecting < self.max_sessions:
+            return True
+        idle = [(entry['last_used'], key) for key, entry in self._entries.items() if not entry['in_use']]
+        if not idle:
+            return False
+        _, key = min(idle)
+        entry = self._entries.pop(key)
+        asyncio.get_running_loop().create_task(entry['session'].close())
+        return True
+
+    async def _wait_for_room(self) -> None:
+        async with self._released:
+            await self._released.wait_for(self._evict_idle_if_full)
+
+    async def _discard(self, key: tuple, entry: dict) -> None:
+        if self._entries.get(key) is entry:
+            del self._entries[key]
+        try:
+            await entry['session'].close()
+        except Exception as e:
+            logger.debug(f"Closing SSH session to {key[0]} failed: {e}")
+
+    def _start_reaper(self) -> None:
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.get_running_loop().create_task(self._reap())
+
+    async def _reap(self) -> None:
+        while self._entries:
+            await asyncio.sleep(min(self.idle_timeout / 2, 30))
+            now = time.monotonic()
+            for key, entry in list(self._entries.items()):
+                if entry['in_use']:
+                    continue
+                if now - entry['last_used'] > self.idle_timeout or not entry['session'].is_alive():
+                    logger.info(f"Closing idle SSH session to {key[0]}")
+                    await self._discard(key, entry)
+
+    async def close(self) -> None:
+        if self._reaper:
+            self._reaper.cancel()
+        entries, self._entries = self._entries, {}
+        await asyncio.gather(*(entry['session'].close() for entry in entries.values()), return_exceptions=True)
+
+
+_pool = None
+
+
+def get_ssh_pool() -> SSHConnectionPool:
+    """Returns the process-wide SSH session pool."""
+    global _pool
+    if _pool is None:
+        _pool = SSHConnectionPool()
+    return _pool
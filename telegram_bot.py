@@ -1,18 +1,67 @@
 import logging
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
+    CallbackQueryHandler,
     filters,
     ContextTypes,
     ConversationHandler,
 )
-import json
 import os
-import asyncio # Added for to_thread
-import requests
-import paramiko
+import asyncio
+import functools
+import time
+
+from marzban_api import (
+    get_marzban_cert,
+    get_marzban_access_token,
+    get_marzban_nodes,
+    cert_fingerprint,
+    invalidate_panel_caches,
+    is_tls_error,
+    report_node_tls_failure,
+    close_panel_clients,
+    panel_key,
+)
+from panel_resilience import get_breaker, STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN
+from node_provisioning import provision_node, push_node_cert, OutputTail, STAGE_TOKEN, STAGE_CERT, STAGE_SSH, STAGE_API, STAGE_DONE
+from provisioning_jobs import ProvisioningQueue, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+from panel_registry import get_registry, node_record, node_ssh_details
+from bulk_onboarding import InventoryError, parse_inventory, format_summary, build_report
+from live_status import get_status_board
+from node_operations import NODE_LOGS_DEFAULT_LINES, ACTION_DELETE, ACTION_DISABLE, run_on_node, restart_node, node_logs, run_node_actions
+from node_upgrade import RollingUpgrade
+from ssh_pool import get_ssh_pool
+from health_monitor import HealthMonitor, STATE_UP, STATE_DOWN
+from node_directory import get_node_directory, node_rows
+from usage_collector import UsageCollector, parse_period
+from update_processing import ChatOrderedUpdateProcessor
+from webhook import BOT_WEBHOOK_URL, webhook_options
+from outbound_queue import OutboundScheduler
+from metrics import (
+    PROVISION_STAGE_SECONDS,
+    PROVISION_RESULTS,
+    SSH_STEP_SECONDS,
+    PANEL_REQUEST_SECONDS,
+    PANEL_RESPONSES,
+    PANEL_RETRIES,
+    PANEL_BREAKER_REJECTED,
+    HANDLER_SECONDS,
+    TELEGRAM_REQUEST_SECONDS,
+    TELEGRAM_RESPONSES,
+    start_metrics_server,
+)
+
+# Chat receiving node health alerts; defaults to the owner of the node's panel
+HEALTH_ALERT_CHAT_ID = os.environ.get("HEALTH_ALERT_CHAT_ID")
+# Seconds between the bot starting to receive updates and the background warm-up
+STARTUP_WARMUP_DELAY = float(os.environ.get("STARTUP_WARMUP_DELAY", "2"))
+# Self-hosted Bot API server (e.g. http://127.0.0.1:8081); api.telegram.org when unset
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL")
 
 # Enable logging
 logging.basicConfig(
@@ -20,42 +69,78 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def parse_admin_ids(value: str) -> set:
+    """Parses a comma or space separated list of Telegram user ids, skipping malformed entries."""
+    admin_ids = set()
+    for entry in value.replace(",", " ").split():
+        try:
+            admin_ids.add(int(entry))
+        except ValueError:
+            logger.warning(f"Ignoring malformed user id in BOT_ADMIN_IDS: {entry!r}")
+    return admin_ids
+
+# Telegram user ids allowed to manage every panel and to run commands on nodes (/node_*)
+BOT_ADMIN_IDS = parse_admin_ids(os.environ.get("BOT_ADMIN_IDS", ""))
+
 # States for conversation handler
-ADD_PANEL_DOMAIN, ADD_PANEL_PORT, ADD_PANEL_USERNAME, ADD_PANEL_PASSWORD, ADD_PANEL_HTTPS, CHOOSE_PANEL_FOR_NODE, ADD_NODE_IP, ADD_NODE_PORT, ADD_NODE_USER, ADD_NODE_PASSWORD, ADD_NODE_TO_PANEL_CONFIRM, EDIT_PANEL_CHOICE, EDIT_PANEL_FIELD, EDIT_PANEL_NEW_VALUE, DELETE_NODE_PANEL_CHOICE, DELETE_NODE_CHOICE = range(16) # Added new states
-
-# File to store panel data
-PANEL_DATA_FILE = "marzban_panels.json"
-
-# Helper function to load panel data
-def load_panel_data():
-    if os.path.exists(PANEL_DATA_FILE):
-        with open(PANEL_DATA_FILE, 'r') as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-    return {}
-
-# Helper function to save panel data
-def save_panel_data(data):
-    with open(PANEL_DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
-
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str = "عملیات با موفقیت انجام شد. گزینه مورد نظر را انتخاب کنید:"):
-    """Displays the main menu with inline keyboard."""
+ADD_PANEL_DOMAIN, ADD_PANEL_PORT, ADD_PANEL_USERNAME, ADD_PANEL_PASSWORD, ADD_PANEL_HTTPS, CHOOSE_PANEL_FOR_NODE, ADD_NODE_IP, ADD_NODE_PORT, ADD_NODE_USER, ADD_NODE_PASSWORD, ADD_NODE_TO_PANEL_CONFIRM, EDIT_PANEL_CHOICE, EDIT_PANEL_FIELD, EDIT_PANEL_NEW_VALUE, DELETE_NODE_PANEL_CHOICE, DELETE_NODE_CHOICE, BULK_CHOOSE_PANEL, BULK_UPLOAD = range(18)
+# State names used as handler latency labels
+STATE_NAMES = dict(enumerate((
+    'add_panel_domain', 'add_panel_port', 'add_panel_username', 'add_panel_password', 'add_panel_https',
+    'choose_panel_for_node', 'add_node_ip', 'add_node_port', 'add_node_user', 'add_node_password',
+    'add_node_to_panel_confirm', 'edit_panel_choice', 'edit_panel_field', 'edit_panel_new_value',
+    'delete_node_panel_choice', 'delete_node_choice', 'bulk_choose_panel', 'bulk_upload',
+)))
+
+def record_node(panel_name: str, node_details: dict, fingerprint: str) -> None:
+    """Remembers a provisioned node and the certificate it runs, for later certificate rotation."""
+    registry = get_registry()
+    if registry.get_panel(panel_name) is None:
+        return
+    registry.save_node(panel_name, node_details['ip'], node_record(node_details, fingerprint))
+
+def is_admin(user_id: int) -> bool:
+    return user_id in BOT_ADMIN_IDS
+
+def can_manage_panel(user_id: int, panel_name: str) -> bool:
+    """Whether a user may use a panel: its owner and the admins may; panels without an owner
+    (imported from the legacy JSON file) are left to the admins."""
+    registry = get_registry()
+    if registry.get_panel(panel_name) is None:
+        return False
+    return is_admin(user_id) or registry.panel_owner(panel_name) == user_id
+
+def owned_panel_names(user_id: int) -> list:
+    """Names of the panels a user may use (see can_manage_panel)."""
+    registry = get_registry()
+    if is_admin(user_id):
+        return registry.panel_names()
+    return list(registry.panels_by_owner(user_id))
+
+def panel_selection_keyboard(panel_names: list, callback_prefix: str) -> InlineKeyboardMarkup:
+    """Builds an inline keyboard with one button per stored panel plus a cancel button."""
+    keyboard = [[InlineKeyboardButton(name, callback_data=f"{callback_prefix}{name}")] for name in panel_names]
+    keyboard.append([InlineKeyboardButton("لغو", callback_data='cancel_operation')])
+    return InlineKeyboardMarkup(keyboard)
+
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str = "عملیات با موفقیت انجام شد. گزینه مورد نظر را انتخاب کنید:",
+                         new_message: bool = False):
+    """Displays the main menu with inline keyboard, editing the pressed message unless ``new_message`` is set."""
     keyboard = [
         [InlineKeyboardButton("افزودن پنل جدید", callback_data='add_panel')],
         [InlineKeyboardButton("افزودن نود جدید", callback_data='add_node')],
+        [InlineKeyboardButton("افزودن گروهی نود (فایل)", callback_data='bulk_add')],
         [InlineKeyboardButton("لیست پنل‌ها", callback_data='list_panels')],
-        # [InlineKeyboardButton("ویرایش پنل", callback_data='edit_panel_start')], # Placeholder for future
-        # [InlineKeyboardButton("حذف نود", callback_data='delete_node_start')], # Placeholder for future
+        [InlineKeyboardButton("لیست نودها", callback_data='nodes_page_0')],
+        [InlineKeyboardButton("ویرایش پنل", callback_data='edit_panel_start')],
+        [InlineKeyboardButton("حذف / غیرفعال‌سازی نودها", callback_data='delete_node_start')],
         [InlineKeyboardButton("لغو", callback_data='cancel_operation')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    if update.callback_query: # If called from a callback query, edit the message
+    if update.callback_query and not new_message: # If called from a callback query, edit the message
         await update.callback_query.edit_message_text(text=message_text, reply_markup=reply_markup)
     else: # If called from a command, send a new message
-        await update.message.reply_text(message_text, reply_markup=reply_markup)
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=message_text, reply_markup=reply_markup)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a welcome message when the /start command is issued and shows the main menu."""
@@ -80,27 +165,8 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             "عملیات لغو شد.", reply_markup=ReplyKeyboardRemove()
         )
     
-    # Show main menu after cancellation
-    # We need a way to send a new message if the original message for the menu was from a command
-    # For now, let's assume we always want to send a new message for the menu after cancel
-    # This might need adjustment based on how `show_main_menu` is called from `cancel`
-    # A simple way is to just call start again, or a dedicated function to show menu via new message
-    
-    # To avoid issues with context when cancelling from different states, 
-    # we send a new message for the main menu.
-    # A new update object is simulated for show_main_menu to send a new message.
-    class MockMessage:
-        async def reply_text(self, text, reply_markup):
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=reply_markup)
-    
-    class MockUpdate:
-        def __init__(self, effective_chat):
-            self.message = MockMessage()
-            self.callback_query = None # Ensure it sends a new message
-            self.effective_chat = effective_chat
-
-    mock_update = MockUpdate(update.effective_chat)
-    await show_main_menu(mock_update, context, "گزینه مورد نظر را انتخاب کنید:")
+    # The cancelled message keeps its text, the menu comes as a new message
+    await show_main_menu(update, context, "گزینه مورد نظر را انتخاب کنید:", new_message=True)
 
     context.user_data.clear()
     return ConversationHandler.END
@@ -157,15 +223,29 @@ async def add_panel_https(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     context.user_data['panel_https'] = True if text == 'بله (HTTPS)' else False
 
     panel_name = f"{context.user_data['panel_domain']}:{context.user_data['panel_port']}"
-    panels = load_panel_data()
-    panels[panel_name] = {
+    registry = get_registry()
+    existing_panel = registry.get_panel(panel_name)
+    if existing_panel and not can_manage_panel(update.effective_user.id, panel_name):
+        # Saving would hand the panel's recorded nodes (and their SSH credentials) to this user
+        logger.warning(f"User {update.effective_user.id} tried to re-add panel {panel_name} owned by someone else")
+        await update.message.reply_text(
+            f"پنل {panel_name} قبلاً توسط کاربر دیگری ثبت شده است و امکان ثبت مجدد آن وجود ندارد.",
+            reply_markup=ReplyKeyboardRemove(),
+        )
+        context.user_data.clear()
+        await show_main_menu(update, context, "گزینه مورد نظر را انتخاب کنید:")
+        return ConversationHandler.END
+    if existing_panel:
+        # Credentials may have changed, so don't keep using the old panel token and certificate
+        invalidate_panel_caches(existing_panel)
+        get_node_directory().invalidate(panel_name)
+    registry.save_panel(panel_name, {
         "domain": context.user_data['panel_domain'],
         "port": context.user_data['panel_port'],
         "username": context.user_data['panel_username'],
         "password": context.user_data['panel_password'],
         "https": context.user_data['panel_https']
-    }
-    save_panel_data(panels)
+    }, owner_id=update.effective_user.id)
 
     await update.message.reply_text(
         f"پنل {panel_name} با موفقیت ذخیره شد.",
@@ -177,12 +257,23 @@ async def add_panel_https(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return ConversationHandler.END
 
 # --- List Panels --- #
+BREAKER_STATE_LABELS = {STATE_CLOSED: "🟢 در دسترس", STATE_HALF_OPEN: "🟡 در حال بررسی مجدد", STATE_OPEN: "🔴 قطع"}
+
+def panel_breaker_text(panel_info: dict) -> str:
+    """Describes the circuit breaker state of a panel's API."""
+    breaker = get_breaker(panel_key(panel_info))
+    text = BREAKER_STATE_LABELS[breaker.state]
+    if breaker.state == STATE_OPEN:
+        text += f" (بررسی مجدد تا {breaker.retry_in():.0f} ثانیه دیگر: {breaker.last_error})"
+    return text
+
 async def list_panels_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     if query:
         await query.answer()
     
-    panels = load_panel_data()
+    registry = get_registry()
+    panels = {name: registry.get_panel(name) for name in owned_panel_names(update.effective_user.id)}
     if not panels:
         message_text = "هیچ پنل مرزبانی ذخیره نشده است. با دکمه 'افزودن پنل جدید' یک پنل اضافه کنید."
         if query:
@@ -195,7 +286,7 @@ async def list_panels_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE
     message = "پنل‌های ذخیره شده:\n"
     for name, data in panels.items():
         protocol = "HTTPS" if data.get('https', True) else "HTTP"
-        message += f"- نام: {name} (پروتکل: {protocol})\n"
+        message += f"- نام: {name} (پروتکل: {protocol}) - API: {panel_breaker_text(data)}\n"
     
     if query:
         await query.edit_message_text(text=message)
@@ -204,127 +295,359 @@ async def list_panels_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE
     await show_main_menu(update, context, "گزینه مورد نظر را انتخاب کنید:") # Show main menu
 
 
-# --- Marzban API and SSH Logic (adapted from curlscript.py) --- #
-async def get_marzban_access_token(panel_info: dict):
-    """Gets access token from Marzban panel."""
-    use_protocol = 'https' if panel_info['https'] else 'http'
-    url = f"{use_protocol}://{panel_info['domain']}:{panel_info['port']}/api/admin/token"
-    data = {
-        'username': panel_info['username'],
-        'password': panel_info['password']
-    }
-    try:
-        # Run blocking requests call in a separate thread
-        response = await asyncio.to_thread(requests.post, url, data=data, timeout=10)
-        response.raise_for_status()
-        access_token = response.json()['access_token']
-        logger.info(f"Successfully obtained access token for {panel_info['domain']}")
-        return access_token
-    except requests.exceptions.RequestException as e:
-        logger.error(f'Error obtaining access token for {panel_info["domain"]}: {e}')
-        return None
+# --- Cross-Panel Node Listing --- #
+NODES_PAGE_SIZE = 20
+NODE_STATUS_ICONS = {'connected': '🟢', 'connecting': '🟡', 'error': '🔴', 'disabled': '⚫️'}
 
-async def get_marzban_cert(panel_info: dict, access_token: str):
-    """Gets certificate from Marzban panel."""
-    use_protocol = 'https' if panel_info['https'] else 'http'
-    url = f"{use_protocol}://{panel_info['domain']}:{panel_info['port']}/api/node/settings"
-    headers = {
-        'accept': 'application/json',
-        'Authorization': f'Bearer {access_token}'
-    }
-    try:
-        response = await asyncio.to_thread(requests.get, url, headers=headers, timeout=10)
-        response.raise_for_status()
-        cert = response.json()["certificate"]
-        logger.info(f"Successfully retrieved certificate from {panel_info['domain']}")
-        return cert
-    except requests.exceptions.RequestException as e:
-        logger.error(f'Error retrieving certificate from {panel_info["domain"]}: {e}')
-        return None
+def render_nodes_page(directory: dict, page: int):
+    """Renders one page of the cross-panel node list with its navigation keyboard."""
+    rows = node_rows(directory)
+    pages = max(1, (len(rows) + NODES_PAGE_SIZE - 1) // NODES_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    connected = sum(1 for _, node in rows if node.get('status') == 'connected')
+    lines = [f"نودهای همه پنل‌ها: {connected}/{len(rows)} متصل (صفحه {page + 1}/{pages})"]
+    for panel_name, entry in sorted(directory.items()):
+        if entry['error']:
+            age = int(time.time() - entry['fetched_at'])
+            lines.append(f"⚠️ {panel_name}: {entry['error']}" + (f" (داده {age} ثانیه پیش)" if entry['nodes'] else ""))
+    current_panel = None
+    for panel_name, node in rows[page * NODES_PAGE_SIZE:(page + 1) * NODES_PAGE_SIZE]:
+        if panel_name != current_panel:
+            current_panel = panel_name
+            lines.append(f"\n{panel_name}:")
+        lines.append(f"{NODE_STATUS_ICONS.get(node.get('status'), '•')} {node.get('name', '-')} ({node.get('address', '-')}) - {node.get('status', '-')}")
 
-async def add_marzban_node_api(panel_info: dict, access_token: str, node_ip: str, add_as_host: bool = True):
-    """Adds a node to the Marzban panel via API."""
-    use_protocol = 'https' if panel_info['https'] else 'http'
-    url = f"{use_protocol}://{panel_info['domain']}:{panel_info['port']}/api/node"
-    node_information = {
-        "name": f"{node_ip}",
-        "address": f"{node_ip}",
-        "port": 62050, # Default Marzban-node port
-        "api_port": 62051, # Default Marzban-node API port
-        "add_as_new_host": add_as_host,
-        "usage_coefficient": 1
-    }
-    headers = {
-        'accept': 'application/json',
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ قبلی", callback_data=f'nodes_page_{page - 1}'))
+    navigation.append(InlineKeyboardButton("🔄", callback_data=f'nodes_refresh_{page}'))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("بعدی ▶️", callback_data=f'nodes_page_{page + 1}'))
+    return "\n".join(lines), InlineKeyboardMarkup([navigation])
+
+async def nodes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/nodes: lists the nodes of every panel of the user, paginated."""
+    panel_names = owned_panel_names(update.effective_user.id)
+    if not panel_names:
+        await update.message.reply_text("هیچ پنل مرزبانی ذخیره نشده است.")
+        return
+    text, reply_markup = render_nodes_page(await get_node_directory().get(panel_names=panel_names), 0)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def nodes_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handles the page and refresh buttons of the /nodes list."""
+    query = update.callback_query
+    await query.answer()
+    action, page = query.data.rsplit('_', 1)
+    directory = await get_node_directory().get(force=action == 'nodes_refresh', panel_names=owned_panel_names(update.effective_user.id))
+    text, reply_markup = render_nodes_page(directory, int(page))
     try:
-        response = await asyncio.to_thread(requests.post, url, json=node_information, headers=headers, timeout=15)
-        response.raise_for_status()
-        logger.info(f"Node {node_ip} added successfully to panel {panel_info['domain']}")
-        return True
-    except requests.exceptions.RequestException as e:
-        logger.error(f'Error adding node {node_ip} to panel {panel_info["domain"]}: {e}')
-        return False
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+    except TelegramError as e:
+        if 'not modified' not in str(e).lower():
+            raise
 
-async def execute_ssh_commands_on_node(node_details: dict, cert_info: str):
-    """Connects to a node via SSH and executes setup commands."""
-    commands = [
-        'sudo ufw disable',
-        'sudo apt-get update && sudo apt-get install -y curl git', # Ensure curl and git are installed
-        # Check if docker group exists, if not create it. Then add user to docker group.
-        # This might require a session restart for the group changes to take effect for non-sudo docker commands.
-        # However, we will continue to use sudo for docker commands to ensure they run.
-        f"getent group docker || sudo groupadd docker",
-        f"sudo usermod -aG docker {node_details['user']}", 
-        # The following command attempts to apply group changes immediately for the current session.
-        # This is shell-specific and might not work as expected in all environments or with paramiko.
-        # 'newgrp docker || true', # This command replaces the current shell, which can be problematic.
-                                 # It's safer to rely on sudo for docker commands throughout the script.
-
-        'curl -fsSL https://get.docker.com | sudo sh', # Ensure Docker is installed with sudo
-        # Ensure Marzban-node directory can be removed and re-cloned
-        'cd /tmp && sudo rm -rf Marzban-node', # Operate in /tmp to avoid permission issues in home dir, and ensure sudo for rm
-        'cd /tmp && git clone https://github.com/Gozargah/Marzban-node',
-        'cd /tmp/Marzban-node && sudo docker compose up -d && sudo docker compose down && sudo rm -f docker-compose.yml', # Ensure sudo for docker and rm
-        # Ensure the directory exists and user has write permission, or use sudo tee
-        'sudo mkdir -p /var/lib/marzban-node', # Ensure directory exists
-        f'echo "{cert_info}" | sudo tee /var/lib/marzban-node/ssl_client_cert.pem > /dev/null',
-        'cd /tmp/Marzban-node && echo \'services:\n  marzban-node:\n    image: gozargah/marzban-node:latest\n    restart: always\n    network_mode: host\n    environment:\n      SSL_CERT_FILE: "/var/lib/marzban-node/ssl_cert.pem"\n      SSL_KEY_FILE: "/var/lib/marzban-node/ssl_key.pem"\n      SSL_CLIENT_CERT_FILE: "/var/lib/marzban-node/ssl_client_cert.pem"\n    volumes:\n      - /var/lib/marzban-node:/var/lib/marzban-node\' | sudo tee docker-compose.yml > /dev/null && sudo docker compose up -d'
+# --- Traffic Usage --- #
+def format_bytes(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024 or unit == 'TB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{int(size)} B"
+        size /= 1024
+
+async def usage_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/usage [panel] [period]: shows per-node traffic over a period (e.g. 24h, 7d, 3m)."""
+    panel_name, period_text = None, '24h'
+    for arg in context.args:
+        if parse_period(arg):
+            period_text = arg
+        else:
+            panel_name = arg
+    if panel_name and not can_manage_panel(update.effective_user.id, panel_name):
+        await update.message.reply_text(f"پنل نامعتبر: {panel_name}\nاستفاده: /usage [panel] [24h|7d|3m]")
+        return
+
+    collector = context.application.bot_data['usage_collector']
+    totals = {}
+    for name in [panel_name] if panel_name else owned_panel_names(update.effective_user.id):
+        totals.update(collector.totals(parse_period(period_text), name))
+    if not totals:
+        await update.message.reply_text(f"ترافیکی در {period_text} گذشته ثبت نشده است.")
+        return
+    rows = sorted(totals.items(), key=lambda item: item[1][0] + item[1][1], reverse=True)
+    up_total = sum(up for up, _ in totals.values())
+    down_total = sum(down for _, down in totals.values())
+    lines = [f"ترافیک {period_text} گذشته{' پنل ' + panel_name if panel_name else ''}: ⬆️ {format_bytes(up_total)} ⬇️ {format_bytes(down_total)}"]
+    for (node_panel, node_name), (up, down) in rows:
+        label = node_name if panel_name else f"{node_name} ({node_panel})"
+        lines.append(f"• {label}: ⬆️ {format_bytes(up)} ⬇️ {format_bytes(down)}")
+    text = "\n".join(lines)
+    await update.message.reply_text(text if len(text) <= 4000 else text[:3990] + "\n...")
+
+# --- Performance Stats --- #
+def format_latency(seconds) -> str:
+    if seconds is None:
+        return "-"
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.1f}s"
+
+def histogram_lines(histogram, label, limit: int = 10) -> list:
+    """Formats the slowest label sets of a histogram (by p95) as p50/p95/p99 lines."""
+    rows = sorted(histogram.summary(), key=lambda row: row[4] or 0, reverse=True)
+    lines = [
+        f"• {label(labels)}: {format_latency(p50)} / {format_latency(p95)} / {format_latency(p99)} ({count})"
+        for labels, count, _, p50, p95, p99 in rows[:limit]
     ]
+    if len(rows) > limit:
+        lines.append(f"... و {len(rows) - limit} مورد دیگر")
+    return lines or ["• داده‌ای ثبت نشده است"]
 
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    command_output = []
-    try:
-        def connect_and_exec():
-            client.connect(node_details['ip'], port=int(node_details['port']), username=node_details['user'], password=node_details['password'], timeout=10)
-            for command in commands:
-                logger.info(f"Executing on {node_details['ip']}: {command}")
-                stdin, stdout, stderr = client.exec_command(command, get_pty=True) # get_pty for sudo
-                # Wait for command completion
-                exit_status = stdout.channel.recv_exit_status()
-                cmd_out = stdout.read().decode()
-                cmd_err = stderr.read().decode()
-                log_msg = f"CMD: {command}\nEXIT_STATUS: {exit_status}\nSTDOUT: {cmd_out}\nSTDERR: {cmd_err}"
-                logger.info(log_msg)
-                command_output.append(log_msg)
-                if exit_status != 0:
-                    logger.error(f"Command '{command}' failed on {node_details['ip']} with exit status {exit_status}.")
-                    # raise Exception(f"Command failed: {command}. Error: {cmd_err}") # Optionally raise to stop further execution
-                    return False # Indicate failure
-            return True # Indicate success
-        
-        success = await asyncio.to_thread(connect_and_exec)
-        return success, "\n".join(command_output)
+def counter_line(counter, label) -> str:
+    counts = {}
+    for key, value in counter.values.items():
+        name = label(dict(zip(counter.labelnames, key)))
+        counts[name] = counts.get(name, 0) + value
+    return "، ".join(f"{name}: {int(value)}" for name, value in sorted(counts.items())) or "-"
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/stats: summarizes latency percentiles recorded since the bot started (admins only)."""
+    if not is_admin(update.effective_user.id):
+        # The panel labels name every user's panels
+        await update.message.reply_text("این دستور فقط برای مدیران ربات (BOT_ADMIN_IDS) فعال است.")
+        return
+    sections = [
+        "📊 آمار عملکرد از زمان راه‌اندازی (p50 / p95 / p99 و تعداد)",
+        "\nمراحل افزودن نود:",
+        *histogram_lines(PROVISION_STAGE_SECONDS, lambda l: f"{l['stage']} ({l['outcome']})"),
+        f"نتایج: {counter_line(PROVISION_RESULTS, lambda l: l['result'])}",
+        "\nکندترین مراحل SSH:",
+        *histogram_lines(SSH_STEP_SECONDS, lambda l: f"{l['step']} ({l['outcome']})"),
+        "\nدرخواست‌های API پنل:",
+        *histogram_lines(PANEL_REQUEST_SECONDS, lambda l: f"{l['panel']} {l['method']} {l['endpoint']}"),
+        f"کدهای پاسخ پنل: {counter_line(PANEL_RESPONSES, lambda l: l['status'])}",
+        f"تلاش‌های مجدد: {counter_line(PANEL_RETRIES, lambda l: l['panel'])}",
+        f"رد شده توسط قطع‌کننده مدار: {counter_line(PANEL_BREAKER_REJECTED, lambda l: l['panel'])}",
+        "\nهندلرهای ربات:",
+        *histogram_lines(HANDLER_SECONDS, lambda l: f"{l['handler']} [{l['state']}]"),
+        "\nدرخواست‌های API تلگرام:",
+        *histogram_lines(TELEGRAM_REQUEST_SECONDS, lambda l: l['method']),
+        f"کدهای پاسخ تلگرام: {counter_line(TELEGRAM_RESPONSES, lambda l: l['status'])}",
+    ]
+    text = "\n".join(sections)
+    await update.message.reply_text(text if len(text) <= 4000 else text[:3990] + "\n...")
+
+# --- Certificate Rotation --- #
+# Shown for recorded nodes the bot can't reach over SSH (see panel_registry)
+MISSING_CREDENTIALS_TEXT = "اطلاعات ورود SSH این نود ذخیره نشده است. NODE_CREDENTIALS_KEY را تنظیم کرده و نود را دوباره اضافه کنید."
+
+def stale_cert_nodes(nodes: dict, fingerprint: str) -> list:
+    """Returns the addresses of recorded nodes that run a different certificate."""
+    return [
+        address for address, node in nodes.items()
+        if node.get('cert_fingerprint') != fingerprint
+    ]
+
+async def rotate_cert_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/rotate_cert [panel]: pushes the panel's current certificate to nodes running a stale one."""
+    registry = get_registry()
+    user_id = update.effective_user.id
+    panel_names = context.args or owned_panel_names(user_id)
+    unknown = [name for name in panel_names if not can_manage_panel(user_id, name)]
+    if unknown:
+        await update.message.reply_text(f"پنل(های) نامعتبر: {', '.join(unknown)}")
+        return
+
+    report = []
+    for panel_name in panel_names:
+        panel_info = registry.get_panel(panel_name)
+        # Nodes failing TLS with the panel mean our cached certificate may be outdated
+        for node in await get_marzban_nodes(panel_info) or []:
+            if node.get('status') == 'error' and is_tls_error(node.get('message')):
+                report_node_tls_failure(panel_info, node.get('address'))
+
+        cert_info = await get_marzban_cert(panel_info)
+        if not cert_info:
+            report.append(f"{panel_name}: خطا در دریافت گواهی")
+            continue
+        fingerprint = cert_fingerprint(cert_info)
+
+        nodes = registry.nodes(panel_name)
+        stale = stale_cert_nodes(nodes, fingerprint)
+        if not stale:
+            report.append(f"{panel_name}: همه نودها گواهی به‌روز دارند")
+            continue
+
+        for address in stale:
+            node_details = node_ssh_details(address, nodes[address])
+            if node_details is None:
+                report.append(f"{panel_name} / {address}: {MISSING_CREDENTIALS_TEXT}")
+                continue
+            success, output = await push_node_cert(node_details, cert_info)
+            if success:
+                registry.update_node(panel_name, address, cert_fingerprint=fingerprint)
+                report.append(f"{panel_name} / {address}: گواهی جدید اعمال شد")
+            else:
+                logger.error(f"Certificate rotation failed on {address}:\n{output}")
+                report.append(f"{panel_name} / {address}: خطا در اعمال گواهی")
+
+    await update.message.reply_text("نتیجه بروزرسانی گواهی:\n" + "\n".join(report))
+
+# --- Node Operations --- #
+def managed_node(update: Update, address: str):
+    """Returns the node recorded at ``address`` on a panel the user may use."""
+    for panel_name, node in get_registry().find_node(address):
+        if can_manage_panel(update.effective_user.id, panel_name):
+            return node
+    return None
+
+def output_tail_text(output: str, limit: int = 3500) -> str:
+    output = output.replace('\r', '').strip()
+    return output if len(output) <= limit else "...\n" + output[-limit:]
+
+async def reply_node_operation(update: Update, address: str, operation, title: str) -> None:
+    """Runs ``operation(node_details)`` on a managed node and replies with its exit status and output."""
+    if not is_admin(update.effective_user.id):
+        # These run as the node's SSH user, usually root, so they are limited to BOT_ADMIN_IDS
+        logger.warning(f"User {update.effective_user.id} is not an admin, refused {title} on {address}")
+        await update.message.reply_text("این دستور فقط برای مدیران ربات (BOT_ADMIN_IDS) فعال است.")
+        return
+    node = managed_node(update, address)
+    if node is None:
+        await update.message.reply_text(f"نودی با آدرس {address} پیدا نشد.")
+        return
+    node_details = node_ssh_details(address, node)
+    if node_details is None:
+        await update.message.reply_text(f"{address}: {MISSING_CREDENTIALS_TEXT}")
+        return
+    try:
+        exit_status, output = await operation(node_details)
+    except asyncio.TimeoutError:
+        await update.message.reply_text(f"{title} روی {address}: زمان اجرا به پایان رسید.")
+        return
     except Exception as e:
-        logger.error(f"SSH connection or command execution failed for {node_details['ip']}: {e}")
-        command_output.append(f"Error: {str(e)}")
-        return False, "\n".join(command_output)
+        logger.error(f"Node operation on {address} failed: {e}")
+        await update.message.reply_text(f"{title} روی {address}: خطا در اتصال SSH: {e}")
+        return
+    status = "✅" if exit_status == 0 else f"❌ (کد خروج {exit_status})"
+    text = f"{title} روی {address}: {status}"
+    if output.strip():
+        text += "\n" + output_tail_text(output)
+    await update.message.reply_text(text)
+
+async def node_restart_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/node_restart <ip>: restarts the marzban-node container of a node."""
+    if not context.args:
+        await update.message.reply_text("استفاده: /node_restart <آدرس نود>")
+        return
+    await reply_node_operation(update, context.args[0], restart_node, "راه‌اندازی مجدد نود")
+
+async def node_logs_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/node_logs <ip> [lines]: shows the latest marzban-node container logs."""
+    if not context.args or (len(context.args) > 1 and not context.args[1].isdigit()):
+        await update.message.reply_text("استفاده: /node_logs <آدرس نود> [تعداد خطوط]")
+        return
+    lines = int(context.args[1]) if len(context.args) > 1 else NODE_LOGS_DEFAULT_LINES
+    await reply_node_operation(update, context.args[0], lambda node_details: node_logs(node_details, lines), "لاگ نود")
+
+async def node_exec_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/node_exec <ip> <command>: runs a shell command on a node."""
+    parts = update.message.text.split(None, 2)
+    if len(parts) < 3:
+        await update.message.reply_text("استفاده: /node_exec <آدرس نود> <دستور>")
+        return
+    address, command = parts[1], parts[2]
+    logger.info(f"User {update.effective_user.id} runs on {address}: {command}")
+    await reply_node_operation(update, address, lambda node_details: run_on_node(node_details, command), "اجرای دستور")
+
+# --- Rolling Upgrade --- #
+async def upgrade_nodes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/upgrade_nodes [panel]: upgrades the marzban-node containers of a panel (default: all your panels) in waves."""
+    registry = get_registry()
+    user_id = update.effective_user.id
+    panel_names = context.args or owned_panel_names(user_id)
+    invalid = [name for name in panel_names if not can_manage_panel(user_id, name)]
+    if invalid:
+        await update.message.reply_text(f"پنل(های) نامعتبر: {', '.join(invalid)}")
+        return
+    running = context.application.bot_data.get('node_upgrade')
+    if running and not running.finished:
+        await update.message.reply_text("یک ارتقای دیگر در حال اجراست. لطفاً تا پایان آن صبر کنید.")
+        return
+
+    targets, seen, missing = [], set(), []
+    for panel_name in panel_names:
+        panel_info = registry.get_panel(panel_name)
+        for address, node in registry.nodes(panel_name).items():
+            # A node recorded on several panels runs a single container
+            if address in seen:
+                continue
+            seen.add(address)
+            node_details = node_ssh_details(address, node)
+            if node_details is None:
+                missing.append(address)
+                continue
+            targets.append({'panel': panel_name, 'panel_info': panel_info, 'address': address, 'node_details': node_details})
+    skipped_text = f"\n{len(missing)} نود بدون اطلاعات ورود SSH کنار گذاشته شد: {', '.join(missing[:10])}" if missing else ""
+    if not targets:
+        await update.message.reply_text("نودی برای ارتقا ثبت نشده است." + skipped_text)
+        return
+
+    upgrade = context.application.bot_data['node_upgrade'] = RollingUpgrade(targets)
+    message = await update.message.reply_text(f"ارتقای {len(targets)} نود ({', '.join(panel_names)}): دریافت ایمیج جدید...{skipped_text}")
+    logger.info(f"User {user_id} started a rolling upgrade of {len(targets)} nodes on {', '.join(panel_names)}")
+    # Run in the background so the bot keeps serving other updates meanwhile
+    context.application.create_task(run_upgrade_job(upgrade, message, f"ارتقای نودهای {', '.join(panel_names)}"))
+
+async def run_upgrade_job(upgrade: RollingUpgrade, message, title: str) -> None:
+    """Runs a rolling upgrade, keeping one summary message up to date."""
+    board = get_status_board()
+    board.track(message, lambda: upgrade.summary(title))
+    try:
+        await upgrade.run()
     finally:
-        client.close()
+        await board.finish(message, upgrade.summary(title))
+
+# --- Node Health --- #
+HEALTH_STATE_ICONS = {STATE_UP: '🟢', STATE_DOWN: '🔴', None: '⚪️'}
+
+def format_rtt(rtt) -> str:
+    return f"{rtt:.0f}ms" if rtt is not None else "-"
+
+async def health_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/health [panel]: shows the state and connect latency of monitored nodes."""
+    monitor = context.application.bot_data['health_monitor']
+    panel_name = context.args[0] if context.args else None
+    if panel_name and not can_manage_panel(update.effective_user.id, panel_name):
+        await update.message.reply_text(f"پنل نامعتبر: {panel_name}")
+        return
+    panel_names = set(owned_panel_names(update.effective_user.id))
+    report = [row for row in monitor.report(panel_name) if row[0] in panel_names]
+    if not report:
+        await update.message.reply_text("هنوز نودی بررسی نشده است.")
+        return
+    up = sum(1 for _, _, entry, _ in report if entry['state'] == STATE_UP)
+    lines = [f"سلامت نودها: {up}/{len(report)} فعال (p50 / p95 / از دست رفته)"]
+    current_panel = None
+    for node_panel, address, entry, stats in report:
+        if node_panel != current_panel:
+            current_panel = node_panel
+            panel_info = get_registry().get_panel(node_panel)
+            lines.append(f"\n{node_panel}:" + (f" (API: {panel_breaker_text(panel_info)})" if panel_info else ""))
+        line = f"{HEALTH_STATE_ICONS.get(entry['state'], '•')} {address}  {format_rtt(stats['p50'])} / {format_rtt(stats['p95'])} / {stats['loss']:.0%}"
+        if entry['reason']:
+            line += f"  ({entry['reason']})"
+        lines.append(line)
+    text = "\n".join(lines)
+    await update.message.reply_text(text if len(text) <= 4000 else text[:3990] + "\n...")
+
+async def send_health_alert(application: Application, panel_name: str, address: str, old_state, new_state, reason: str) -> None:
+    """Notifies the alert chat (or the panel owner) when a node goes down or recovers."""
+    chat_id = HEALTH_ALERT_CHAT_ID or get_registry().panel_owner(panel_name)
+    if not chat_id:
+        return
+    if new_state == STATE_DOWN:
+        text = f"🔴 نود {address} در پنل {panel_name} از دسترس خارج شد: {reason}"
+    else:
+        text = f"🟢 نود {address} در پنل {panel_name} دوباره در دسترس است."
+    await application.bot.send_message(chat_id=chat_id, text=text)
 
 # --- Add Node Conversation --- # 
 async def add_node_start_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -332,8 +655,8 @@ async def add_node_start_wrapper(update: Update, context: ContextTypes.DEFAULT_T
     if query:
         await query.answer()
 
-    panels = load_panel_data()
-    if not panels:
+    panel_names = owned_panel_names(update.effective_user.id)
+    if not panel_names:
         message_text = "ابتدا باید یک پنل مرزبان اضافه کنید. از دکمه 'افزودن پنل جدید' استفاده کنید."
         if query:
             await query.edit_message_text(text=message_text, reply_markup=None) # Remove keyboard if any
@@ -343,9 +666,7 @@ async def add_node_start_wrapper(update: Update, context: ContextTypes.DEFAULT_T
         return ConversationHandler.END
 
     # Using InlineKeyboardMarkup for panel selection
-    keyboard = [[InlineKeyboardButton(name, callback_data=f"select_panel_for_node_{name}")] for name in panels.keys()]
-    keyboard.append([InlineKeyboardButton("لغو", callback_data='cancel_operation')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = panel_selection_keyboard(panel_names, "select_panel_for_node_")
     
     message_text = "لطفاً پنلی را که می‌خواهید نود به آن اضافه شود انتخاب کنید:"
     if query:
@@ -360,21 +681,20 @@ async def choose_panel_for_node(update: Update, context: ContextTypes.DEFAULT_TY
     await query.answer()
     
     chosen_panel_name = query.data.replace("select_panel_for_node_", "")
-    panels = load_panel_data()
+    registry = get_registry()
+    chosen_panel = registry.get_panel(chosen_panel_name)
 
-    if chosen_panel_name not in panels:
+    if chosen_panel is None or not can_manage_panel(update.effective_user.id, chosen_panel_name):
         await query.edit_message_text(
             text="پنل انتخاب شده معتبر نیست. لطفاً دوباره تلاش کنید."
         )
         # Go back to panel selection or show main menu
         # For simplicity, let's reshow panel selection
-        keyboard = [[InlineKeyboardButton(name, callback_data=f"select_panel_for_node_{name}")] for name in panels.keys()]
-        keyboard.append([InlineKeyboardButton("لغو", callback_data='cancel_operation')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = panel_selection_keyboard(owned_panel_names(update.effective_user.id), "select_panel_for_node_")
         await query.message.reply_text("لطفاً پنلی را که می‌خواهید نود به آن اضافه شود انتخاب کنید:", reply_markup=reply_markup)
         return CHOOSE_PANEL_FOR_NODE
     
-    context.user_data['chosen_panel'] = panels[chosen_panel_name]
+    context.user_data['chosen_panel'] = chosen_panel
     context.user_data['chosen_panel_name'] = chosen_panel_name
     await query.edit_message_text(
         text=f"شما پنل '{chosen_panel_name}' را انتخاب کردید.\n"
@@ -399,9 +719,22 @@ async def add_node_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     await update.message.reply_text("لطفاً رمز عبور سرور نود را وارد کنید:")
     return ADD_NODE_PASSWORD
 
+def render_ssh_status(node_ip: str, output_tail: OutputTail, finished: bool = False) -> str:
+    """Text of the live status message shown while a node's setup script runs."""
+    minutes, seconds = divmod(int(output_tail.elapsed()), 60)
+    step = output_tail.current_step + 1 if output_tail.current_step is not None else 0
+    header = "پایان اجرای دستورات" if finished else "در حال اجرای دستورات"
+    text = (
+        f"{header} روی نود {node_ip}\n"
+        f"مرحله {step}/{len(output_tail.steps)}: {output_tail.step_name}\n"
+        f"زمان سپری شده: {minutes:02d}:{seconds:02d}\n\n"
+        f"{output_tail.tail()}"
+    )
+    return text[:4000]
+
 async def add_node_password(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['node_password'] = update.message.text
-    panel_info = context.user_data['chosen_panel']
+    panel_name = context.user_data['chosen_panel_name']
     node_details = {
         'ip': context.user_data['node_ip'],
         'port': context.user_data['node_port'],
@@ -409,63 +742,636 @@ async def add_node_password(update: Update, context: ContextTypes.DEFAULT_TYPE)
         'password': context.user_data['node_password']
     }
 
+    # Provisioning takes minutes, so hand it to the job queue and free the conversation
+    queue = context.application.bot_data['provisioning_queue']
+    job_id = queue.enqueue(panel_name, node_details, update.effective_chat.id)
     await update.message.reply_text(
-        f"درحال پردازش درخواست شما برای افزودن نود {node_details['ip']} به پنل {context.user_data['chosen_panel_name']}... این عملیات ممکن است چند دقیقه طول بکشد."
+        f"درخواست افزودن نود {node_details['ip']} به پنل {panel_name} با شناسه #{job_id} در صف قرار گرفت. "
+        f"پیشرفت کار در همین گفتگو اطلاع داده می‌شود. وضعیت: /job {job_id}"
     )
+    context.user_data.clear()
+    return ConversationHandler.END
 
-    # 1. Get Marzban access token
-    access_token = await get_marzban_access_token(panel_info)
-    if not access_token:
-        await update.message.reply_text("خطا: امکان دریافت توکن دسترسی از پنل مرزبان وجود ندارد. لطفاً اطلاعات پنل را بررسی کنید.")
-        context.user_data.clear()
+# --- Provisioning Jobs --- #
+STAGE_LABELS = {
+    STAGE_TOKEN: "دریافت توکن پنل",
+    STAGE_CERT: "دریافت گواهی پنل",
+    STAGE_SSH: "اجرای دستورات روی سرور نود",
+    STAGE_API: "افزودن نود به پنل",
+    STAGE_DONE: "پایان",
+}
+
+JOB_STATE_ICONS = {JOB_QUEUED: '⏳', JOB_RUNNING: '🔄', JOB_DONE: '✅', JOB_FAILED: '❌'}
+
+def provisioning_result_text(result: dict, panel_name: str) -> str:
+    """User-facing summary of a finished provision_node run."""
+    node_ip = result['ip']
+    if result['success']:
+        return f"نود {node_ip} با موفقیت به پنل {panel_name} اضافه شد."
+    if result['stage'] == STAGE_TOKEN:
+        return "خطا: امکان دریافت توکن دسترسی از پنل مرزبان وجود ندارد. لطفاً اطلاعات پنل را بررسی کنید."
+    if result['stage'] == STAGE_CERT:
+        return "خطا: امکان دریافت گواهی از پنل مرزبان وجود ندارد."
+    if result['stage'] == STAGE_SSH:
+        return f"خطا در هنگام اجرای دستورات روی سرور نود {node_ip}. لطفاً لاگ‌ها را بررسی کنید.\n{result['output'][-500:]}"
+    return f"خطا در افزودن نود {node_ip} به پنل مرزبان. ممکن است سرور نود به درستی کانفیگ نشده باشد یا مشکلی در ارتباط با پنل وجود داشته باشد."
+
+async def run_provisioning_job(application: Application, job: dict, queue: ProvisioningQueue):
+    """Runner of the provisioning queue: provisions one node and reports to the job's chat."""
+    panel_info = get_registry().get_panel(job['panel_name'])
+    if panel_info is None:
+        return False, f"panel {job['panel_name']} no longer exists"
+
+    node_details = job['node_details']
+    # Jobs of a bulk upload are reported together, in the summary of their batch
+    notify = job['chat_id'] and job['batch_id'] is None
+    resumed = job['stage'] is not None
+    current = {'stage': job['stage'] or STAGE_TOKEN}
+    output_tail = OutputTail()
+    board = get_status_board()
+
+    def render():
+        header = f"کار #{job['id']}: افزودن نود {node_details['ip']} به پنل {job['panel_name']}"
+        if resumed:
+            header += " (ادامه پس از راه‌اندازی مجدد ربات)"
+        if current['stage'] == STAGE_SSH:
+            return f"{header}\n{render_ssh_status(node_details['ip'], output_tail)}"
+        return f"{header}\nمرحله: {STAGE_LABELS.get(current['stage'], current['stage'])}"
+
+    status_message = None
+    if notify:
+        try:
+            status_message = await application.bot.send_message(job['chat_id'], render())
+            board.track(status_message, render)
+        except TelegramError as e:
+            logger.warning(f"Could not send status of job {job['id']}: {e}")
+
+    async def progress(stage):
+        current['stage'] = stage
+        queue.set_stage(job['id'], stage)
+
+    async def on_checkpoint(stage, data):
+        queue.save_checkpoint(job['id'], stage, data)
+
+    started = time.monotonic()
+    try:
+        result = await provision_node(panel_info, node_details, progress, output_tail, job['checkpoints'], on_checkpoint)
+    finally:
+        if status_message:
+            await board.finish(status_message, render())
+    queue.save_result(job['id'], {
+        'stage': result['stage'], 'duration': time.monotonic() - started,
+        'output': result['output'][-300:], 'cert_fingerprint': result['cert_fingerprint'],
+    })
+
+    if result['success']:
+        record_node(job['panel_name'], node_details, result['cert_fingerprint'])
+    if notify:
+        try:
+            await application.bot.send_message(job['chat_id'], f"کار #{job['id']}: {provisioning_result_text(result, job['panel_name'])}")
+        except TelegramError as e:
+            logger.warning(f"Could not send result of job {job['id']}: {e}")
+    return result['success'], None if result['success'] else f"failed at stage {result['stage']}"
+
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/jobs: lists the latest provisioning jobs of this chat."""
+    queue = context.application.bot_data['provisioning_queue']
+    jobs = queue.recent(chat_id=update.effective_chat.id)
+    if not jobs:
+        await update.message.reply_text("هیچ کار نصبی ثبت نشده است.")
+        return
+    lines = ["آخرین کارهای نصب نود:"]
+    for job in jobs:
+        stage = STAGE_LABELS.get(job['stage'], job['stage'] or '-')
+        lines.append(f"{JOB_STATE_ICONS.get(job['state'], '•')} #{job['id']} {job['node_ip']} → {job['panel_name']} ({stage})")
+    await update.message.reply_text("\n".join(lines))
+
+async def job_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/job <id>: shows the state and checkpoints of one provisioning job."""
+    queue = context.application.bot_data['provisioning_queue']
+    if not context.args or not context.args[0].lstrip('#').isdigit():
+        await update.message.reply_text("استفاده: /job <شناسه کار>")
+        return
+    job = queue.get(int(context.args[0].lstrip('#')))
+    if job is None or job['chat_id'] != update.effective_chat.id:
+        await update.message.reply_text("کاری با این شناسه پیدا نشد.")
+        return
+    completed = [STAGE_LABELS.get(stage, stage) for stage in job['checkpoints']]
+    text = (
+        f"کار #{job['id']} {JOB_STATE_ICONS.get(job['state'], '')}\n"
+        f"نود: {job['node_ip']}\n"
+        f"پنل: {job['panel_name']}\n"
+        f"وضعیت: {job['state']}\n"
+        f"مرحله فعلی: {STAGE_LABELS.get(job['stage'], job['stage'] or '-')}\n"
+        f"مراحل انجام شده: {', '.join(completed) or '-'}\n"
+        f"ایجاد: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['created_at']))}\n"
+        f"آخرین تغییر: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['updated_at']))}"
+    )
+    if job['error']:
+        text += f"\nخطا: {job['error']}"
+    await update.message.reply_text(text)
+
+# --- Bulk Node Onboarding --- #
+async def bulk_add_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    if query:
+        await query.answer()
+
+    panel_names = owned_panel_names(update.effective_user.id)
+    if not panel_names:
+        message_text = "ابتدا باید یک پنل مرزبان اضافه کنید. از دکمه 'افزودن پنل جدید' استفاده کنید."
+        if query:
+            await query.edit_message_text(text=message_text)
+        else:
+            await update.message.reply_text(message_text)
+        await show_main_menu(update, context, "گزینه مورد نظر را انتخاب کنید:")
         return ConversationHandler.END
 
-    # 2. Get Marzban certificate
-    cert_info = await get_marzban_cert(panel_info, access_token)
-    if not cert_info:
-        await update.message.reply_text("خطا: امکان دریافت گواهی از پنل مرزبان وجود ندارد.")
-        context.user_data.clear()
+    reply_markup = panel_selection_keyboard(panel_names, "select_panel_for_bulk_")
+    message_text = "لطفاً پنلی را که می‌خواهید نودها به آن اضافه شوند انتخاب کنید:"
+    if query:
+        await query.edit_message_text(text=message_text, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(message_text, reply_markup=reply_markup)
+    return BULK_CHOOSE_PANEL
+
+async def bulk_choose_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+
+    chosen_panel_name = query.data.replace("select_panel_for_bulk_", "")
+    if not can_manage_panel(update.effective_user.id, chosen_panel_name):
+        await query.edit_message_text(text="پنل انتخاب شده معتبر نیست. لطفاً دوباره تلاش کنید.")
         return ConversationHandler.END
 
-    await update.message.reply_text("گواهی با موفقیت از پنل دریافت شد. در حال اجرای دستورات روی سرور نود...")
+    context.user_data['chosen_panel_name'] = chosen_panel_name
+    await query.edit_message_text(
+        text=f"شما پنل '{chosen_panel_name}' را انتخاب کردید.\n"
+        "لطفاً فایل CSV یا YAML لیست سرورها را ارسال کنید. هر ردیف شامل ip, port, user, password و key (اختیاری) است."
+    )
+    return BULK_UPLOAD
 
-    # 3. Execute SSH commands on the node server
-    # Assuming ADD_AS_HOST is always True for simplicity, or get it from user_data if needed
-    ssh_success, ssh_output = await execute_ssh_commands_on_node(node_details, cert_info)
-    
-    logger.info(f"SSH Execution Output for {node_details['ip']}:\n{ssh_output}")
-    # You might want to send parts of ssh_output to the user for debugging or progress
-    # await update.message.reply_text(f"خروجی اجرای دستورات SSH:\n```\n{ssh_output[:1000]}...\n```") # Be careful with message length
+async def bulk_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    document = update.message.document
+    panel_name = context.user_data['chosen_panel_name']
+    file = await document.get_file()
+    data = await file.download_as_bytearray()
 
-    if not ssh_success:
-        await update.message.reply_text(
-            f"خطا در هنگام اجرای دستورات روی سرور نود {node_details['ip']}. لطفاً لاگ‌ها را بررسی کنید.\n{ssh_output[-500:]}"
+    try:
+        nodes = parse_inventory(document.file_name or 'inventory.csv', bytes(data))
+    except InventoryError as e:
+        await update.message.reply_text(f"خطا در خواندن فایل: {e}\nلطفاً فایل اصلاح‌شده را دوباره ارسال کنید یا /cancel را بزنید.")
+        return BULK_UPLOAD
+
+    summary_message = await update.message.reply_text(f"{len(nodes)} سرور دریافت شد. شروع افزودن گروهی...")
+    # Every row becomes a job of the provisioning queue, so the batch survives restarts and
+    # shares the queue's global and per-panel limits with single additions
+    queue = context.application.bot_data['provisioning_queue']
+    batch_id = queue.enqueue_batch(panel_name, nodes, update.effective_chat.id)
+    context.application.bot_data.setdefault('bulk_messages', {})[batch_id] = summary_message
+    get_status_board().track(summary_message, lambda: format_summary(panel_name, batch_statuses(queue.batch_jobs(batch_id))))
+    logger.info(f"Bulk onboarding of {len(nodes)} nodes to panel {panel_name} queued as batch {batch_id}")
+    context.user_data.clear()
+    return ConversationHandler.END
+
+def batch_statuses(jobs: list) -> dict:
+    """``{ip: status}`` of the jobs of a batch, as shown by format_summary."""
+    statuses = {}
+    for job in jobs:
+        if job['state'] == JOB_DONE:
+            statuses[job['node_ip']] = 'done'
+        elif job['state'] == JOB_FAILED:
+            statuses[job['node_ip']] = 'failed'
+        elif job['state'] == JOB_RUNNING and job['stage']:
+            statuses[job['node_ip']] = job['stage']
+        else:
+            statuses[job['node_ip']] = 'queued'
+    return statuses
+
+def batch_results(jobs: list) -> list:
+    """Turns the finished jobs of a batch into the result dicts build_report expects."""
+    results = []
+    for job in jobs:
+        result = job['result'] or {}
+        results.append({
+            'ip': job['node_ip'],
+            'success': job['state'] == JOB_DONE,
+            'stage': result.get('stage', job['stage'] or '-'),
+            'duration': result.get('duration', 0),
+            'output': result.get('output', job['error'] or ''),
+            'cert_fingerprint': result.get('cert_fingerprint'),
+        })
+    return results
+
+async def finish_bulk_batch(application: Application, batch: dict, jobs: list) -> None:
+    """Finalizes the summary of a bulk upload and sends its CSV report."""
+    text = format_summary(batch['panel_name'], batch_statuses(jobs))
+    summary_message = application.bot_data.get('bulk_messages', {}).pop(batch['id'], None)
+    if summary_message:
+        await get_status_board().finish(summary_message, text)
+    results = batch_results(jobs)
+    succeeded = sum(1 for result in results if result['success'])
+    logger.info(f"Bulk onboarding batch {batch['id']} to panel {batch['panel_name']} finished: {succeeded}/{len(results)} succeeded")
+    if batch['chat_id']:
+        await application.bot.send_document(
+            chat_id=batch['chat_id'],
+            document=build_report(results),
+            filename="bulk_onboarding_report.csv",
+            caption=f"گزارش افزودن گروهی: {succeeded} موفق، {len(results) - succeeded} ناموفق از {len(results)} سرور.",
         )
-        context.user_data.clear()
+
+# --- Edit Panel Conversation --- #
+EDITABLE_PANEL_FIELDS = {
+    'domain': "دامنه یا IP",
+    'port': "پورت",
+    'username': "نام کاربری",
+    'password': "رمز عبور",
+    'https': "HTTPS",
+}
+
+async def edit_panel_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    if query:
+        await query.answer()
+
+    panel_names = owned_panel_names(update.effective_user.id)
+    if not panel_names:
+        message_text = "پنلی برای ویرایش وجود ندارد."
+        if query:
+            await query.edit_message_text(text=message_text)
+        else:
+            await update.message.reply_text(message_text)
+        await show_main_menu(update, context, "گزینه مورد نظر را انتخاب کنید:", new_message=True)
         return ConversationHandler.END
 
-    await update.message.reply_text(f"دستورات روی سرور نود {node_details['ip']} با موفقیت اجرا شدند. در حال افزودن نود به پنل مرزبان...")
+    reply_markup = panel_selection_keyboard(panel_names, "select_panel_for_edit_")
+    message_text = "لطفاً پنلی را که می‌خواهید ویرایش کنید انتخاب کنید:"
+    if query:
+        await query.edit_message_text(text=message_text, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(message_text, reply_markup=reply_markup)
+    return EDIT_PANEL_CHOICE
 
-    # 4. Add node to Marzban panel via API
-    # Determine ADD_AS_HOST, for now, let's assume True or get from user input earlier
-    add_as_host_preference = panel_info.get('add_as_new_host', True) # Example, ideally ask user or have a default
-    node_added_successfully = await add_marzban_node_api(panel_info, access_token, node_details['ip'], add_as_host_preference)
+async def edit_panel_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Stores the chosen panel and asks which field to change."""
+    query = update.callback_query
+    await query.answer()
 
-    if node_added_successfully:
-        await update.message.reply_text(
-            f"نود {node_details['ip']} با موفقیت به پنل {context.user_data['chosen_panel_name']} اضافه شد."
+    chosen_panel_name = query.data.replace("select_panel_for_edit_", "")
+    panel_info = get_registry().get_panel(chosen_panel_name)
+    if panel_info is None or chosen_panel_name not in owned_panel_names(update.effective_user.id):
+        await query.edit_message_text(text="پنل انتخاب شده معتبر نیست. لطفاً دوباره تلاش کنید.")
+        return ConversationHandler.END
+
+    context.user_data['chosen_panel_name'] = chosen_panel_name
+    keyboard = [[InlineKeyboardButton(label, callback_data=f"edit_field_{field}")] for field, label in EDITABLE_PANEL_FIELDS.items()]
+    keyboard.append([InlineKeyboardButton("لغو", callback_data='cancel_operation')])
+    protocol = "HTTPS" if panel_info.get('https', True) else "HTTP"
+    await query.edit_message_text(
+        text=f"پنل {chosen_panel_name}\n"
+        f"دامنه: {panel_info['domain']}\nپورت: {panel_info['port']}\nنام کاربری: {panel_info['username']}\nپروتکل: {protocol}\n\n"
+        "کدام مورد را می‌خواهید تغییر دهید؟",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+    )
+    return EDIT_PANEL_FIELD
+
+async def edit_panel_field(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Stores the field to change and asks for its new value."""
+    query = update.callback_query
+    await query.answer()
+
+    field = query.data.replace("edit_field_", "")
+    context.user_data['edit_field'] = field
+    if field == 'https':
+        await query.edit_message_text(text=f"تغییر پروتکل پنل {context.user_data['chosen_panel_name']}")
+        await query.message.reply_text(
+            "آیا پنل شما از HTTPS استفاده می‌کند؟",
+            reply_markup=ReplyKeyboardMarkup([['بله (HTTPS)'], ['خیر (HTTP)']], one_time_keyboard=True),
         )
     else:
-        await update.message.reply_text(
-            f"خطا در افزودن نود {node_details['ip']} به پنل مرزبان. ممکن است سرور نود به درستی کانفیگ نشده باشد یا مشکلی در ارتباط با پنل وجود داشته باشد."
-        )
+        await query.edit_message_text(text=f"{EDITABLE_PANEL_FIELDS[field]} جدید را وارد کنید:")
+    return EDIT_PANEL_NEW_VALUE
+
+async def edit_panel_new_value(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Saves the new value and checks that the panel still accepts the login."""
+    field = context.user_data['edit_field']
+    panel_name = context.user_data['chosen_panel_name']
+    text = update.message.text.strip()
+    if field == 'port' and not text.isdigit():
+        await update.message.reply_text("پورت باید عدد باشد. لطفاً دوباره وارد کنید:")
+        return EDIT_PANEL_NEW_VALUE
+    if field == 'https' and text not in ('بله (HTTPS)', 'خیر (HTTP)'):
+        await update.message.reply_text("لطفاً یکی از گزینه‌های «بله (HTTPS)» یا «خیر (HTTP)» را انتخاب کنید:")
+        return EDIT_PANEL_NEW_VALUE
 
-    logger.info(f"Node addition process completed for {node_details['ip']} to panel {context.user_data['chosen_panel_name']}")
+    registry = get_registry()
+    panel_info = registry.get_panel(panel_name)
+    if panel_info is None:
+        await update.message.reply_text("این پنل دیگر وجود ندارد.", reply_markup=ReplyKeyboardRemove())
+        context.user_data.clear()
+        return ConversationHandler.END
+    # The token, certificate and node list belong to the old settings
+    invalidate_panel_caches(panel_info)
+    get_node_directory().invalidate(panel_name)
+    panel_info[field] = text == 'بله (HTTPS)' if field == 'https' else text
+    # The panel keeps its name so its recorded nodes, jobs and traffic stay attached
+    registry.save_panel(panel_name, panel_info)
+    logger.info(f"Panel {panel_name}: {field} changed by user {update.effective_user.id}")
+
+    login_ok = await get_marzban_access_token(panel_info) is not None
+    await update.message.reply_text(
+        f"{EDITABLE_PANEL_FIELDS[field]} پنل {panel_name} تغییر کرد.\n"
+        + ("✅ ورود به پنل با اطلاعات جدید موفق بود." if login_ok else "⚠️ ورود به پنل با اطلاعات جدید ناموفق بود؛ اطلاعات را بررسی کنید."),
+        reply_markup=ReplyKeyboardRemove(),
+    )
     context.user_data.clear()
+    await show_main_menu(update, context)
     return ConversationHandler.END
 
+# --- Delete / Disable Nodes Conversation --- #
+NODE_SELECTION_PAGE_SIZE = 20
+NODE_ACTION_LABELS = {ACTION_DELETE: "حذف از پنل", ACTION_DISABLE: "غیرفعال‌سازی"}
+
+def render_node_selection(user_data: dict):
+    """Renders the multi-select list of a panel's nodes with its keyboard."""
+    nodes, selected = user_data['action_nodes'], user_data['action_selected']
+    pages = max(1, (len(nodes) + NODE_SELECTION_PAGE_SIZE - 1) // NODE_SELECTION_PAGE_SIZE)
+    page = user_data['action_page'] = min(max(user_data.get('action_page', 0), 0), pages - 1)
+    page_nodes = nodes[page * NODE_SELECTION_PAGE_SIZE:(page + 1) * NODE_SELECTION_PAGE_SIZE]
+
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{'☑️' if node['id'] in selected else '⬜️'} {NODE_STATUS_ICONS.get(node['status'], '•')} {node['name']} ({node['address']})",
+            callback_data=f"nodeaction_toggle_{node['id']}",
+        )]
+        for node in page_nodes
+    ]
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"nodeaction_page_{page - 1}"))
+    all_selected = all(node['id'] in selected for node in page_nodes)
+    navigation.append(InlineKeyboardButton("لغو انتخاب صفحه" if all_selected else "انتخاب همه صفحه", callback_data='nodeaction_all'))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"nodeaction_page_{page + 1}"))
+    keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton(
+        f"حذف کانتینر با SSH: {'بله' if user_data['action_teardown'] else 'خیر'}", callback_data='nodeaction_teardown')])
+    keyboard.append([
+        InlineKeyboardButton(f"🗑 {NODE_ACTION_LABELS[ACTION_DELETE]}", callback_data=f"nodeaction_{ACTION_DELETE}"),
+        InlineKeyboardButton(f"⏸ {NODE_ACTION_LABELS[ACTION_DISABLE]}", callback_data=f"nodeaction_{ACTION_DISABLE}"),
+    ])
+    keyboard.append([InlineKeyboardButton("لغو", callback_data='cancel_operation')])
+    text = (
+        f"نودهای پنل {user_data['chosen_panel_name']}: {len(selected)} از {len(nodes)} انتخاب شده (صفحه {page + 1}/{pages})\n"
+        "نودها را انتخاب کرده و سپس عملیات را انتخاب کنید."
+    )
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def delete_node_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    if query:
+        await query.answer()
+
+    panel_names = owned_panel_names(update.effective_user.id)
+    if not panel_names:
+        message_text = "پنلی برای مدیریت نودها وجود ندارد."
+        if query:
+            await query.edit_message_text(text=message_text)
+        else:
+            await update.message.reply_text(message_text)
+        await show_main_menu(update, context, "گزینه مورد نظر را انتخاب کنید:", new_message=True)
+        return ConversationHandler.END
+
+    reply_markup = panel_selection_keyboard(panel_names, "select_panel_for_delete_")
+    message_text = "لطفاً پنلی را که می‌خواهید نودهای آن را حذف یا غیرفعال کنید انتخاب کنید:"
+    if query:
+        await query.edit_message_text(text=message_text, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(message_text, reply_markup=reply_markup)
+    return DELETE_NODE_PANEL_CHOICE
+
+async def delete_node_panel_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Lists the chosen panel's nodes for selection."""
+    query = update.callback_query
+    await query.answer()
+
+    chosen_panel_name = query.data.replace("select_panel_for_delete_", "")
+    panel_info = get_registry().get_panel(chosen_panel_name)
+    if panel_info is None or chosen_panel_name not in owned_panel_names(update.effective_user.id):
+        await query.edit_message_text(text="پنل انتخاب شده معتبر نیست. لطفاً دوباره تلاش کنید.")
+        return ConversationHandler.END
+
+    panel_nodes = await get_marzban_nodes(panel_info)
+    if panel_nodes is None:
+        await query.edit_message_text(text=f"خطا در دریافت لیست نودهای پنل {chosen_panel_name}. (API: {panel_breaker_text(panel_info)})")
+        return ConversationHandler.END
+    if not panel_nodes:
+        await query.edit_message_text(text=f"پنل {chosen_panel_name} نودی ندارد.")
+        return ConversationHandler.END
+
+    context.user_data.update({
+        'chosen_panel_name': chosen_panel_name,
+        'action_nodes': [
+            {'id': node['id'], 'name': node.get('name', '-'), 'address': node.get('address', '-'), 'status': node.get('status')}
+            for node in panel_nodes
+        ],
+        'action_selected': set(),
+        'action_page': 0,
+        'action_teardown': False,
+    })
+    text, reply_markup = render_node_selection(context.user_data)
+    await query.edit_message_text(text=text, reply_markup=reply_markup)
+    return DELETE_NODE_CHOICE
+
+async def delete_node_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handles selection, paging, the teardown toggle, the action buttons and their confirmation."""
+    query = update.callback_query
+    user_data = context.user_data
+    action = query.data.replace("nodeaction_", "")
+    if action in NODE_ACTION_LABELS and not user_data['action_selected']:
+        await query.answer("ابتدا حداقل یک نود را انتخاب کنید.", show_alert=True)
+        return DELETE_NODE_CHOICE
+    await query.answer()
+
+    if action.startswith('toggle_'):
+        user_data['action_selected'] ^= {int(action.replace('toggle_', ''))}
+    elif action.startswith('page_'):
+        user_data['action_page'] = int(action.replace('page_', ''))
+    elif action == 'all':
+        page = user_data['action_page']
+        page_ids = {node['id'] for node in user_data['action_nodes'][page * NODE_SELECTION_PAGE_SIZE:(page + 1) * NODE_SELECTION_PAGE_SIZE]}
+        if page_ids <= user_data['action_selected']:
+            user_data['action_selected'] -= page_ids
+        else:
+            user_data['action_selected'] |= page_ids
+    elif action == 'teardown':
+        user_data['action_teardown'] = not user_data['action_teardown']
+    elif action in NODE_ACTION_LABELS:
+        user_data['node_action'] = action
+        teardown_text = " و کانتینر آن‌ها با SSH حذف می‌شود" if user_data['action_teardown'] else ""
+        await query.edit_message_text(
+            text=f"{NODE_ACTION_LABELS[action]} {len(user_data['action_selected'])} نود از پنل {user_data['chosen_panel_name']}{teardown_text}. ادامه می‌دهید؟",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ تأیید", callback_data='nodeaction_confirm'), InlineKeyboardButton("بازگشت", callback_data='nodeaction_back')],
+            ]),
+        )
+        return DELETE_NODE_CHOICE
+    elif action == 'confirm':
+        await start_node_action_job(update, context)
+        return ConversationHandler.END
+
+    text, reply_markup = render_node_selection(user_data)
+    try:
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+    except TelegramError as e:
+        if 'not modified' not in str(e).lower():
+            raise
+    return DELETE_NODE_CHOICE
+
+def teardown_node_details(panel_name: str, address: str):
+    """node_details for tearing down the container of a panel's node, or None when it must be left alone:
+    not installed by the bot, no stored credentials, or also recorded on another panel it still serves."""
+    registry = get_registry()
+    node = registry.get_node(panel_name, address)
+    if node is None:
+        return None
+    shared = [other for other, _ in registry.find_node(address) if other != panel_name]
+    if shared:
+        logger.warning(f"Not tearing down node {address} of panel {panel_name}, it is also recorded on {', '.join(shared)}")
+        return None
+    return node_ssh_details(address, node)
+
+async def start_node_action_job(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_data = context.user_data
+    panel_name, action, teardown = user_data['chosen_panel_name'], user_data['node_action'], user_data['action_teardown']
+    nodes = [
+        {**node, 'node_details': teardown_node_details(panel_name, node['address'])}
+        for node in user_data['action_nodes'] if node['id'] in user_data['action_selected']
+    ]
+    logger.info(f"User {update.effective_user.id} runs {action} (teardown: {teardown}) on {len(nodes)} nodes of panel {panel_name}")
+    await update.callback_query.edit_message_text(text=f"{NODE_ACTION_LABELS[action]} {len(nodes)} نود از پنل {panel_name}...")
+    # Run in the background so the bot keeps serving other updates meanwhile
+    context.application.create_task(
+        run_node_action_job(context, update.effective_chat.id, panel_name, nodes, action, teardown, update.callback_query.message)
+    )
+    user_data.clear()
+
+def format_node_action_summary(panel_name: str, action: str, results: dict) -> str:
+    """Renders the per-node results of a running delete/disable action."""
+    def icon(value):
+        return {None: '⏳', True: '✅', False: '❌', 'skipped': '➖'}[value]
+
+    finished = sum(1 for result in results.values() if result['ssh'] is not None)
+    lines = [f"{NODE_ACTION_LABELS[action]} - نودهای پنل {panel_name}: {finished}/{len(results)} (پنل / کانتینر)"]
+    for result in results.values():
+        lines.append(f"{icon(result['api'])} {icon(result['ssh'])} {result['name']} ({result['address']})")
+    text = "\n".join(lines)
+    return text if len(text) <= 4000 else text[:3990] + "\n..."
+
+async def run_node_action_job(context: ContextTypes.DEFAULT_TYPE, chat_id: int, panel_name: str, nodes: list,
+                              action: str, teardown: bool, summary_message) -> None:
+    """Deletes or disables the selected nodes, keeping one summary message up to date."""
+    panel_info = get_registry().get_panel(panel_name)
+    results = {}
+    board = get_status_board()
+    board.track(summary_message, lambda: format_node_action_summary(panel_name, action, results))
+    try:
+        await run_node_actions(panel_info, nodes, action, teardown, results)
+    finally:
+        await board.finish(summary_message, format_node_action_summary(panel_name, action, results))
+
+    registry = get_registry()
+    if action == ACTION_DELETE:
+        for node in nodes:
+            if results[node['id']]['api'] and registry.get_node(panel_name, node['address']) is not None:
+                registry.delete_node(panel_name, node['address'])
+    get_node_directory().invalidate(panel_name)
+    succeeded = sum(1 for result in results.values() if result['api'])
+    logger.info(f"{action} on panel {panel_name} finished: {succeeded}/{len(results)} succeeded")
+
 
 # --- Main Application Setup --- #
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records the latency and status code of every Bot API call."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        status = 'error'
+        try:
+            with TELEGRAM_REQUEST_SECONDS.time(method=api_method):
+                status, payload = await super().do_request(url, method, *args, **kwargs)
+            return status, payload
+        finally:
+            TELEGRAM_RESPONSES.inc(method=api_method, status=status)
+
+def timed_callback(callback, state: str):
+    """Wraps a handler callback to record its latency under the given conversation state."""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with HANDLER_SECONDS.time(handler=callback.__name__, state=state):
+            return await callback(update, context)
+    return wrapper
+
+def instrument_handlers(application: Application) -> None:
+    """Times every registered handler, labelled by its conversation state ('none' outside conversations)."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if not isinstance(handler, ConversationHandler):
+                handler.callback = timed_callback(handler.callback, 'none')
+                continue
+            groups = [('entry', handler.entry_points), ('fallback', handler.fallbacks)]
+            groups += [(STATE_NAMES.get(state, str(state)), state_handlers) for state, state_handlers in handler.states.items()]
+            for state, state_handlers in groups:
+                for state_handler in state_handlers:
+                    state_handler.callback = timed_callback(state_handler.callback, state)
+
+async def post_init(application: Application) -> None:
+    """Creates the provisioning queue, health monitor and usage collector the handlers use and
+    starts the metrics endpoint (when METRICS_PORT is set); the rest waits for deferred_startup."""
+    application.bot_data['provisioning_queue'] = ProvisioningQueue(
+        lambda job, queue: run_provisioning_job(application, job, queue),
+        on_batch_finished=lambda batch, jobs: finish_bulk_batch(application, batch, jobs),
+    )
+    application.bot_data['health_monitor'] = HealthMonitor(lambda *transition: send_health_alert(application, *transition))
+    application.bot_data['usage_collector'] = UsageCollector()
+    application.bot_data['metrics_server'] = await start_metrics_server()
+    # post_init runs before polling starts, so the warm-up must not be awaited here
+    application.bot_data['startup_task'] = asyncio.get_running_loop().create_task(deferred_startup(application))
+
+async def deferred_startup(application: Application) -> None:
+    """Once updates are being received: loads the registry, resumes jobs interrupted by a restart,
+    logs in to every panel in the background and starts the health monitor and usage collector."""
+    while not application.running:
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(STARTUP_WARMUP_DELAY)
+    started = time.monotonic()
+    panels = get_registry().panels() # Loaded here rather than by the first handler that needs it
+    application.bot_data['provisioning_queue'].resume()
+    # Logins first, so the monitors' first rounds and the first user actions find cached tokens
+    tokens = await asyncio.gather(*(get_marzban_access_token(panel_info) for panel_info in panels.values()))
+    application.bot_data['health_monitor'].start()
+    application.bot_data['usage_collector'].start()
+    logger.info(f"Startup warm-up done in {time.monotonic() - started:.1f}s: logged in to {sum(1 for token in tokens if token)}/{len(panels)} panels")
+
+async def post_shutdown(application: Application) -> None:
+    """Stops running jobs (they resume on next start) and releases pooled panel and SSH connections."""
+    startup_task = application.bot_data.get('startup_task')
+    if startup_task:
+        startup_task.cancel()
+        await asyncio.gather(startup_task, return_exceptions=True)
+    queue = application.bot_data.get('provisioning_queue')
+    if queue:
+        await queue.stop()
+    for service in ('health_monitor', 'usage_collector'):
+        if application.bot_data.get(service):
+            await application.bot_data[service].stop()
+    metrics_server = application.bot_data.get('metrics_server')
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    await close_panel_clients()
+    await get_ssh_pool().close()
+
 def main() -> None:
     """Start the bot.""" # Check if TELEGRAM_BOT_TOKEN is set
     bot_token = os.environ.get("TELEGRAM_BOT_TOKEN")
@@ -473,7 +1379,15 @@ def main() -> None:
         logger.error("متغیر محیطی TELEGRAM_BOT_TOKEN تنظیم نشده است!")
         return
 
-    application = Application.builder().token(bot_token).build()
+    builder = (
+        Application.builder().token(bot_token).request(InstrumentedRequest(connection_pool_size=256))
+        .rate_limiter(OutboundScheduler())
+        .concurrent_updates(ChatOrderedUpdateProcessor())
+        .post_init(post_init).post_shutdown(post_shutdown)
+    )
+    if BOT_API_BASE_URL:
+        builder.base_url(f"{BOT_API_BASE_URL.rstrip('/')}/bot").base_file_url(f"{BOT_API_BASE_URL.rstrip('/')}/file/bot")
+    application = builder.build()
 
     # Conversation handler for adding a panel
     add_panel_conv_handler = ConversationHandler(
@@ -500,7 +1414,6 @@ def main() -> None:
             ADD_NODE_PORT: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_node_port)],
             ADD_NODE_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_node_user)],
             ADD_NODE_PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_node_password)],
-            ADD_NODE_TO_PANEL_CONFIRM: [MessageHandler(filters.Regex('^(بله|خیر|yes|no)$'), add_node_to_panel_confirm)],
         },
         fallbacks=[CommandHandler("cancel", cancel), CallbackQueryHandler(cancel, pattern='^cancel_operation$')],
         map_to_parent={
@@ -508,6 +1421,37 @@ def main() -> None:
         }
     )
     
+    # Conversation handler for bulk onboarding from an inventory file
+    bulk_add_conv_handler = ConversationHandler(
+        entry_points=[CallbackQueryHandler(bulk_add_start, pattern='^bulk_add$'), CommandHandler("bulk_add", bulk_add_start)],
+        states={
+            BULK_CHOOSE_PANEL: [CallbackQueryHandler(bulk_choose_panel, pattern='^select_panel_for_bulk_.*$')],
+            BULK_UPLOAD: [MessageHandler(filters.Document.ALL, bulk_upload)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel), CallbackQueryHandler(cancel, pattern='^cancel_operation$')],
+    )
+
+    # Conversation handler for editing a stored panel
+    edit_panel_conv_handler = ConversationHandler(
+        entry_points=[CallbackQueryHandler(edit_panel_start, pattern='^edit_panel_start$'), CommandHandler("edit_panel", edit_panel_start)],
+        states={
+            EDIT_PANEL_CHOICE: [CallbackQueryHandler(edit_panel_choice, pattern='^select_panel_for_edit_.*$')],
+            EDIT_PANEL_FIELD: [CallbackQueryHandler(edit_panel_field, pattern=f"^edit_field_({'|'.join(EDITABLE_PANEL_FIELDS)})$")],
+            EDIT_PANEL_NEW_VALUE: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_panel_new_value)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel), CallbackQueryHandler(cancel, pattern='^cancel_operation$')],
+    )
+
+    # Conversation handler for deleting or disabling many nodes of a panel at once
+    delete_node_conv_handler = ConversationHandler(
+        entry_points=[CallbackQueryHandler(delete_node_start, pattern='^delete_node_start$'), CommandHandler("delete_nodes", delete_node_start)],
+        states={
+            DELETE_NODE_PANEL_CHOICE: [CallbackQueryHandler(delete_node_panel_choice, pattern='^select_panel_for_delete_.*$')],
+            DELETE_NODE_CHOICE: [CallbackQueryHandler(delete_node_choice, pattern=r'^nodeaction_(toggle_\d+|page_\d+|all|teardown|delete|disable|confirm|back)$')],
+        },
+        fallbacks=[CommandHandler("cancel", cancel), CallbackQueryHandler(cancel, pattern='^cancel_operation$')],
+    )
+
     # Main conversation handler to manage top-level menu and sub-conversations
     # This is a simplified approach. For complex menus, a different structure might be better.
     # For now, we'll use individual handlers for commands/callbacks from the main menu.
@@ -518,15 +1462,35 @@ def main() -> None:
 
     application.add_handler(add_panel_conv_handler)
     application.add_handler(add_node_conv_handler)
+    application.add_handler(bulk_add_conv_handler)
+    application.add_handler(edit_panel_conv_handler)
+    application.add_handler(delete_node_conv_handler)
     application.add_handler(CallbackQueryHandler(list_panels_wrapper, pattern='^list_panels$'))
+    application.add_handler(CallbackQueryHandler(nodes_page_callback, pattern=r'^nodes_(page|refresh)_\d+$'))
     application.add_handler(CommandHandler("list_panels", list_panels_wrapper))
+    application.add_handler(CommandHandler("rotate_cert", rotate_cert_command))
+    application.add_handler(CommandHandler("jobs", jobs_command))
+    application.add_handler(CommandHandler("job", job_command))
+    application.add_handler(CommandHandler("node_restart", node_restart_command))
+    application.add_handler(CommandHandler("node_logs", node_logs_command))
+    application.add_handler(CommandHandler("node_exec", node_exec_command))
+    application.add_handler(CommandHandler("upgrade_nodes", upgrade_nodes_command))
+    application.add_handler(CommandHandler("health", health_command))
+    application.add_handler(CommandHandler("nodes", nodes_command))
+    application.add_handler(CommandHandler("usage", usage_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    instrument_handlers(application)
 
     # Fallback for unknown commands/callbacks if needed
     # application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
     # application.add_handler(CallbackQueryHandler(unknown_callback))
 
-    logger.info("Bot started and polling...")
-    application.run_polling()
+    if BOT_WEBHOOK_URL:
+        logger.info(f"Bot started with webhook {BOT_WEBHOOK_URL}...")
+        application.run_webhook(**webhook_options())
+    else:
+        logger.info("Bot started and polling...")
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,29 @@
+import asyncio
+import itertools
+import os
+import sys
+
+import httpx
+import pytest
+
+# The bot's modules live flat at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import marzban_api # noqa: E402
+
+_panel_numbers = itertools.count()
+
+
+@pytest.fixture
+def mock_panel(monkeypatch):
+    """Serves a fresh panel (own client and breaker) from ``handler(request)``; no backoff sleeps."""
+    monkeypatch.setattr(marzban_api, 'backoff_delay', lambda attempt: 0)
+
+    def make(handler):
+        panel_info = {'domain': f'panel{next(_panel_numbers)}.test', 'port': 8000, 'https': False, 'username': 'u', 'password': 'p'}
+        base_url = marzban_api.panel_base_url(panel_info)
+        marzban_api._panel_clients[base_url] = httpx.AsyncClient(base_url=base_url, transport=httpx.MockTransport(handler))
+        return panel_info
+
+    yield make
+    asyncio.run(marzban_api.close_panel_clients())
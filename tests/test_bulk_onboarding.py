@@ -0,0 +1,57 @@
+import pytest
+
+from bulk_onboarding import InventoryError, format_summary, parse_inventory
+
+
+def test_csv_without_header_uses_default_columns():
+    nodes = parse_inventory('nodes.csv', b"1.2.3.4,2222,admin,secret\n5.6.7.8,,,pw\n")
+    assert nodes == [
+        {'ip': '1.2.3.4', 'port': '2222', 'user': 'admin', 'password': 'secret', 'key': ''},
+        {'ip': '5.6.7.8', 'port': '22', 'user': 'root', 'password': 'pw', 'key': ''},
+    ]
+
+
+def test_csv_header_names_columns_and_comments_and_blank_lines_are_skipped():
+    data = "\ufeffip,password,user\n# staging\n\n 9.9.9.9 ,pw,ubuntu\n".encode('utf-8')
+    assert parse_inventory('nodes.csv', data) == [
+        {'ip': '9.9.9.9', 'port': '22', 'user': 'ubuntu', 'password': 'pw', 'key': ''},
+    ]
+
+
+def test_yaml_inventory_accepts_nodes_mapping_and_keys():
+    pytest.importorskip('yaml')
+    data = b"nodes:\n  - ip: 5.6.7.8\n    user: ubuntu\n    key: |\n      KEY\n"
+    [node] = parse_inventory('nodes.yml', data)
+    assert node['ip'] == '5.6.7.8' and node['user'] == 'ubuntu' and node['key'] == 'KEY\n'
+    assert node['password'] == '' and node['port'] == '22'
+
+
+@pytest.mark.parametrize('filename, data, message', [
+    ('nodes.csv', b"1.2.3.4,22,root,\n", "needs a password or a key"),
+    ('nodes.csv', b"1.2.3.4,ssh,root,pw\n", "invalid port"),
+    ('nodes.csv', b"1.2.3.4,22,root,pw\n1.2.3.4,22,root,pw\n", "line 2: duplicate ip"),
+    ('nodes.csv', b"# only a comment\n", "empty"),
+    ('nodes.csv', b"\xff\xfe", "UTF-8"),
+])
+def test_invalid_inventories_are_rejected(filename, data, message):
+    with pytest.raises(InventoryError, match=message):
+        parse_inventory(filename, data)
+
+
+def test_yaml_entry_without_ip_is_rejected():
+    pytest.importorskip('yaml')
+    with pytest.raises(InventoryError, match="line 2: missing ip"):
+        parse_inventory('nodes.yaml', b"- ip: 1.2.3.4\n  password: pw\n- user: root\n  password: pw\n")
+
+
+def test_yaml_inventory_must_be_a_list():
+    pytest.importorskip('yaml')
+    with pytest.raises(InventoryError, match="list of nodes"):
+        parse_inventory('nodes.yaml', b"ip: 1.2.3.4\n")
+
+
+def test_summary_counts_finished_nodes_and_stays_within_message_limit():
+    text = format_summary('panel', {'1.1.1.1': 'done', '2.2.2.2': 'failed', '3.3.3.3': 'ssh'})
+    assert text.splitlines()[0].endswith("2/3")
+    statuses = {f'10.0.{i // 256}.{i % 256}': 'queued' for i in range(500)}
+    assert len(format_summary('panel', statuses)) <= 4000
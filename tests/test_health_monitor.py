@@ -0,0 +1,143 @@
+import asyncio
+import math
+
+import httpx
+import pytest
+
+import health_monitor
+import marzban_api
+from health_monitor import STATE_DOWN, STATE_UP, HealthMonitor, RttSeries
+from marzban_api import NODE_API_PORT, NODE_SERVICE_PORT
+from panel_registry import PanelRegistry
+from panel_resilience import STATE_OPEN, get_breaker
+
+
+class FakeNetwork:
+    """Answers ``tcp_connect_rtt`` from the set of reachable ``(host, port)`` pairs."""
+
+    def __init__(self):
+        self.reachable = set()
+
+    def open(self, host):
+        self.reachable |= {(host, NODE_SERVICE_PORT), (host, NODE_API_PORT)}
+
+    async def tcp_connect_rtt(self, host, port, timeout=None):
+        return 5.0 if (host, port) in self.reachable else None
+
+
+@pytest.fixture
+def network(monkeypatch):
+    network = FakeNetwork()
+    monkeypatch.setattr(health_monitor, 'tcp_connect_rtt', network.tcp_connect_rtt)
+    return network
+
+
+@pytest.fixture
+def monitor(tmp_path, monkeypatch, mock_panel, network):
+    """A monitor over one panel ('main') whose ``/api/nodes`` returns ``monitor.panel_nodes``."""
+    registry = PanelRegistry(str(tmp_path / 'marzban_bot.db'), str(tmp_path / 'missing.json'))
+    monkeypatch.setattr(health_monitor, 'get_registry', lambda: registry)
+    alerts = []
+
+    async def on_transition(*transition):
+        alerts.append(transition)
+
+    # No spread between probes of a round
+    monitor = HealthMonitor(on_transition, interval=0)
+    monitor.alerts, monitor.panel_nodes, monitor.registry = alerts, [], registry
+
+    def handler(request):
+        if request.url.path == '/api/admin/token':
+            return httpx.Response(200, json={'access_token': 'token'})
+        return httpx.Response(200, json=monitor.panel_nodes)
+
+    monitor.panel_info = mock_panel(handler)
+    registry.save_panel('main', monitor.panel_info, owner_id=1)
+    yield monitor
+    registry.close()
+
+
+def test_rtt_series_keeps_the_latest_samples():
+    series = RttSeries(capacity=3)
+    for timestamp, rtt in enumerate([1.0, 2.0, None, 4.0]):
+        series.append(rtt, timestamp)
+    assert series.samples() == [(1, 2.0), (2, None), (3, 4.0)]
+    assert series.samples(since=3) == [(3, 4.0)]
+    stats = series.stats()
+    assert stats['samples'] == 3 and stats['p50'] == 2.0 and stats['p95'] == 4.0
+    assert math.isclose(stats['loss'], 1 / 3)
+
+
+def test_rtt_series_without_successful_samples():
+    series = RttSeries(capacity=2)
+    assert series.stats() == {'samples': 0, 'p50': None, 'p95': None, 'loss': 0.0}
+    series.append(None, 1)
+    assert series.stats() == {'samples': 1, 'p50': None, 'p95': None, 'loss': 1.0}
+
+
+def test_only_state_changes_raise_alerts(monitor, network):
+    monitor.panel_nodes = [{'address': '10.0.0.1', 'status': 'connected'}, {'address': '10.0.0.2', 'status': 'connected'}]
+    network.open('10.0.0.1')
+
+    asyncio.run(monitor.check_all())
+    # A node first seen up is not worth an alert, one first seen down is
+    assert monitor.alerts == [('main', '10.0.0.2', None, STATE_DOWN, f"پورت {NODE_SERVICE_PORT} در دسترس نیست")]
+
+    asyncio.run(monitor.check_all())
+    assert len(monitor.alerts) == 1
+
+    network.reachable = {('10.0.0.2', NODE_SERVICE_PORT), ('10.0.0.2', NODE_API_PORT)}
+    asyncio.run(monitor.check_all())
+    assert sorted(monitor.alerts[1:]) == [
+        ('main', '10.0.0.1', STATE_UP, STATE_DOWN, f"پورت {NODE_SERVICE_PORT} در دسترس نیست"),
+        ('main', '10.0.0.2', STATE_DOWN, STATE_UP, ''),
+    ]
+    assert monitor.nodes[('main', '10.0.0.1')]['series'].count == 3
+
+
+def test_panel_reported_status_and_missing_registration(monitor, network):
+    monitor.registry.save_node('main', '10.0.0.3', {})
+    monitor.panel_nodes = [{'address': '10.0.0.1', 'status': 'error', 'message': 'SSL error'}]
+    for host in ('10.0.0.1', '10.0.0.3'):
+        network.open(host)
+
+    asyncio.run(monitor.check_all())
+    assert sorted(monitor.alerts) == [
+        ('main', '10.0.0.1', None, STATE_DOWN, "وضعیت پنل: error SSL error"),
+        ('main', '10.0.0.3', None, STATE_DOWN, "نود در پنل ثبت نشده است"),
+    ]
+
+
+def test_open_breaker_does_not_mark_recorded_nodes_down(monitor, network):
+    monitor.registry.save_node('main', '10.0.0.1', {})
+    network.open('10.0.0.1')
+    monitor.panel_nodes = [{'address': '10.0.0.1', 'status': 'connected'}]
+    asyncio.run(monitor.check_all())
+
+    breaker = get_breaker(marzban_api.panel_key(monitor.panel_info))
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure('HTTP 503')
+    assert breaker.state == STATE_OPEN
+    monitor.panel_nodes = []
+
+    # The panel can't be asked, so its silence about the node is no reason to alert
+    asyncio.run(monitor.check_all())
+    assert monitor.alerts == []
+    assert monitor.nodes[('main', '10.0.0.1')]['state'] == STATE_UP
+
+    network.reachable = set()
+    asyncio.run(monitor.check_all())
+    assert monitor.alerts == [('main', '10.0.0.1', STATE_UP, STATE_DOWN, f"پورت {NODE_SERVICE_PORT} در دسترس نیست")]
+
+
+def test_failing_alert_does_not_stop_the_round(monitor, network):
+    monitor.panel_nodes = [{'address': '10.0.0.1'}, {'address': '10.0.0.2'}]
+
+    async def on_transition(panel_name, address, old_state, new_state, reason):
+        monitor.alerts.append(address)
+        raise RuntimeError("chat not found")
+
+    monitor.on_transition = on_transition
+    asyncio.run(monitor.check_all())
+    assert sorted(monitor.alerts) == ['10.0.0.1', '10.0.0.2']
+    assert {entry['state'] for _, _, entry, _ in monitor.report('main')} == {STATE_DOWN}
@@ -0,0 +1,31 @@
+import asyncio
+
+import httpx
+
+import marzban_api
+
+
+def panel_handler(node_status):
+    calls = []
+
+    def handler(request):
+        calls.append((request.method, request.url.path))
+        if request.url.path == '/api/admin/token':
+            return httpx.Response(200, json={'access_token': 'token'})
+        return httpx.Response(node_status, json={'detail': 'Node already exists'})
+
+    return handler, calls
+
+
+def test_node_already_on_the_panel_counts_as_added(mock_panel):
+    handler, calls = panel_handler(409)
+    panel_info = mock_panel(handler)
+    assert asyncio.run(marzban_api.add_marzban_node_api(panel_info, '10.0.0.1')) is True
+    assert calls.count(('POST', '/api/node')) == 1
+
+
+def test_rejected_node_is_not_added(mock_panel):
+    handler, calls = panel_handler(422)
+    panel_info = mock_panel(handler)
+    assert asyncio.run(marzban_api.add_marzban_node_api(panel_info, '10.0.0.1')) is False
+    assert calls.count(('POST', '/api/node')) == 1
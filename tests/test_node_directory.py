@@ -0,0 +1,145 @@
+import asyncio
+
+import pytest
+
+import node_directory
+from node_directory import NodeDirectory, node_rows
+from panel_registry import PanelRegistry
+
+PANEL = {'domain': 'panel.example.com', 'port': 8000, 'https': True, 'username': 'admin', 'password': 'secret'}
+
+
+class FakePanels:
+    """Serves ``get_marzban_nodes`` from per-panel node lists; ``gate`` holds fetches until set."""
+
+    def __init__(self):
+        self.nodes = {}
+        self.calls = []
+        self.gate = None
+
+    async def get_marzban_nodes(self, panel_info):
+        self.calls.append(panel_info['domain'])
+        if self.gate is not None:
+            await self.gate.wait()
+        nodes = self.nodes.get(panel_info['domain'])
+        if isinstance(nodes, float):
+            await asyncio.sleep(nodes)
+            return []
+        return nodes
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    registry = PanelRegistry(str(tmp_path / 'marzban_bot.db'), str(tmp_path / 'missing.json'))
+    monkeypatch.setattr(node_directory, 'get_registry', lambda: registry)
+    for name in ('a', 'b'):
+        registry.save_panel(name, dict(PANEL, domain=name), owner_id=1)
+    yield registry
+    registry.close()
+
+
+@pytest.fixture
+def panels(monkeypatch):
+    panels = FakePanels()
+    monkeypatch.setattr(node_directory, 'get_marzban_nodes', panels.get_marzban_nodes)
+    return panels
+
+
+def node(name, address=None):
+    return {'name': name, 'address': address or name}
+
+
+def test_first_fetch_waits_and_fresh_entries_are_cached(registry, panels):
+    panels.nodes = {'a': [node('n1')], 'b': []}
+    directory = NodeDirectory(ttl=30)
+
+    async def scenario():
+        first = await directory.get()
+        second = await directory.get()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first['a']['nodes'] == [node('n1')] and first['b']['nodes'] == []
+    assert second == first
+    assert sorted(panels.calls) == ['a', 'b']
+
+
+def test_stale_entries_are_served_while_refreshing(registry, panels):
+    panels.nodes = {'a': [node('old')], 'b': []}
+    directory = NodeDirectory(ttl=30)
+
+    async def scenario():
+        await directory.get()
+        directory._entries['a']['fetched_at'] -= 60
+        panels.nodes['a'] = [node('new')]
+        panels.gate = asyncio.Event()
+        stale = await directory.get(panel_names=['a'])
+        refresh = directory._inflight['a']
+        panels.gate.set()
+        await refresh
+        return stale, await directory.get(panel_names=['a'])
+
+    stale, fresh = asyncio.run(scenario())
+    assert stale['a']['nodes'] == [node('old')]
+    assert fresh['a']['nodes'] == [node('new')]
+    assert panels.calls.count('a') == 2
+
+
+def test_concurrent_requests_share_one_fetch(registry, panels):
+    panels.nodes = {'a': [node('n1')]}
+
+    async def scenario():
+        directory = NodeDirectory()
+        return await asyncio.gather(directory.get(panel_names=['a']), directory.get(panel_names=['a']))
+
+    first, second = asyncio.run(scenario())
+    assert first == second
+    assert panels.calls == ['a']
+
+
+def test_failed_refresh_keeps_the_last_list(registry, panels):
+    panels.nodes = {'a': [node('n1')]}
+    directory = NodeDirectory()
+
+    async def scenario():
+        await directory.get(panel_names=['a'])
+        panels.nodes['a'] = None
+        return await directory.get(force=True, panel_names=['a'])
+
+    result = asyncio.run(scenario())
+    assert result['a']['nodes'] == [node('n1')]
+    assert result['a']['error']
+
+
+def test_slow_panel_times_out_without_holding_up_the_others(registry, panels):
+    panels.nodes = {'a': 5.0, 'b': [node('n1')]}
+    directory = NodeDirectory(panel_timeout=0.05)
+
+    result = asyncio.run(directory.get())
+    assert result['a'] == {'nodes': [], 'fetched_at': result['a']['fetched_at'], 'error': "پاسخی از پنل دریافت نشد"}
+    assert result['b']['nodes'] == [node('n1')] and result['b']['error'] is None
+
+
+def test_deleted_panels_and_invalidated_entries_are_dropped(registry, panels, monkeypatch):
+    panels.nodes = {'a': [node('n1')], 'b': [node('n2')], 'c': [node('n3')]}
+    registry.save_panel('c', dict(PANEL, domain='c'), owner_id=1)
+    directory = NodeDirectory()
+
+    async def scenario():
+        await directory.get()
+        monkeypatch.setattr(registry, 'panels', lambda: {name: registry.get_panel(name) for name in ('a', 'b')})
+        directory.invalidate('a')
+        return await directory.get(panel_names=['b', 'c'])
+
+    assert set(asyncio.run(scenario())) == {'b'}
+    assert set(directory._entries) == {'b'}
+    directory.invalidate()
+    assert directory._entries == {}
+
+
+def test_node_rows_are_sorted_by_panel_and_name():
+    directory = {
+        'b': {'nodes': [node('z'), node('a')]},
+        'a': {'nodes': [node(None, '10.0.0.2'), node('m')]},
+    }
+    assert [(panel_name, n['name']) for panel_name, n in node_rows(directory)] == [('a', None), ('a', 'm'), ('b', 'a'), ('b', 'z')]
@@ -0,0 +1,213 @@
+import asyncio
+import io
+import json
+import subprocess
+import tarfile
+
+import pytest
+
+import node_provisioning
+from artifact_relay import image_tarball_id
+from node_provisioning import (
+    PROBE_MARKER,
+    STAGE_API,
+    STAGE_CERT,
+    STAGE_DONE,
+    STAGE_SSH,
+    STAGE_TOKEN,
+    STEP_MARKER,
+    build_probe_script,
+    parse_probe_output,
+    provision_node,
+    relay_provisioning_steps,
+)
+
+PANEL = {'domain': 'panel.example.com', 'port': 8000, 'https': True, 'username': 'admin', 'password': 'secret'}
+NODE = {'ip': '10.0.0.1', 'port': '22', 'user': 'root', 'password': 'x', 'key': ''}
+
+
+class FakeSession:
+    closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeNode:
+    """Panel and SSH calls of provision_node; the SSH setup outlasts the panel calls."""
+
+    def __init__(self):
+        self.calls = []
+        self.adopted = []
+        self.session = FakeSession()
+        self.token = self.cert = self.api = True
+        self.connect_error = None
+
+    async def get_marzban_access_token(self, panel_info):
+        self.calls.append(STAGE_TOKEN)
+        await asyncio.sleep(0)
+        return 'token' if self.token else None
+
+    async def get_marzban_cert(self, panel_info):
+        self.calls.append(STAGE_CERT)
+        await asyncio.sleep(0.01)
+        return 'CERT' if self.cert else None
+
+    async def connect_node(self, node_details):
+        self.calls.append('connect')
+        return (None, self.connect_error) if self.connect_error else (self.session, None)
+
+    async def run_session_steps(self, session, node_details, steps, output_tail=None):
+        await asyncio.sleep(0.05)
+        return True, 'ok'
+
+    async def add_marzban_node_api(self, panel_info, node_ip, add_as_host=True):
+        self.calls.append(STAGE_API)
+        return self.api
+
+    async def adopt(self, node_details, session):
+        self.adopted.append(session)
+
+
+@pytest.fixture
+def node(monkeypatch):
+    fake = FakeNode()
+    for name in ('get_marzban_access_token', 'get_marzban_cert', 'connect_node', 'run_session_steps', 'add_marzban_node_api'):
+        monkeypatch.setattr(node_provisioning, name, getattr(fake, name))
+    monkeypatch.setattr(node_provisioning, 'get_ssh_pool', lambda: fake)
+    return fake
+
+
+def provision(**kwargs):
+    seen = []
+
+    async def progress(stage):
+        seen.append(stage)
+
+    result = asyncio.run(provision_node(PANEL, NODE, progress, **kwargs))
+    return result, seen
+
+
+def test_ssh_stage_is_reported_while_the_panel_calls_overlap_it(node):
+    checkpoints = []
+
+    async def on_checkpoint(stage, data):
+        checkpoints.append(stage)
+
+    result, seen = provision(on_checkpoint=on_checkpoint)
+    assert seen == [STAGE_TOKEN, STAGE_SSH, STAGE_API]
+    assert (result['success'], result['stage']) == (True, STAGE_DONE)
+    assert checkpoints == [STAGE_TOKEN, STAGE_CERT, STAGE_SSH, STAGE_API]
+    assert result['cert_fingerprint'] is not None
+    assert node.adopted == [node.session]
+
+
+def test_failed_certificate_fetch_is_reported_as_the_failing_stage(node):
+    node.cert = False
+    result, seen = provision()
+    assert (result['success'], result['stage']) == (False, STAGE_CERT)
+    assert seen == [STAGE_TOKEN, STAGE_SSH]
+    assert STAGE_API not in node.calls
+    assert node.session.closed and not node.adopted
+
+
+def test_failed_ssh_connection_is_reported_as_the_ssh_stage(node):
+    node.connect_error = 'Connection refused'
+    result, _ = provision()
+    assert (result['success'], result['stage'], result['output']) == (False, STAGE_SSH, 'Connection refused')
+    assert STAGE_API not in node.calls
+
+
+def test_failed_api_call_is_reported_as_the_api_stage(node):
+    node.api = False
+    result, seen = provision()
+    assert (result['success'], result['stage']) == (False, STAGE_API)
+    assert seen[-1] == STAGE_API
+
+
+def test_checkpointed_stages_are_skipped_on_resume(node):
+    result, seen = provision(checkpoints={STAGE_TOKEN: True, STAGE_CERT: 'CERT', STAGE_SSH: True})
+    assert (result['success'], result['stage']) == (True, STAGE_DONE)
+    assert node.calls == [STAGE_API]
+    assert seen == [STAGE_API]
+
+
+def test_pull_step_accepts_any_local_copy_of_an_unpinned_image():
+    step = node_provisioning.pull_image_step('')
+    assert step['command'] == f'sudo docker pull {node_provisioning.NODE_IMAGE}'
+    assert step['check'] == f'sudo docker image inspect {node_provisioning.NODE_IMAGE}'
+
+
+def test_pull_step_compares_a_pinned_digest(monkeypatch):
+    monkeypatch.setattr(node_provisioning, 'NODE_IMAGE', 'registry:5000/marzban-node:v1')
+    step = node_provisioning.pull_image_step('sha256:abc')
+    assert step['command'] == ('sudo docker pull registry:5000/marzban-node@sha256:abc && '
+                               'sudo docker tag registry:5000/marzban-node@sha256:abc registry:5000/marzban-node:v1')
+    assert 'grep -qF @sha256:abc' in step['check']
+
+
+def write_image_tarball(path, config):
+    manifest = json.dumps([{'Config': config, 'RepoTags': ['gozargah/marzban-node:latest'], 'Layers': []}]).encode()
+    with tarfile.open(path, 'w') as tar:
+        info = tarfile.TarInfo('manifest.json')
+        info.size = len(manifest)
+        tar.addfile(info, io.BytesIO(manifest))
+
+
+@pytest.mark.parametrize('config', ['blobs/sha256/abc123', 'abc123.json'])
+def test_image_tarball_id(tmp_path, config):
+    write_image_tarball(tmp_path / 'marzban-node.tar', config)
+    assert image_tarball_id(str(tmp_path / 'marzban-node.tar')) == 'sha256:abc123'
+
+
+def test_relayed_image_replaces_the_pull_and_is_checked_by_id(tmp_path):
+    tarball = str(tmp_path / 'marzban-node.tar')
+    write_image_tarball(tarball, 'blobs/sha256/abc123')
+    steps = node_provisioning.provisioning_steps(NODE, relay=False)
+    relayed = relay_provisioning_steps(steps, {'image': tarball, 'compose': None, 'installer': None, 'packages': []})
+    names = [step['name'] for step in relayed]
+    assert names == [step['name'] if step['name'] != 'pull_image' else 'load_image' for step in steps]
+    load_image = relayed[names.index('load_image')]
+    assert load_image['uploads'][0][0] == tarball
+    assert "= sha256:abc123 ]" in load_image['check']
+    assert names.index('load_image') < names.index('warm_up_container')
+
+
+def test_probe_reports_the_satisfied_checks():
+    steps = [{'name': 'a', 'check': 'true'}, {'name': 'b', 'check': 'false'}, {'name': 'c'}, {'name': 'd', 'check': 'test -d /'}]
+    output = subprocess.run(['bash', '-c', build_probe_script(steps)], capture_output=True, text=True).stdout
+    assert parse_probe_output(output) == {0, 3}
+
+
+class ScriptedSession(FakeSession):
+    """Answers the probe with the given satisfied steps and records the uploaded script."""
+
+    def __init__(self, satisfied):
+        self.satisfied = satisfied
+        self.uploads = []
+
+    async def run(self, command, on_text=None, pty=False):
+        if command.startswith('bash -c'):
+            return 0, ''.join(f"{PROBE_MARKER} {index} 1\r\n" for index in self.satisfied)
+        script = self.uploads[-1][1][0][1]
+        output = ''.join(f"{STEP_MARKER} begin {n}\r\nok\r\n{STEP_MARKER} end {n} 0\r\n" for n in range(script.count(f'{STEP_MARKER} begin')))
+        return 0, output
+
+    async def upload(self, files=(), contents=()):
+        self.uploads.append((list(files), list(contents)))
+
+
+def test_satisfied_steps_are_skipped():
+    steps = [
+        {'name': 'a', 'command': 'echo a', 'check': 'true'},
+        {'name': 'b', 'command': 'echo b', 'check': 'false', 'uploads': [('local-b', '/tmp/b')]},
+        {'name': 'c', 'command': 'echo c', 'check': 'true', 'uploads': [('local-c', '/tmp/c')]},
+    ]
+    session = ScriptedSession({0, 2})
+    success, output = asyncio.run(node_provisioning.run_session_steps(session, NODE, steps))
+    assert success
+    files, contents = session.uploads[0]
+    assert files == [('local-b', '/tmp/b')]
+    script = contents[0][1]
+    assert 'echo b' in script and 'echo a' not in script and 'echo c' not in script
+    assert 'CMD: a: SKIPPED' in output and 'CMD: c: SKIPPED' in output
@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+
+import node_upgrade
+from node_upgrade import PRESTAGE_SCRIPT, UPGRADE_SCRIPT, RollingUpgrade, parse_image_ids
+
+PANEL = {'domain': 'panel.example.com', 'port': 8000, 'https': True, 'username': 'admin', 'password': 'secret'}
+
+
+class FakeFleet:
+    """Nodes of one panel: the images they run, whether they reconnect after a restart."""
+
+    def __init__(self, addresses, current=(), broken=(), rollback_fails=()):
+        self.images = {address: 'new' if address in current else 'old' for address in addresses}
+        self.status = {address: 'connected' for address in addresses}
+        self.broken = set(broken)
+        self.rollback_fails = set(rollback_fails)
+        self.restarting = 0
+        self.peak_restarting = 0
+        self.restarted = []
+
+    async def run_on_node(self, node_details, command, timeout):
+        address = node_details['ip']
+        if command == PRESTAGE_SCRIPT:
+            return 0, f"PREVIOUS_IMAGE={self.images[address]}\r\nTARGET_IMAGE=new\r\n"
+        if command == UPGRADE_SCRIPT:
+            self.restarting += 1
+            self.peak_restarting = max(self.peak_restarting, self.restarting)
+            await asyncio.sleep(0.001)
+            self.restarting -= 1
+            self.restarted.append(address)
+            self.images[address] = 'new'
+            self.status[address] = 'error' if address in self.broken else 'connecting'
+            return 0, ''
+        # Rollback
+        if address in self.rollback_fails:
+            return 1, 'Error response from daemon'
+        self.images[address] = 'old'
+        self.status[address] = 'connected'
+        return 0, ''
+
+    async def get_marzban_nodes(self, panel_info):
+        return [{'id': n, 'address': address, 'status': status} for n, (address, status) in enumerate(self.status.items())]
+
+    async def reconnect_marzban_node(self, panel_info, node_id):
+        address = list(self.status)[node_id]
+        if address not in self.broken:
+            self.status[address] = 'connected'
+        return True
+
+
+@pytest.fixture
+def fleet(monkeypatch):
+    def make(addresses, **kwargs):
+        fake = FakeFleet(addresses, **kwargs)
+        for name in ('run_on_node', 'get_marzban_nodes', 'reconnect_marzban_node'):
+            monkeypatch.setattr(node_upgrade, name, getattr(fake, name))
+        monkeypatch.setattr(node_upgrade, 'UPGRADE_HEALTH_POLL_INTERVAL', 0.001)
+        return fake
+
+    return make
+
+
+def targets(addresses):
+    return [{'panel': 'main', 'panel_info': PANEL, 'address': address, 'node_details': {'ip': address}} for address in addresses]
+
+
+def addresses(count):
+    return [f'10.0.0.{n}' for n in range(count)]
+
+
+def test_parse_image_ids():
+    output = "noise\r\nPREVIOUS_IMAGE=sha256:aaa\r\nTARGET_IMAGE=sha256:bbb\r\n"
+    assert parse_image_ids(output) == {'PREVIOUS_IMAGE': 'sha256:aaa', 'TARGET_IMAGE': 'sha256:bbb'}
+
+
+def test_nodes_are_upgraded_in_waves_of_max_unavailable(fleet):
+    nodes = addresses(5)
+    fake = fleet(nodes, current=[nodes[0]])
+    upgrade = RollingUpgrade(targets(nodes), max_unavailable=2, health_timeout=1)
+    asyncio.run(upgrade.run())
+    assert upgrade.finished and upgrade.halted is None
+    assert upgrade.statuses == {nodes[0]: 'current', **{address: 'upgraded' for address in nodes[1:]}}
+    assert sorted(fake.restarted) == nodes[1:]
+    assert fake.peak_restarting == 2
+    assert (upgrade.wave, upgrade.waves) == (2, 2)
+
+
+def test_node_that_does_not_reconnect_is_rolled_back(fleet):
+    nodes = addresses(4)
+    fake = fleet(nodes, broken=[nodes[1]])
+    upgrade = RollingUpgrade(targets(nodes), max_unavailable=1, max_failure_rate=0.5, health_timeout=0.02)
+    asyncio.run(upgrade.run())
+    assert upgrade.halted is None
+    assert upgrade.statuses[nodes[1]] == 'rolled_back'
+    assert fake.images[nodes[1]] == 'old'
+    assert [upgrade.statuses[address] for address in nodes if address != nodes[1]] == ['upgraded'] * 3
+
+
+def test_rollout_halts_once_the_failure_rate_passes_the_threshold(fleet):
+    nodes = addresses(5)
+    fake = fleet(nodes, broken=nodes[:2])
+    upgrade = RollingUpgrade(targets(nodes), max_unavailable=1, max_failure_rate=0.2, health_timeout=0.02)
+    asyncio.run(upgrade.run())
+    assert upgrade.finished and 'failure rate' in upgrade.halted
+    assert upgrade.statuses[nodes[0]] == 'rolled_back'
+    assert [upgrade.statuses[address] for address in nodes[1:]] == ['skipped'] * 4
+    assert fake.restarted == nodes[:1]
+
+
+def test_node_left_down_by_a_failed_rollback_halts_the_rollout(fleet):
+    nodes = addresses(3)
+    fleet(nodes, broken=[nodes[0]], rollback_fails=[nodes[0]])
+    upgrade = RollingUpgrade(targets(nodes), max_unavailable=1, max_failure_rate=1, health_timeout=0.02)
+    asyncio.run(upgrade.run())
+    assert upgrade.statuses[nodes[0]] == 'rollback_failed'
+    assert 'still unavailable' in upgrade.halted
+    assert [upgrade.statuses[address] for address in nodes[1:]] == ['skipped'] * 2
+
+
+def test_failed_pull_leaves_the_node_alone(fleet, monkeypatch):
+    nodes = addresses(2)
+    fake = fleet(nodes)
+    run_on_node = fake.run_on_node
+
+    async def failing_pull(node_details, command, timeout):
+        if node_details['ip'] == nodes[0] and command == PRESTAGE_SCRIPT:
+            return 1, 'manifest unknown'
+        return await run_on_node(node_details, command, timeout)
+
+    monkeypatch.setattr(node_upgrade, 'run_on_node', failing_pull)
+    upgrade = RollingUpgrade(targets(nodes), health_timeout=1)
+    asyncio.run(upgrade.run())
+    assert upgrade.statuses == {nodes[0]: 'pull_failed', nodes[1]: 'upgraded'}
+    assert upgrade.errors[nodes[0]] == 'manifest unknown'
+
+
+def test_unexpected_error_still_finishes_the_rollout(fleet, monkeypatch):
+    fleet(addresses(2))
+
+    async def panel_down(panel_info):
+        raise RuntimeError("panel unreachable")
+
+    monkeypatch.setattr(node_upgrade, 'get_marzban_nodes', panel_down)
+    upgrade = RollingUpgrade(targets(addresses(2)), max_unavailable=1, health_timeout=1)
+    asyncio.run(upgrade.run())
+    assert upgrade.finished
+    assert upgrade.halted == "error: panel unreachable"
+    assert upgrade.statuses['10.0.0.1'] == 'skipped'
+    assert 'panel unreachable' in upgrade.summary("ارتقا")
+
+
+def test_error_before_the_waves_still_finishes_the_rollout():
+    upgrade = RollingUpgrade(targets(addresses(1)), pull_concurrency=-1)
+    asyncio.run(upgrade.run())
+    assert upgrade.finished and upgrade.halted.startswith("error:")
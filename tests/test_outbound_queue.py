@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+from telegram.error import BadRequest, RetryAfter
+
+from outbound_queue import OutboundScheduler
+
+
+def scheduler():
+    return OutboundScheduler(global_rate=1000, chat_rate=1000, chat_burst=1000)
+
+
+def call(name, sent, gate=None, error=None):
+    async def callback():
+        if gate:
+            await gate.wait()
+        sent.append(name)
+        if error:
+            raise error
+        return name
+
+    return callback
+
+
+def edit(outbound, callback, chat_id=1, message_id=10):
+    return outbound.process_request(callback, (), {}, 'editMessageText', {'chat_id': chat_id, 'message_id': message_id}, None)
+
+
+def send(outbound, callback, chat_id=1):
+    return outbound.process_request(callback, (), {}, 'sendMessage', {'chat_id': chat_id}, None)
+
+
+def test_queued_edit_is_replaced_by_the_newer_one():
+    sent = []
+
+    async def main():
+        outbound = scheduler()
+        gate = asyncio.Event()
+        busy = asyncio.create_task(send(outbound, call('message', sent, gate)))
+        await asyncio.sleep(0)
+        edits = [asyncio.create_task(edit(outbound, call(f'edit {n}', sent))) for n in range(3)]
+        await asyncio.sleep(0)
+        gate.set()
+        return await asyncio.gather(busy, *edits)
+
+    results = asyncio.run(main())
+    assert sent == ['message', 'edit 2']
+    assert results == ['message', 'edit 2', 'edit 2', 'edit 2']
+
+
+def test_edits_of_different_messages_are_all_sent():
+    sent = []
+
+    async def main():
+        outbound = scheduler()
+        gate = asyncio.Event()
+        busy = asyncio.create_task(send(outbound, call('message', sent, gate)))
+        await asyncio.sleep(0)
+        edits = [asyncio.create_task(edit(outbound, call(f'edit {n}', sent), message_id=n)) for n in range(2)]
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(busy, *edits)
+
+    asyncio.run(main())
+    assert sent == ['message', 'edit 0', 'edit 1']
+
+
+def test_messages_to_a_chat_keep_their_order():
+    sent = []
+
+    async def main():
+        outbound = scheduler()
+        gate = asyncio.Event()
+        first = asyncio.create_task(send(outbound, call('first', sent, gate)))
+        await asyncio.sleep(0)
+        rest = [asyncio.create_task(send(outbound, call(name, sent))) for name in ('second', 'third')]
+        other_chat = asyncio.create_task(send(outbound, call('other chat', sent), chat_id=2))
+        await other_chat
+        gate.set()
+        await asyncio.gather(first, *rest)
+
+    asyncio.run(main())
+    assert sent == ['other chat', 'first', 'second', 'third']
+
+
+def test_failed_edit_fails_every_coalesced_caller():
+    sent = []
+
+    async def main():
+        outbound = scheduler()
+        gate = asyncio.Event()
+        busy = asyncio.create_task(send(outbound, call('message', sent, gate)))
+        await asyncio.sleep(0)
+        edits = [asyncio.create_task(edit(outbound, call(f'edit {n}', sent, error=BadRequest('Message to edit not found')))) for n in range(2)]
+        await asyncio.sleep(0)
+        gate.set()
+        return await asyncio.gather(busy, *edits, return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert sent == ['message', 'edit 1']
+    assert all(isinstance(result, BadRequest) for result in results[1:])
+
+
+def test_flood_control_pauses_and_retries():
+    attempts = []
+
+    async def callback():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RetryAfter(0)
+        return 'sent'
+
+    assert asyncio.run(send(scheduler(), callback)) == 'sent'
+    assert len(attempts) == 2
+
+
+def test_flood_control_gives_up_after_max_retries():
+    async def callback():
+        raise RetryAfter(0)
+
+    outbound = scheduler()
+    with pytest.raises(RetryAfter):
+        asyncio.run(outbound.process_request(callback, (), {}, 'sendMessage', {'chat_id': 1}, 0))
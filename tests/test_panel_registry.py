@@ -0,0 +1,107 @@
+import json
+
+import pytest
+from cryptography.fernet import Fernet
+
+import panel_registry
+from panel_registry import PanelRegistry, node_record, node_ssh_details
+
+PANEL = {'domain': 'panel.example.com', 'port': 8000, 'https': True, 'username': 'admin', 'password': 'secret'}
+
+
+@pytest.fixture
+def open_registry(tmp_path):
+    registries = []
+
+    def open_(legacy_json_file=None):
+        registry = PanelRegistry(str(tmp_path / 'marzban_bot.db'), legacy_json_file or str(tmp_path / 'missing.json'))
+        registries.append(registry)
+        return registry
+
+    yield open_
+    for registry in registries:
+        registry.close()
+
+
+def test_save_panel_records_owner_of_new_panel(open_registry):
+    registry = open_registry()
+    registry.save_panel('main', PANEL, owner_id=1)
+    assert registry.panel_owner('main') == 1
+    assert registry.get_panel('main') == PANEL
+    assert registry.panels_by_owner(1) == {'main': PANEL}
+
+
+def test_resaving_a_panel_never_changes_its_owner(open_registry):
+    registry = open_registry()
+    registry.save_panel('main', PANEL, owner_id=1)
+    registry.save_panel('main', {**PANEL, 'password': 'changed'}, owner_id=2)
+    assert registry.panel_owner('main') == 1
+    assert registry.get_panel('main')['password'] == 'changed'
+    assert registry.panels_by_owner(2) == {}
+    registry.save_panel('second', PANEL, owner_id=1)
+    assert list(registry.panels_by_owner(1)) == ['main', 'second']
+
+    reopened = open_registry()
+    assert reopened.panel_owner('main') == 1
+    assert reopened.get_panel('main')['password'] == 'changed'
+
+
+def test_resaving_a_panel_keeps_its_nodes(open_registry):
+    registry = open_registry()
+    registry.save_panel('main', PANEL, owner_id=1)
+    registry.save_node('main', '10.0.0.1', node_record({'port': '22', 'user': 'root', 'password': 'x'}))
+    registry.save_panel('main', {**PANEL, 'nodes': {}}, owner_id=1)
+    assert list(registry.nodes('main')) == ['10.0.0.1']
+    assert 'nodes' not in registry.get_panel('main')
+    assert list(open_registry().nodes('main')) == ['10.0.0.1']
+
+
+def test_save_node_requires_a_known_panel(open_registry):
+    with pytest.raises(KeyError):
+        open_registry().save_node('missing', '10.0.0.1', {})
+
+
+def test_node_record_round_trips_to_ssh_details(open_registry, monkeypatch):
+    monkeypatch.setattr(panel_registry, 'NODE_CREDENTIALS_KEY', Fernet.generate_key().decode())
+    registry = open_registry()
+    registry.save_panel('main', PANEL, owner_id=1)
+    details = {'ip': '10.0.0.1', 'port': '2222', 'user': 'root', 'password': 'x', 'key': ''}
+    registry.save_node('main', '10.0.0.1', node_record(details, cert_fingerprint='ab:cd'))
+    node = registry.get_node('main', '10.0.0.1')
+    assert node['cert_fingerprint'] == 'ab:cd'
+    assert node_ssh_details('10.0.0.1', node) == details
+    assert registry.find_node('10.0.0.1') == [('main', node)]
+
+
+def test_ssh_credentials_are_only_stored_encrypted(monkeypatch):
+    details = {'ip': '10.0.0.1', 'port': '22', 'user': 'root', 'password': 'hunter2', 'key': 'PRIVATE KEY'}
+    monkeypatch.setattr(panel_registry, 'NODE_CREDENTIALS_KEY', '')
+    record = node_record(details)
+    assert record == {'ssh_port': '22', 'ssh_user': 'root', 'cert_fingerprint': None}
+    assert node_ssh_details('10.0.0.1', record) is None
+
+    monkeypatch.setattr(panel_registry, 'NODE_CREDENTIALS_KEY', Fernet.generate_key().decode())
+    record = node_record(details)
+    assert 'hunter2' not in json.dumps(record) and 'PRIVATE KEY' not in json.dumps(record)
+    assert node_ssh_details('10.0.0.1', record) == details
+
+
+def test_credentials_need_the_key_they_were_encrypted_with(monkeypatch):
+    monkeypatch.setattr(panel_registry, 'NODE_CREDENTIALS_KEY', Fernet.generate_key().decode())
+    record = node_record({'ip': '10.0.0.1', 'port': '22', 'user': 'root', 'password': 'x'})
+    monkeypatch.setattr(panel_registry, 'NODE_CREDENTIALS_KEY', Fernet.generate_key().decode())
+    assert node_ssh_details('10.0.0.1', record) is None
+    monkeypatch.setattr(panel_registry, 'NODE_CREDENTIALS_KEY', 'not a key')
+    assert node_ssh_details('10.0.0.1', record) is None
+    assert 'ssh_secret' not in node_record({'ip': '10.0.0.1', 'port': '22', 'user': 'root', 'password': 'x'})
+
+
+def test_legacy_panels_are_imported_once_without_owner(open_registry, tmp_path):
+    legacy = tmp_path / 'marzban_panels.json'
+    legacy.write_text(json.dumps({'old': {**PANEL, 'nodes': {'10.0.0.9': {'ssh_port': '22', 'ssh_user': 'root'}}}}))
+    registry = open_registry(str(legacy))
+    assert registry.panel_owner('old') is None
+    assert list(registry.nodes('old')) == ['10.0.0.9']
+
+    registry.save_panel('old', {**PANEL, 'password': 'changed'})
+    assert open_registry(str(legacy)).get_panel('old')['password'] == 'changed'
@@ -0,0 +1,116 @@
+import asyncio
+
+import httpx
+import pytest
+
+import marzban_api
+import panel_resilience
+from panel_resilience import (
+    STATE_CLOSED,
+    STATE_HALF_OPEN,
+    STATE_OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    backoff_delay,
+    is_transient_error,
+    should_retry,
+)
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(panel_resilience.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_breaker_opens_after_threshold_and_recovers_through_a_probe(clock):
+    breaker = CircuitBreaker('p', failure_threshold=3, reset_timeout=30, half_open_probes=1)
+    for _ in range(2):
+        assert breaker.before_call() is False
+        breaker.record_failure("HTTP 503")
+    assert breaker.state == STATE_CLOSED
+    breaker.record_failure("HTTP 503")
+    assert breaker.state == STATE_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    clock[0] += 30
+    assert breaker.before_call() is True # The single half-open probe
+    assert breaker.state == STATE_HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success(probe=True)
+    assert breaker.state == STATE_CLOSED and breaker.failures == 0
+
+
+def test_failed_probe_reopens_the_breaker(clock):
+    breaker = CircuitBreaker('p', failure_threshold=1, reset_timeout=10)
+    breaker.record_failure("ConnectError")
+    clock[0] += 10
+    assert breaker.before_call() is True
+    breaker.record_failure("ConnectError", probe=True)
+    assert breaker.state == STATE_OPEN and breaker.retry_in() == 10
+
+
+def test_released_probe_frees_the_half_open_slot(clock):
+    breaker = CircuitBreaker('p', failure_threshold=1, reset_timeout=0)
+    breaker.record_failure("timeout")
+    assert breaker.before_call() is True
+    breaker.release_probe()
+    assert breaker.before_call() is True
+
+
+def test_retry_policy():
+    request = httpx.Request('POST', 'http://panel/api/node')
+    assert should_retry(False, error=httpx.ConnectError("refused", request=request))
+    assert not should_retry(False, error=httpx.ReadTimeout("slow", request=request))
+    assert should_retry(True, error=httpx.ReadTimeout("slow", request=request))
+    assert not should_retry(True, error=CircuitOpenError("open"))
+    assert should_retry(True, status_code=503) and not should_retry(False, status_code=503)
+    assert not should_retry(True, status_code=500)
+
+    def status_error(code):
+        return httpx.HTTPStatusError("error", request=request, response=httpx.Response(code, request=request))
+    assert is_transient_error(status_error(504)) and not is_transient_error(status_error(409))
+    assert is_transient_error(httpx.ReadTimeout("slow", request=request))
+
+
+def test_backoff_is_bounded():
+    for attempt in range(1, 20):
+        assert 0 <= backoff_delay(attempt) <= panel_resilience.PANEL_RETRY_MAX_DELAY
+
+
+def test_idempotent_request_is_retried_on_503(mock_panel):
+    responses = iter([httpx.Response(503), httpx.Response(200, json={'ok': True})])
+    panel_info = mock_panel(lambda request: next(responses))
+    response = asyncio.run(marzban_api.panel_request(panel_info, 'GET', '/api/nodes'))
+    assert response.json() == {'ok': True}
+
+
+def test_post_is_not_retried_after_it_reached_the_panel(mock_panel):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503)
+    panel_info = mock_panel(handler)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(marzban_api.panel_request(panel_info, 'POST', '/api/node'))
+    assert len(calls) == 1
+
+
+def test_open_breaker_fails_fast_without_calling_the_panel(mock_panel):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        raise httpx.ConnectError("refused", request=request)
+    panel_info = mock_panel(handler)
+    breaker = panel_resilience.get_breaker(marzban_api.panel_key(panel_info))
+    while breaker.state != STATE_OPEN:
+        with pytest.raises(httpx.HTTPError):
+            asyncio.run(marzban_api.panel_request(panel_info, 'GET', '/api/nodes'))
+    calls.clear()
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(marzban_api.panel_request(panel_info, 'GET', '/api/nodes'))
+    assert calls == []
@@ -0,0 +1,192 @@
+import asyncio
+import sqlite3
+
+from provisioning_jobs import JOB_DONE, JOB_FAILED, JOB_QUEUED, JOB_RUNNING, ProvisioningQueue
+
+
+def interrupted_queue(db_file, nodes):
+    """Enqueues one batch and stops the bot while the first job runs; returns the batch id."""
+    async def runner(job, queue):
+        queue.save_checkpoint(job['id'], 'token', {'token': 'abc'})
+        await asyncio.Event().wait()
+
+    async def main():
+        queue = ProvisioningQueue(runner, db_file, max_concurrent=1)
+        batch_id = queue.enqueue_batch('main', [{'ip': ip} for ip in nodes], chat_id=42)
+        await asyncio.sleep(0.01)
+        await queue.stop()
+        return batch_id
+
+    return asyncio.run(main())
+
+
+def test_resume_runs_unfinished_jobs_from_their_checkpoints(tmp_path):
+    db_file = str(tmp_path / 'jobs.db')
+    interrupted_queue(db_file, ['10.0.0.1', '10.0.0.2'])
+    seen = []
+
+    async def runner(job, queue):
+        seen.append((job['node_ip'], job['state'], job['checkpoints']))
+        return True, None
+
+    async def main():
+        queue = ProvisioningQueue(runner, db_file)
+        assert [job['state'] for job in reversed(queue.recent())] == [JOB_RUNNING, JOB_QUEUED]
+        job_ids = queue.resume()
+        await asyncio.sleep(0.05)
+        states = [queue.get(job_id)['state'] for job_id in job_ids]
+        await queue.stop()
+        return job_ids, states
+
+    job_ids, states = asyncio.run(main())
+    assert len(job_ids) == 2
+    assert states == [JOB_DONE, JOB_DONE]
+    assert sorted(seen) == [('10.0.0.1', JOB_RUNNING, {'token': {'token': 'abc'}}), ('10.0.0.2', JOB_RUNNING, {})]
+
+
+def test_finished_jobs_forget_the_ssh_credentials(tmp_path):
+    async def runner(job, queue):
+        assert job['node_details']['password'] == 'secret'
+        return job['node_ip'] == '10.0.0.1', None
+
+    async def main():
+        queue = ProvisioningQueue(runner, str(tmp_path / 'jobs.db'))
+        for ip in ('10.0.0.1', '10.0.0.2'):
+            queue.enqueue('main', {'ip': ip, 'port': '22', 'user': 'root', 'password': 'secret', 'key': 'KEY'})
+        await asyncio.sleep(0.05)
+        jobs = queue.recent()
+        await queue.stop()
+        return jobs
+
+    jobs = asyncio.run(main())
+    assert {job['state'] for job in jobs} == {JOB_DONE, JOB_FAILED}
+    assert [job['node_details'] for job in jobs] == [
+        {'ip': '10.0.0.2', 'port': '22', 'user': 'root'},
+        {'ip': '10.0.0.1', 'port': '22', 'user': 'root'},
+    ]
+    with sqlite3.connect(str(tmp_path / 'jobs.db')) as conn:
+        assert not conn.execute("SELECT 1 FROM jobs WHERE node_details LIKE '%secret%'").fetchone()
+
+def test_resume_skips_jobs_already_scheduled(tmp_path):
+    runs = []
+
+    async def runner(job, queue):
+        runs.append(job['id'])
+        await asyncio.sleep(0.01)
+        return True, None
+
+    async def main():
+        queue = ProvisioningQueue(runner, str(tmp_path / 'jobs.db'))
+        job_id = queue.enqueue('main', {'ip': '10.0.0.1'})
+        assert queue.resume() == []
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        return job_id
+
+    assert runs == [asyncio.run(main())]
+
+
+def test_jobs_of_a_panel_respect_its_limit(tmp_path):
+    running = {'main': 0, 'other': 0}
+    peak = {'main': 0, 'other': 0}
+
+    async def runner(job, queue):
+        panel = job['panel_name']
+        running[panel] += 1
+        peak[panel] = max(peak[panel], running[panel])
+        await asyncio.sleep(0.01)
+        running[panel] -= 1
+        return True, None
+
+    async def main():
+        queue = ProvisioningQueue(runner, str(tmp_path / 'jobs.db'), max_concurrent=10, max_per_panel=2)
+        queue.enqueue_batch('main', [{'ip': f'10.0.0.{n}'} for n in range(6)])
+        queue.enqueue_batch('other', [{'ip': f'10.0.1.{n}'} for n in range(2)])
+        await asyncio.sleep(0.1)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert peak == {'main': 2, 'other': 2}
+
+
+def test_backlog_of_one_panel_does_not_hold_back_other_panels(tmp_path):
+    started = []
+    release = None
+
+    async def runner(job, queue):
+        started.append(job['panel_name'])
+        await release.wait()
+        return True, None
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        queue = ProvisioningQueue(runner, str(tmp_path / 'jobs.db'), max_concurrent=3, max_per_panel=2)
+        queue.enqueue_batch('main', [{'ip': f'10.0.0.{n}'} for n in range(10)])
+        await asyncio.sleep(0.01)
+        queue.enqueue('other', {'ip': '10.0.1.1'})
+        await asyncio.sleep(0.01)
+        queued = [job['state'] for job in queue.recent(limit=20)].count(JOB_QUEUED)
+        release.set()
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        return queued
+
+    assert asyncio.run(main()) == 8
+    assert started[:3] == ['main', 'main', 'other']
+    assert started.count('main') == 10
+
+def test_batch_is_reported_once_with_the_results_of_its_jobs(tmp_path):
+    reports = []
+
+    async def runner(job, queue):
+        queue.save_result(job['id'], {'stage': 'done'})
+        return (True, None) if job['node_ip'] != '10.0.0.2' else (False, 'failed at stage ssh')
+
+    async def on_batch_finished(batch, jobs):
+        reports.append((batch, jobs))
+
+    async def main():
+        queue = ProvisioningQueue(runner, str(tmp_path / 'jobs.db'), on_batch_finished=on_batch_finished)
+        batch_id = queue.enqueue_batch('main', [{'ip': '10.0.0.1'}, {'ip': '10.0.0.2'}], chat_id=42)
+        queue.enqueue('main', {'ip': '10.0.0.3'}, chat_id=42)
+        await asyncio.sleep(0.05)
+        assert queue.get_batch(batch_id)['reported_at'] is not None
+        await queue.stop()
+        return batch_id
+
+    batch_id = asyncio.run(main())
+    assert len(reports) == 1
+    batch, jobs = reports[0]
+    assert (batch['id'], batch['panel_name'], batch['chat_id']) == (batch_id, 'main', 42)
+    assert [(job['node_ip'], job['state'], job['result']) for job in jobs] == [
+        ('10.0.0.1', JOB_DONE, {'stage': 'done'}),
+        ('10.0.0.2', JOB_FAILED, {'stage': 'done'}),
+    ]
+
+
+def test_batch_finished_before_a_restart_is_reported_on_resume(tmp_path):
+    db_file = str(tmp_path / 'jobs.db')
+    batch_id = interrupted_queue(db_file, ['10.0.0.1'])
+    # The job finished, but the bot stopped before reporting its batch
+    with sqlite3.connect(db_file) as conn:
+        conn.execute("UPDATE jobs SET state = ?", (JOB_DONE,))
+    reports = []
+
+    async def runner(job, queue):
+        raise AssertionError("finished jobs must not run again")
+
+    async def on_batch_finished(batch, jobs):
+        reports.append(batch['id'])
+
+    async def main():
+        queue = ProvisioningQueue(runner, db_file, on_batch_finished=on_batch_finished)
+        assert queue.resume() == []
+        await asyncio.sleep(0.01)
+        queue.resume()
+        await asyncio.sleep(0.01)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert reports == [batch_id]
+
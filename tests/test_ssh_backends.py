@@ -0,0 +1,17 @@
+import pytest
+
+from ssh_backends import SSHSession, _remote_dirs
+
+
+def test_incomplete_session_fails_when_constructed():
+    class RunOnlySession(SSHSession):
+        async def run(self, command, on_text=None, pty=False):
+            return 0, ''
+
+    with pytest.raises(TypeError):
+        RunOnlySession()
+
+
+def test_remote_dirs_lists_parents_first():
+    files = [('a', '/opt/marzban-node/docker-compose.yml'), ('b', '/var/lib/marzban-node/ssl_cert.pem')]
+    assert _remote_dirs(files) == ['/opt', '/opt/marzban-node', '/var', '/var/lib', '/var/lib/marzban-node']
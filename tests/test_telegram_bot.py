@@ -0,0 +1,50 @@
+import pytest
+from cryptography.fernet import Fernet
+
+import panel_registry
+import telegram_bot
+from panel_registry import PanelRegistry, node_record
+
+PANEL = {'domain': 'panel.example.com', 'port': 8000, 'https': True, 'username': 'admin', 'password': 'secret'}
+NODE = {'ip': '10.0.0.1', 'port': '22', 'user': 'root', 'password': 'x', 'key': ''}
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    monkeypatch.setattr(panel_registry, 'NODE_CREDENTIALS_KEY', Fernet.generate_key().decode())
+    registry = PanelRegistry(str(tmp_path / 'marzban_bot.db'), str(tmp_path / 'missing.json'))
+    monkeypatch.setattr(telegram_bot, 'get_registry', lambda: registry)
+    for name, owner_id in (('main', 1), ('other', 2)):
+        registry.save_panel(name, PANEL, owner_id=owner_id)
+    yield registry
+    registry.close()
+
+
+def test_teardown_uses_the_recorded_credentials(registry):
+    registry.save_node('main', '10.0.0.1', node_record(NODE))
+    assert telegram_bot.teardown_node_details('main', '10.0.0.1') == NODE
+
+
+def test_teardown_leaves_nodes_the_bot_did_not_install(registry):
+    assert telegram_bot.teardown_node_details('main', '10.0.0.1') is None
+
+
+def test_teardown_leaves_nodes_recorded_on_another_panel(registry):
+    for panel_name in ('main', 'other'):
+        registry.save_node(panel_name, '10.0.0.1', node_record(NODE))
+    assert telegram_bot.teardown_node_details('main', '10.0.0.1') is None
+    registry.delete_node('other', '10.0.0.1')
+    assert telegram_bot.teardown_node_details('main', '10.0.0.1') == NODE
+
+
+def test_users_manage_only_their_own_panels(registry, monkeypatch):
+    monkeypatch.setattr(telegram_bot, 'BOT_ADMIN_IDS', {9})
+    assert telegram_bot.owned_panel_names(1) == ['main']
+    assert telegram_bot.owned_panel_names(9) == ['main', 'other']
+    assert telegram_bot.owned_panel_names(3) == []
+    assert telegram_bot.can_manage_panel(2, 'other') and not telegram_bot.can_manage_panel(2, 'main')
+    assert not telegram_bot.can_manage_panel(9, 'missing')
+
+
+def test_malformed_admin_ids_are_skipped():
+    assert telegram_bot.parse_admin_ids("1, x 2,,3") == {1, 2, 3}
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import usage_collector
+from usage_collector import DAY, HOUR, ColumnStore, PanelUsage, UsageCollector, parse_period
+
+# 2026-01-01T00:00:00Z
+DAY0 = 1767225600
+
+
+def usage(node_name, up, down):
+    return {'node_name': node_name, 'uplink': up, 'downlink': down}
+
+
+def column_sizes(prefix):
+    return {name: os.path.getsize(f"{prefix}.{name}") for name, _ in usage_collector.COLUMNS}
+
+
+@pytest.mark.parametrize('text, seconds', [('12h', 12 * HOUR), ('7d', 7 * DAY), ('3M', 90 * DAY), (' 1d ', DAY)])
+def test_parse_period(text, seconds):
+    assert parse_period(text) == seconds
+
+
+@pytest.mark.parametrize('text', ['0d', '5w', 'd', '-1h', ''])
+def test_parse_period_rejects_invalid_periods(text):
+    assert parse_period(text) is None
+
+
+def test_hourly_and_daily_rollups(tmp_path):
+    panel = PanelUsage(str(tmp_path))
+    for hour in range(3):
+        panel.add_hour(DAY0 + hour * HOUR, [usage('a', 10, 100), usage('b', 1, 0), usage(None, 0, 0)])
+    panel.add_hour(DAY0 + DAY, [usage('a', 5, 50)])
+    now = DAY0 + DAY + HOUR
+
+    assert panel.totals(HOUR, now) == {'a': (5, 50)}
+    assert panel.totals(2 * DAY, now) == {'a': (35, 350), 'b': (3, 0)}
+    # Longer than a week: the daily rows plus the open day
+    assert panel.totals(30 * DAY, now) == {'a': (35, 350), 'b': (3, 0)}
+    assert len(panel.daily) == 2 and panel.daily.last_bucket == DAY0
+    assert panel.node_names == ['a', 'b']
+
+
+def test_rollups_survive_a_restart(tmp_path):
+    panel = PanelUsage(str(tmp_path))
+    panel.add_hour(DAY0, [usage('a', 10, 100)])
+    panel.add_hour(DAY0 + DAY, [usage('a', 1, 2), usage('b', 3, 4)])
+    panel.add_hour(DAY0 + DAY + HOUR, [])
+
+    reopened = PanelUsage(str(tmp_path))
+    assert reopened.last_hour == DAY0 + DAY + HOUR
+    assert reopened.open_day_totals == panel.open_day_totals
+    assert reopened.totals(30 * DAY, DAY0 + 2 * DAY) == {'a': (11, 102), 'b': (3, 4)}
+
+
+def test_hour_written_before_a_crash_still_counts_in_its_day(tmp_path):
+    panel = PanelUsage(str(tmp_path))
+    panel.add_hour(DAY0, [usage('a', 10, 100)])
+    state = (tmp_path / 'state.json').read_text()
+    panel.add_hour(DAY0 + HOUR, [usage('a', 1, 1)])
+    # The process died after appending the hour but before saving the state
+    (tmp_path / 'state.json').write_text(state)
+
+    reopened = PanelUsage(str(tmp_path))
+    assert reopened.last_hour == DAY0 + HOUR
+    assert reopened.open_day_totals == {0: [11, 101]}
+    reopened.add_hour(DAY0 + DAY, [])
+    assert reopened.daily.totals(DAY0) == {0: [11, 101]}
+
+
+def test_closing_a_day_twice_does_not_duplicate_it(tmp_path):
+    panel = PanelUsage(str(tmp_path))
+    panel.add_hour(DAY0, [usage('a', 10, 100)])
+    state = (tmp_path / 'state.json').read_text()
+    panel.add_hour(DAY0 + DAY, [])
+    # The day was rolled up, then the process died before saving the state
+    (tmp_path / 'state.json').write_text(state)
+
+    reopened = PanelUsage(str(tmp_path))
+    reopened.add_hour(DAY0 + DAY, [])
+    assert len(reopened.daily) == 1
+    assert reopened.totals(30 * DAY, DAY0 + DAY + HOUR) == {'a': (10, 100)}
+
+
+def test_missing_daily_rows_are_rebuilt_from_the_hourly_rows(tmp_path):
+    panel = PanelUsage(str(tmp_path))
+    panel.add_hour(DAY0, [usage('a', 10, 100)])
+    panel.add_hour(DAY0 + 2 * DAY, [usage('a', 1, 1)])
+    panel.add_hour(DAY0 + 3 * DAY, [])
+    for name, _ in usage_collector.COLUMNS:
+        os.remove(tmp_path / f'daily.{name}')
+
+    reopened = PanelUsage(str(tmp_path))
+    assert list(reopened.daily.columns['bucket']) == [DAY0, DAY0 + 2 * DAY]
+    assert reopened.totals(30 * DAY, DAY0 + 3 * DAY + HOUR) == {'a': (11, 101)}
+
+
+@pytest.mark.parametrize('written_rows', [0, 1])
+def test_interrupted_append_drops_the_whole_bucket(tmp_path, written_rows):
+    prefix = str(tmp_path / 'hourly')
+    store = ColumnStore(prefix)
+    store.append([(DAY0, 0, 1, 1)])
+    complete = column_sizes(prefix)
+    store.append([(DAY0 + HOUR, 0, 2, 2), (DAY0 + HOUR, 1, 3, 3)])
+    # The last columns got only part of the second hour (``written_rows`` rows of its two)
+    item_size = store.columns['up'].itemsize
+    with open(f"{prefix}.up", 'r+b') as f:
+        f.truncate(complete['up'] + written_rows * item_size + 3)
+    with open(f"{prefix}.down", 'r+b') as f:
+        f.truncate(complete['down'] + written_rows * item_size)
+
+    reopened = ColumnStore(prefix)
+    assert len(reopened) == 1 and reopened.last_bucket == DAY0
+    assert column_sizes(prefix) == complete
+    reopened.append([(DAY0 + HOUR, 0, 2, 2)])
+    assert ColumnStore(prefix).totals(DAY0 + HOUR) == {0: [2, 2]}
+
+
+def test_interrupted_first_write_starts_empty(tmp_path):
+    prefix = str(tmp_path / 'hourly')
+    with open(f"{prefix}.bucket", 'wb') as f:
+        f.write(b'\0' * 16)
+
+    store = ColumnStore(prefix)
+    assert len(store) == 0
+    store.append([(DAY0, 0, 1, 1)])
+    assert ColumnStore(prefix).totals(0) == {0: [1, 1]}
+
+
+def test_collect_panel_fetches_each_completed_hour_once(tmp_path, monkeypatch):
+    requests = []
+    failing = set()
+
+    async def get_marzban_nodes_usage(panel_info, start, end):
+        requests.append(start)
+        if start in failing:
+            return None
+        return [usage('a', 1, 10)]
+
+    monkeypatch.setattr(usage_collector, 'get_marzban_nodes_usage', get_marzban_nodes_usage)
+    monkeypatch.setattr(usage_collector, 'USAGE_BACKFILL_HOURS', 3)
+    collector = UsageCollector(str(tmp_path))
+    now = DAY0 + 10 * HOUR + 120
+
+    assert asyncio.run(collector.collect_panel('main', {}, now)) == 3
+    assert requests == ['2026-01-01T07:00:00', '2026-01-01T08:00:00', '2026-01-01T09:00:00']
+    assert asyncio.run(collector.collect_panel('main', {}, now)) == 0
+
+    # A failed hour is retried from the same hour on the next poll
+    failing.add('2026-01-01T11:00:00')
+    requests.clear()
+    assert asyncio.run(collector.collect_panel('main', {}, now + 3 * HOUR)) == 1
+    assert requests == ['2026-01-01T10:00:00', '2026-01-01T11:00:00']
+    failing.clear()
+    assert asyncio.run(collector.collect_panel('main', {}, now + 3 * HOUR)) == 2
+    assert collector.panel_usage('main').totals(DAY, now + 3 * HOUR) == {'a': (6, 60)}
+    assert json.loads((tmp_path / 'main' / 'state.json').read_text()) == {'last_hour': DAY0 + 12 * HOUR}
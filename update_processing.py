@@ -0,0 +1,70 @@
+"""Concurrent Telegram update processing that keeps the updates of each chat in order.
+
+With python-telegram-bot's default processing a long handler (a provisioning
+run, a slow panel call) delays every other chat. ChatOrderedUpdateProcessor runs
+updates of different chats concurrently but serializes the updates of one chat,
+so ConversationHandler state transitions stay consistent.
+"""
+import asyncio
+import os
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates handled at the same time (across chats)
+BOT_CONCURRENT_UPDATES = int(os.environ.get("BOT_CONCURRENT_UPDATES", "32"))
+# Updates accepted before fetching pauses, including those waiting behind their chat
+BOT_MAX_PENDING_UPDATES = int(os.environ.get("BOT_MAX_PENDING_UPDATES", "1024"))
+
+
+def update_chat_key(update: object):
+    """Returns the chat (or, without one, the user) an update belongs to; None if neither."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return ('chat', update.effective_chat.id)
+    if update.effective_user:
+        return ('user', update.effective_user.id)
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, one at a time per chat, in arrival order.
+
+    The base class semaphore only bounds pending updates (``max_pending_updates``);
+    the limit of ``max_concurrent_updates`` running handlers is applied after the
+    per-chat lock is taken, so updates queued behind a busy chat don't occupy slots
+    other chats could use.
+    """
+
+    def __init__(self, max_concurrent_updates: int = BOT_CONCURRENT_UPDATES, max_pending_updates: int = BOT_MAX_PENDING_UPDATES):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.running_limit = max_concurrent_updates
+        self._running = None
+        # chat key -> [lock, number of updates holding or waiting for it]
+        self._chat_locks = {}
+
+    async def initialize(self) -> None:
+        self._running = asyncio.Semaphore(self.running_limit)
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = update_chat_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._chat_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes waiters in FIFO order, which keeps each chat's updates in order
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[key]
@@ -0,0 +1,280 @@
+"""Per-node traffic collected from all panels into hourly and daily rollups.
+
+Marzban records node usage in hourly buckets, so the collector fetches every
+completed hour exactly once per panel (``/api/nodes/usage`` for that hour only)
+and remembers the last collected hour across restarts. Hourly rows are appended
+to column files (one ``array`` file per column); a day's totals are rolled up
+from its hourly rows into the daily column files once the day is complete. Queries
+sum the rows of the requested period straight from the in-memory columns.
+
+The hourly rows are the source of truth: the totals of the open day and any
+missing daily rows are rebuilt from them on load, and an append interrupted by a
+crash is dropped as a whole, so its hour is fetched again.
+
+Layout of USAGE_DATA_DIR/<panel>/: ``nodes.json`` (node index -> name),
+``state.json`` (last collected hour), ``hourly.<column>`` and ``daily.<column>``.
+"""
+import array
+import asyncio
+import bisect
+import datetime
+import json
+import logging
+import os
+import re
+import time
+
+from marzban_api import get_marzban_nodes_usage
+from panel_registry import get_registry
+
+logger = logging.getLogger(__name__)
+
+USAGE_DATA_DIR = os.environ.get("MARZBAN_USAGE_DIR", "usage_data")
+USAGE_POLL_INTERVAL = float(os.environ.get("USAGE_POLL_INTERVAL", "600"))
+# Hours fetched on the first collection of a panel
+USAGE_BACKFILL_HOURS = int(os.environ.get("USAGE_BACKFILL_HOURS", "24"))
+
+HOUR, DAY = 3600, 86400
+# Periods up to this length are answered from hourly rows, longer ones from daily rows
+HOURLY_QUERY_LIMIT = 7 * DAY
+
+COLUMNS = (('bucket', 'q'), ('node', 'I'), ('up', 'Q'), ('down', 'Q'))
+
+
+def _atomic_write_json(path: str, data) -> None:
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+class ColumnStore:
+    """Append-only table kept as one ``array`` per column, mirrored to one file per column.
+
+    Rows are appended in bucket order, so a period is found by bisecting the bucket column.
+    """
+
+    def __init__(self, path_prefix: str):
+        self.path_prefix = path_prefix
+        self.columns = {name: array.array(typecode) for name, typecode in COLUMNS}
+        paths = {name: f"{path_prefix}.{name}" for name, _ in COLUMNS}
+        sizes = {name: os.path.getsize(path) for name, path in paths.items() if os.path.exists(path)}
+        if not sizes:
+            return
+        # A first write interrupted before every column file existed left nothing usable
+        rows = min(size // self.columns[name].itemsize for name, size in sizes.items()) if len(sizes) == len(COLUMNS) else 0
+        if rows:
+            for name, column in self.columns.items():
+                with open(paths[name], 'rb') as f:
+                    column.fromfile(f, rows)
+        if any(sizes.get(name) != rows * column.itemsize for name, column in self.columns.items()):
+            # Every append holds a single bucket and writes the bucket column first, so the
+            # bucket file names the interrupted bucket; drop the rows of it that made it everywhere
+            buckets = self.columns['bucket']
+            if rows and sizes['bucket'] >= (rows + 1) * buckets.itemsize:
+                with open(paths['bucket'], 'rb') as f:
+                    f.seek(rows * buckets.itemsize)
+                    interrupted = array.array(buckets.typecode)
+                    interrupted.fromfile(f, 1)
+                rows = bisect.bisect_left(buckets, interrupted[0])
+                for column in self.columns.values():
+                    del column[rows:]
+            logger.warning(f"Dropping an interrupted write from {path_prefix}, keeping {rows} rows")
+            self._truncate_files(rows)
+
+    def _truncate_files(self, rows: int) -> None:
+        for name, column in self.columns.items():
+            with open(f"{self.path_prefix}.{name}", 'ab') as f:
+                f.truncate(rows * column.itemsize)
+
+    def __len__(self) -> int:
+        return len(self.columns['bucket'])
+
+    def append(self, rows: list) -> None:
+        """Appends ``(bucket, node, up, down)`` rows."""
+        if not rows:
+            return
+        new = {name: array.array(typecode) for name, typecode in COLUMNS}
+        for row in rows:
+            for (name, _), value in zip(COLUMNS, row):
+                new[name].append(value)
+        for name, values in new.items():
+            with open(f"{self.path_prefix}.{name}", 'ab') as f:
+                values.tofile(f)
+            self.columns[name].extend(values)
+
+    @property
+    def last_bucket(self):
+        buckets = self.columns['bucket']
+        return buckets[-1] if buckets else None
+
+    def totals(self, since: int, until: int = None) -> dict:
+        """Sums ``{node: [up, down]}`` over rows with ``since <= bucket < until``."""
+        buckets = self.columns['bucket']
+        start = bisect.bisect_left(buckets, since)
+        end = bisect.bisect_left(buckets, until) if until is not None else len(buckets)
+        nodes, ups, downs = self.columns['node'], self.columns['up'], self.columns['down']
+        totals = {}
+        for i in range(start, end):
+            total = totals.setdefault(nodes[i], [0, 0])
+            total[0] += ups[i]
+            total[1] += downs[i]
+        return totals
+
+
+class PanelUsage:
+    """Usage rollups of one panel."""
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.hourly = ColumnStore(os.path.join(directory, 'hourly'))
+        self.daily = ColumnStore(os.path.join(directory, 'daily'))
+        self.node_names = self._load_json('nodes.json', [])
+        self._node_index = {name: index for index, name in enumerate(self.node_names)}
+        state = self._load_json('state.json', {})
+        # Hourly rows may have been written before a crash prevented saving the state
+        known_hours = [hour for hour in (state.get('last_hour'), self.hourly.last_bucket) if hour is not None]
+        self.last_hour = max(known_hours) if known_hours else None
+        self.open_day = self.last_hour - self.last_hour % DAY if self.last_hour is not None else None
+        self.open_day_totals = {}
+        if self.open_day is not None:
+            self._roll_up_days(self.open_day)
+            self.open_day_totals = self.hourly.totals(self.open_day)
+
+    def _load_json(self, name: str, default):
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return default
+        with open(path) as f:
+            return json.load(f)
+
+    def _node(self, name: str) -> int:
+        if name not in self._node_index:
+            self._node_index[name] = len(self.node_names)
+            self.node_names.append(name)
+            _atomic_write_json(os.path.join(self.directory, 'nodes.json'), self.node_names)
+        return self._node_index[name]
+
+    def _roll_up_days(self, until_day: int) -> None:
+        """Appends the daily rows of every day before ``until_day`` that has hourly rows but no daily rows yet."""
+        buckets = self.hourly.columns['bucket']
+        daily_last = self.daily.last_bucket
+        day = daily_last + DAY if daily_last is not None else 0
+        while day < until_day:
+            i = bisect.bisect_left(buckets, day)
+            if i == len(buckets) or buckets[i] >= until_day:
+                break
+            day = buckets[i] - buckets[i] % DAY
+            self.daily.append([(day, node, up, down) for node, (up, down) in sorted(self.hourly.totals(day, day + DAY).items())])
+            day += DAY
+
+    def add_hour(self, hour: int, usages: list) -> None:
+        """Records the usage of one completed hour (rows with no traffic are skipped)."""
+        rows = []
+        for usage in usages:
+            up, down = int(usage.get('uplink') or 0), int(usage.get('downlink') or 0)
+            if up or down:
+                rows.append((hour, self._node(usage.get('node_name') or 'Master'), up, down))
+
+        day = hour - hour % DAY
+        if self.open_day is not None and day != self.open_day:
+            self._roll_up_days(day)
+            self.open_day_totals = {}
+        self.open_day = day
+        for _, node, up, down in rows:
+            totals = self.open_day_totals.setdefault(node, [0, 0])
+            totals[0] += up
+            totals[1] += down
+
+        self.hourly.append(rows)
+        self.last_hour = hour
+        # Hours without traffic leave no rows, so the last collected hour is kept separately
+        _atomic_write_json(os.path.join(self.directory, 'state.json'), {'last_hour': self.last_hour})
+
+    def totals(self, period: int, now: float = None) -> dict:
+        """Returns ``{node_name: (up, down)}`` over the last ``period`` seconds."""
+        since = int(now if now is not None else time.time()) - period
+        if period <= HOURLY_QUERY_LIMIT:
+            by_node = self.hourly.totals(since - since % HOUR)
+        else:
+            by_node = self.daily.totals(since - since % DAY)
+            for node, (up, down) in self.open_day_totals.items():
+                total = by_node.setdefault(node, [0, 0])
+                total[0] += up
+                total[1] += down
+        return {self.node_names[node]: tuple(total) for node, total in by_node.items()}
+
+
+def _utc(timestamp: int) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def parse_period(text: str):
+    """Parses ``12h``, ``7d`` or ``3m`` (30-day months) into seconds; None if invalid."""
+    match = re.fullmatch(r'(\d+)([hdm])', text.strip().lower())
+    if not match or int(match.group(1)) == 0:
+        return None
+    return int(match.group(1)) * {'h': HOUR, 'd': DAY, 'm': 30 * DAY}[match.group(2)]
+
+
+class UsageCollector:
+    """Polls every panel for newly completed hours of node usage."""
+
+    def __init__(self, data_dir: str = USAGE_DATA_DIR, interval: float = USAGE_POLL_INTERVAL):
+        self.data_dir = data_dir
+        self.interval = interval
+        self.panels = {}
+        self._task = None
+
+    def panel_usage(self, panel_name: str) -> PanelUsage:
+        if panel_name not in self.panels:
+            safe_name = re.sub(r'[^A-Za-z0-9._-]', '_', panel_name)
+            self.panels[panel_name] = PanelUsage(os.path.join(self.data_dir, safe_name))
+        return self.panels[panel_name]
+
+    async def collect_panel(self, panel_name: str, panel_info: dict, now: float = None) -> int:
+        """Fetches every completed hour not collected yet; returns the number of hours stored."""
+        usage = self.panel_usage(panel_name)
+        current_hour = int(now if now is not None else time.time()) // HOUR * HOUR
+        hour = usage.last_hour + HOUR if usage.last_hour is not None else current_hour - USAGE_BACKFILL_HOURS * HOUR
+        collected = 0
+        while hour < current_hour:
+            usages = await get_marzban_nodes_usage(panel_info, _utc(hour), _utc(hour + HOUR - 1))
+            if usages is None:
+                break # Retried from the same hour on the next poll
+            usage.add_hour(hour, usages)
+            collected += 1
+            hour += HOUR
+        return collected
+
+    async def collect_all(self) -> None:
+        panels = get_registry().panels()
+        results = await asyncio.gather(
+            *(self.collect_panel(name, panel_info) for name, panel_info in panels.items()), return_exceptions=True
+        )
+        for name, result in zip(panels, results):
+            if isinstance(result, Exception):
+                logger.error(f"Usage collection for panel {name} failed: {result}")
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            await self.collect_all()
+            await asyncio.sleep(self.interval)
+
+    def totals(self, period: int, panel_name: str = None) -> dict:
+        """Returns ``{(panel_name, node_name): (up, down)}`` over the last ``period`` seconds."""
+        panel_names = [panel_name] if panel_name else get_registry().panel_names()
+        totals = {}
+        for name in panel_names:
+            for node_name, total in self.panel_usage(name).totals(period).items():
+                totals[(name, node_name)] = total
+        return totals
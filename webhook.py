@@ -0,0 +1,78 @@
+"""Webhook mode settings for the bot (polling is used when BOT_WEBHOOK_URL is unset).
+
+python-telegram-bot serves the webhook itself, using tornado from its ``webhooks`` extra (in requirements.txt).
+Either terminate TLS in a reverse proxy that forwards to BOT_WEBHOOK_LISTEN:BOT_WEBHOOK_PORT,
+or set BOT_WEBHOOK_CERT/BOT_WEBHOOK_KEY to let the bot serve TLS and upload the
+certificate to Telegram; with BOT_WEBHOOK_SELF_SIGNED=1 a self-signed pair is
+generated at those paths (default webhook_cert.pem/webhook_key.pem) if missing.
+Telegram accepts self-signed certificates on ports 443, 80, 88 and 8443.
+"""
+import datetime
+import ipaddress
+import logging
+import os
+import secrets
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+BOT_WEBHOOK_URL = os.environ.get("BOT_WEBHOOK_URL") # e.g. https://bot.example.com:8443/telegram
+BOT_WEBHOOK_LISTEN = os.environ.get("BOT_WEBHOOK_LISTEN", "0.0.0.0")
+BOT_WEBHOOK_PORT = int(os.environ.get("BOT_WEBHOOK_PORT", "8443"))
+# Checked against the X-Telegram-Bot-Api-Secret-Token header; random per start when unset
+BOT_WEBHOOK_SECRET = os.environ.get("BOT_WEBHOOK_SECRET")
+BOT_WEBHOOK_CERT = os.environ.get("BOT_WEBHOOK_CERT")
+BOT_WEBHOOK_KEY = os.environ.get("BOT_WEBHOOK_KEY")
+BOT_WEBHOOK_SELF_SIGNED = os.environ.get("BOT_WEBHOOK_SELF_SIGNED", "").lower() in ("1", "true", "yes")
+
+
+def ensure_self_signed_cert(cert_path: str, key_path: str, host: str, days: int = 365) -> None:
+    """Writes a self-signed certificate for ``host`` (domain or IP) unless both files exist."""
+    if os.path.exists(cert_path) and os.path.exists(key_path):
+        return
+    # cryptography is already installed as a dependency of paramiko/asyncssh
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)])
+    try:
+        alt_name = x509.IPAddress(ipaddress.ip_address(host))
+    except ValueError:
+        alt_name = x509.DNSName(host)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name).public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5)).not_valid_after(now + datetime.timedelta(days=days))
+        .add_extension(x509.SubjectAlternativeName([alt_name]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
+    os.chmod(key_path, 0o600)
+    with open(cert_path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    logger.info(f"Generated a self-signed webhook certificate for {host} at {cert_path}")
+
+
+def webhook_options() -> dict:
+    """Returns the ``Application.run_webhook`` arguments for the configured webhook."""
+    url = urlsplit(BOT_WEBHOOK_URL)
+    options = {
+        'listen': BOT_WEBHOOK_LISTEN,
+        'port': BOT_WEBHOOK_PORT,
+        'url_path': url.path.lstrip('/'),
+        'webhook_url': BOT_WEBHOOK_URL,
+        'secret_token': BOT_WEBHOOK_SECRET or secrets.token_urlsafe(32),
+    }
+    cert_path, key_path = BOT_WEBHOOK_CERT, BOT_WEBHOOK_KEY
+    if BOT_WEBHOOK_SELF_SIGNED:
+        cert_path, key_path = cert_path or 'webhook_cert.pem', key_path or 'webhook_key.pem'
+        ensure_self_signed_cert(cert_path, key_path, url.hostname)
+    if cert_path and key_path:
+        options.update(cert=cert_path, key=key_path)
+    return options